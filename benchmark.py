@@ -0,0 +1,277 @@
+#
+# benchmark - end to end throughput and latency benchmark for the LED Emulator
+# Copyright © 2019  Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# The benchmark starts a headless emulator in this process and drives it
+# with a number of client processes. Each client sends pre-built frames at
+# a given rate. The results are printed and written to a JSON file.
+#
+#   python benchmark.py --clients 4 --pixels 1000 --fps 100 --duration 10
+#
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import sys
+import threading
+import time
+from array import array
+from struct import pack
+from configuration import Configuration
+from led_connection_handler import LEDConnectionHandler
+from led_string import LEDString, LEDStrings
+from ledsocketserver import SocketServerThread
+from ledsocketserver import AsyncSocketServerThread
+from frame_sinks import FrameSink
+from led_headless import run_headless
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+# Clients are started after the server threads. They are spawned, not
+# forked, so they do not inherit locks held by those threads.
+context = multiprocessing.get_context("spawn")
+
+
+class LatencySink(FrameSink):
+    """
+    Frame sink that records the time from receipt of a frame
+    (LEDConnectionHandler.execute_command) to its consumption.
+    """
+    def __init__(self):
+        super(LatencySink, self).__init__()
+        self.latencies = array("d")
+
+    def write_frame(self, frame):
+        super(LatencySink, self).write_frame(frame)
+        self.latencies.append(time.time() - frame.timestamp)
+
+
+def build_frames(num_pixels, count=8):
+    """
+    Build wire ready frames (frame size prefix + APA102 frame)
+    :param num_pixels:
+    :param count: Number of distinct frames
+    :return: Returns a list of bytes
+    """
+    frames = []
+    for shift in range(count):
+        body = bytearray(num_pixels * 4)
+        for i in range(num_pixels):
+            c = ((i + shift) * 37) % 256
+            body[i * 4:(i + 1) * 4] = bytes([0xE0 | 0x0E, c, 255 - c, (c * 3) % 256])
+        frame = bytes(4) + bytes(body) + bytes([0xFF, 0xFF, 0xFF, 0xFF])
+        frames.append(pack('!i', len(frame)) + frame)
+    return frames
+
+
+def build_batches(num_pixels, batch_size, count=8):
+    """
+    Build wire ready batch messages (see TCPRequestHandler)
+    :param num_pixels:
+    :param batch_size: Frames per batch
+    :param count: Number of distinct batches
+    :return: Returns a list of bytes
+    """
+    frames = [frame[4:] for frame in build_frames(num_pixels, count=count)]
+    batches = []
+    for shift in range(count):
+        batch = [frames[(shift + i) % count] for i in range(batch_size)]
+        batches.append(pack('!iHBxI', -1, batch_size, 0, num_pixels) + b"".join(batch))
+    return batches
+
+
+def run_client(host, port, num_pixels, fps, duration, result_queue, batch_size=1):
+    """
+    Client process. Sends frames for duration seconds at fps frames/sec
+    (as fast as possible when fps is 0).
+    """
+    if batch_size > 1:
+        frames = build_batches(num_pixels, batch_size)
+    else:
+        frames = build_frames(num_pixels)
+    sent = 0
+    sock = socket.create_connection((host, port))
+    try:
+        interval = (float(batch_size) / fps) if fps else 0
+        start = time.time()
+        next_send = start
+        end = start + duration
+        while True:
+            now = time.time()
+            if now >= end:
+                break
+            if interval and now < next_send:
+                time.sleep(next_send - now)
+            sock.sendall(frames[(sent // batch_size) % len(frames)])
+            sent += batch_size
+            next_send += interval
+    except Exception as ex:
+        print("Client error:", str(ex))
+    finally:
+        sock.close()
+    result_queue.put(sent)
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    k = int(round((pct / 100.0) * (len(sorted_values) - 1)))
+    return sorted_values[k]
+
+
+def current_rss_kb():
+    """
+    :return: Returns the current resident set size in KB or None if unknown
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+        return (pages * os.sysconf("SC_PAGE_SIZE")) // 1024
+    except Exception:
+        return None
+
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux reports KB
+    if sys.platform == "darwin":
+        peak //= 1024
+    return peak
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="LED Emulator end to end benchmark")
+    parser.add_argument("--clients", type=int, default=1, help="Number of concurrent clients")
+    parser.add_argument("--pixels", type=int, default=50, help="Pixels per frame")
+    parser.add_argument("--fps", type=float, default=0, help="Frames/sec per client (0 = as fast as possible)")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds to send frames")
+    parser.add_argument("--batch", type=int, default=1, help="Frames per message (batch protocol when > 1)")
+    parser.add_argument("--port", type=int, default=5556, help="Server port")
+    parser.add_argument("--server-mode", dest="server_mode", choices=["threaded", "asyncio"], default="threaded")
+    parser.add_argument("--queue-size", dest="queue_size", type=int, default=Configuration.frame_queue_size())
+    parser.add_argument("--queue-policy", dest="queue_policy", default=Configuration.frame_queue_policy())
+    parser.add_argument("--output", default="bench_output.json", help="JSON results file")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    host = "127.0.0.1"
+    led_string = LEDString("benchmark", args.port, args.pixels,
+                           queue_size=args.queue_size, queue_policy=args.queue_policy)
+    LEDStrings.configure([led_string])
+    frame_size = led_string.frame_size
+    frame_queue = led_string.frame_queue
+
+    if args.server_mode == "asyncio":
+        server_class = AsyncSocketServerThread.AsyncSocketServerThread
+    else:
+        server_class = SocketServerThread.SocketServerThread
+    server = server_class(host, args.port, LEDConnectionHandler, frame_size=frame_size)
+    server.Start()
+
+    # Drain frames the same way the headless emulator does
+    sink = LatencySink()
+    stop_event = threading.Event()
+    drain_thread = threading.Thread(target=run_headless, args=(sink,),
+                                    kwargs={"stop_event": stop_event, "report_interval": 3600})
+    drain_thread.start()
+
+    result_queue = context.Queue()
+    clients = [context.Process(target=run_client,
+                               args=(host, args.port, args.pixels, args.fps, args.duration, result_queue,
+                                     args.batch))
+               for i in range(args.clients)]
+
+    start_time = time.time()
+    start_cpu = time.process_time()
+    for client in clients:
+        client.start()
+    frames_sent = sum([result_queue.get() for client in clients])
+    for client in clients:
+        client.join()
+
+    # Allow frames in flight to arrive and the queue to drain
+    drain_deadline = time.time() + 5.0
+    while time.time() < drain_deadline:
+        consumed = sink.frame_count + sum(frame_queue.dropped().values())
+        if consumed >= frames_sent and not len(frame_queue):
+            break
+        time.sleep(0.01)
+    elapsed = time.time() - start_time
+    cpu = time.process_time() - start_cpu
+
+    stop_event.set()
+    drain_thread.join()
+    rss = current_rss_kb()
+    frame_queue.close()
+    server.Stop()
+
+    dropped = sum(frame_queue.dropped().values())
+    frames_received = sink.frame_count + dropped
+    latencies_ms = sorted([v * 1000.0 for v in sink.latencies])
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "clients": args.clients,
+            "pixels": args.pixels,
+            "fps": args.fps,
+            "duration": args.duration,
+            "batch": args.batch,
+            "server_mode": args.server_mode,
+            "queue_size": args.queue_size,
+            "queue_policy": args.queue_policy,
+        },
+        "frames_sent": frames_sent,
+        "frames_received": frames_received,
+        "frames_rendered": sink.frame_count,
+        "frames_dropped": dropped,
+        "elapsed_sec": elapsed,
+        "frames_per_sec": frames_received / elapsed,
+        "mb_per_sec": (frames_received * (frame_size + 4)) / elapsed / 1000000.0,
+        "latency_ms": {
+            "p50": percentile(latencies_ms, 50),
+            "p90": percentile(latencies_ms, 90),
+            "p99": percentile(latencies_ms, 99),
+            "max": latencies_ms[-1] if latencies_ms else None,
+        },
+        "cpu_percent": (cpu / elapsed) * 100.0,
+        "rss_kb": rss,
+        "peak_rss_kb": peak_rss_kb(),
+    }
+
+    print(json.dumps(results, indent=2))
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2)
+    print("Results written to", args.output)
+
+
+#
+# Run as an application
+#
+if __name__ == "__main__":
+    main()
@@ -27,6 +27,7 @@
 import os
 import json
 import logging
+from frame_queue import FrameRingBuffer
 
 logger = logging.getLogger("led")
 
@@ -36,9 +37,49 @@ class Configuration():
     cfg_port = 5555
     cfg_num_pixels = 50
     cfg_polling_interval = 20
+    # LED window repaint rate cap, 0 = poll every polling_interval
+    cfg_max_fps = 60
     cfg_log_console = True
     cfg_log_file = ""
     cfg_log_level = "debug"
+    cfg_headless = False
+    cfg_sink = "null"
+    cfg_sink_file = ""
+    # Options of the compare sink (see frame_compare.py)
+    cfg_compare_align = "seq"
+    cfg_compare_tolerance = 0
+    cfg_compare_max_pixels = 0
+    cfg_compare_report = ""
+    cfg_frame_queue_size = 64
+    cfg_frame_queue_policy = "drop-oldest"
+    cfg_server_mode = "threaded"
+    # Check the APA102 header, trailer and start bits of every frame
+    cfg_strict_frames = False
+    # Largest frame accepted when its size differs from a string's frame size (0 = off)
+    cfg_max_frame_size = 0
+    cfg_renderer = "canvas"
+    cfg_stats_port = 0
+    cfg_stats_file = ""
+    # Web viewer (see WebViewerServerThread), 0 = none
+    cfg_viewer_port = 0
+    cfg_viewer_max_fps = 30
+    # Layout of the lights, e.g. {"type": "serpentine", "width": 64} (see led_layout.py)
+    cfg_layout = None
+    # Color pipeline (see led_color.py)
+    cfg_apply_brightness = False
+    cfg_gamma = 1.0
+    cfg_color_order = "rgb"
+    cfg_capture_file = ""
+    # UDP frame port, 0 = none
+    cfg_udp_port = 0
+    # E1.31/Art-Net input, e.g. {"protocol": "e131", "universe": 1}, None = none
+    cfg_dmx = None
+    # List of {"name": name, "port": port, "num_pixels": num_pixels}.
+    # None means one string using port and num_pixels.
+    cfg_strings = None
+
+    # Values accepted for server_mode
+    server_modes = ["threaded", "asyncio", "process"]
 
     ######################################################################
     def __init__(self):
@@ -79,6 +120,69 @@ class Configuration():
                 cls.cfg_num_pixels = int(config["num_pixels"])
             if "polling_interval" in config:
                 cls.cfg_polling_interval = int(config["polling_interval"])
+            if "max_fps" in config:
+                cls.cfg_max_fps = int(config["max_fps"])
+            if "headless" in config:
+                cls.cfg_headless = bool(config["headless"])
+            if "sink" in config:
+                cls.cfg_sink = str(config["sink"])
+            if "sink_file" in config:
+                cls.cfg_sink_file = str(config["sink_file"])
+            if "compare_align" in config:
+                cls.cfg_compare_align = str(config["compare_align"]).lower()
+            if "compare_tolerance" in config:
+                cls.cfg_compare_tolerance = int(config["compare_tolerance"])
+            if "compare_max_pixels" in config:
+                cls.cfg_compare_max_pixels = int(config["compare_max_pixels"])
+            if "compare_report" in config:
+                cls.cfg_compare_report = str(config["compare_report"])
+            if "frame_queue_size" in config:
+                cls.cfg_frame_queue_size = int(config["frame_queue_size"])
+            if "frame_queue_policy" in config:
+                cls.cfg_frame_queue_policy = cls.choice(config, "frame_queue_policy", FrameRingBuffer.policies,
+                                                        cls.cfg_frame_queue_policy)
+            if "server_mode" in config:
+                cls.cfg_server_mode = cls.choice(config, "server_mode", cls.server_modes, cls.cfg_server_mode)
+            if "strict_frames" in config:
+                cls.cfg_strict_frames = bool(config["strict_frames"])
+            if "max_frame_size" in config:
+                cls.cfg_max_frame_size = int(config["max_frame_size"])
+            if "renderer" in config:
+                cls.cfg_renderer = str(config["renderer"]).lower()
+            if "stats_port" in config:
+                cls.cfg_stats_port = int(config["stats_port"])
+            if "stats_file" in config:
+                cls.cfg_stats_file = str(config["stats_file"])
+            if "viewer_port" in config:
+                cls.cfg_viewer_port = int(config["viewer_port"])
+            if "viewer_max_fps" in config:
+                cls.cfg_viewer_max_fps = int(config["viewer_max_fps"])
+            if "layout" in config:
+                cls.cfg_layout = dict(config["layout"])
+            if "apply_brightness" in config:
+                cls.cfg_apply_brightness = bool(config["apply_brightness"])
+            if "gamma" in config:
+                cls.cfg_gamma = float(config["gamma"])
+            if "color_order" in config:
+                cls.cfg_color_order = str(config["color_order"]).lower()
+            if "udp_port" in config:
+                cls.cfg_udp_port = int(config["udp_port"])
+            if "dmx" in config:
+                cls.cfg_dmx = dict(config["dmx"]) if config["dmx"] else None
+            if "capture_file" in config:
+                cls.cfg_capture_file = str(config["capture_file"])
+            if "strings" in config:
+                strings = []
+                for i, s in enumerate(config["strings"]):
+                    strings.append({
+                        "name": str(s.get("name", "String {0}".format(i + 1))),
+                        "port": int(s["port"]),
+                        "num_pixels": int(s.get("num_pixels", cls.cfg_num_pixels)),
+                        "layout": dict(s["layout"]) if "layout" in s else cls.cfg_layout,
+                        "udp_port": int(s.get("udp_port", 0)),
+                        "dmx": dict(s["dmx"]) if s.get("dmx") else None,
+                    })
+                cls.cfg_strings = strings
         except Exception as ex:
             print("Unable to parse configuration file as JSON")
             print(str(ex))
@@ -86,15 +190,61 @@ class Configuration():
 
         return
 
+    ######################################################################
+    @classmethod
+    def choice(cls, config, key, choices, default):
+        """
+        Check a configuration value that must be one of a set of names
+        :param config: The parsed configuration file
+        :param key: The configuration key
+        :param choices: The accepted values
+        :param default: The value used when the configured one is not accepted
+        :return: Returns the configured value or the default
+        """
+        value = str(config[key]).lower()
+        if value not in choices:
+            logger.error("Invalid %s in configuration file: %s (expected one of %s). Using %s.",
+                         key, value, ", ".join(choices), default)
+            return default
+        return value
+
     @classmethod
     def dump_configuration(cls):
         logger.info("Active configuration")
         logger.info("port: %d", cls.cfg_port)
         logger.info("num_pixels: %d", cls.cfg_num_pixels)
         logger.info("polling_interval: %d", cls.cfg_polling_interval)
+        logger.info("max_fps: %d", cls.cfg_max_fps)
         logger.info("log_console: %s", str(cls.cfg_log_console))
         logger.info("log_file: %s", cls.cfg_log_file)
         logger.info("log_level: %s", cls.cfg_log_level)
+        logger.info("headless: %s", str(cls.cfg_headless))
+        logger.info("sink: %s", cls.cfg_sink)
+        logger.info("sink_file: %s", cls.cfg_sink_file)
+        logger.info("compare_align: %s", cls.cfg_compare_align)
+        logger.info("compare_tolerance: %d", cls.cfg_compare_tolerance)
+        logger.info("compare_max_pixels: %d", cls.cfg_compare_max_pixels)
+        logger.info("compare_report: %s", cls.cfg_compare_report)
+        logger.info("frame_queue_size: %d", cls.cfg_frame_queue_size)
+        logger.info("frame_queue_policy: %s", cls.cfg_frame_queue_policy)
+        logger.info("server_mode: %s", cls.cfg_server_mode)
+        logger.info("strict_frames: %s", str(cls.cfg_strict_frames))
+        logger.info("max_frame_size: %d", cls.cfg_max_frame_size)
+        logger.info("renderer: %s", cls.cfg_renderer)
+        logger.info("stats_port: %d", cls.cfg_stats_port)
+        logger.info("stats_file: %s", cls.cfg_stats_file)
+        logger.info("viewer_port: %d", cls.cfg_viewer_port)
+        logger.info("viewer_max_fps: %d", cls.cfg_viewer_max_fps)
+        logger.info("layout: %s", str(cls.cfg_layout))
+        logger.info("apply_brightness: %s", str(cls.cfg_apply_brightness))
+        logger.info("gamma: %f", cls.cfg_gamma)
+        logger.info("color_order: %s", cls.cfg_color_order)
+        logger.info("capture_file: %s", cls.cfg_capture_file)
+        logger.info("udp_port: %d", cls.cfg_udp_port)
+        logger.info("dmx: %s", str(cls.cfg_dmx))
+        for s in cls.strings():
+            logger.info("string: %s port: %d udp_port: %d num_pixels: %d layout: %s dmx: %s",
+                        s["name"], s["port"], s["udp_port"], s["num_pixels"], str(s["layout"]), str(s["dmx"]))
 
     ######################################################################
     @classmethod
@@ -122,6 +272,147 @@ class Configuration():
     def num_pixels(cls):
         return cls.cfg_num_pixels
 
+    ######################################################################
+    @classmethod
+    def polling_interval(cls):
+        return cls.cfg_polling_interval
+
+    ######################################################################
+    @classmethod
+    def max_fps(cls):
+        return cls.cfg_max_fps
+
+    ######################################################################
+    @classmethod
+    def headless(cls):
+        return cls.cfg_headless
+
+    ######################################################################
+    @classmethod
+    def sink(cls):
+        return cls.cfg_sink
+
+    ######################################################################
+    @classmethod
+    def sink_file(cls):
+        return cls.cfg_sink_file
+
+    ######################################################################
+    @classmethod
+    def compare_align(cls):
+        return cls.cfg_compare_align
+
+    ######################################################################
+    @classmethod
+    def compare_tolerance(cls):
+        return cls.cfg_compare_tolerance
+
+    ######################################################################
+    @classmethod
+    def compare_max_pixels(cls):
+        return cls.cfg_compare_max_pixels
+
+    ######################################################################
+    @classmethod
+    def compare_report(cls):
+        return cls.cfg_compare_report
+
+    ######################################################################
+    @classmethod
+    def frame_queue_size(cls):
+        return cls.cfg_frame_queue_size
+
+    ######################################################################
+    @classmethod
+    def frame_queue_policy(cls):
+        return cls.cfg_frame_queue_policy
+
+    ######################################################################
+    @classmethod
+    def server_mode(cls):
+        return cls.cfg_server_mode
+
+    ######################################################################
+    @classmethod
+    def strict_frames(cls):
+        return cls.cfg_strict_frames
+
+    ######################################################################
+    @classmethod
+    def max_frame_size(cls):
+        return cls.cfg_max_frame_size
+
+    ######################################################################
+    @classmethod
+    def renderer(cls):
+        return cls.cfg_renderer
+
+    ######################################################################
+    @classmethod
+    def stats_port(cls):
+        return cls.cfg_stats_port
+
+    ######################################################################
+    @classmethod
+    def stats_file(cls):
+        return cls.cfg_stats_file
+
+    ######################################################################
+    @classmethod
+    def viewer_port(cls):
+        return cls.cfg_viewer_port
+
+    ######################################################################
+    @classmethod
+    def viewer_max_fps(cls):
+        return cls.cfg_viewer_max_fps
+
+    ######################################################################
+    @classmethod
+    def layout(cls):
+        return cls.cfg_layout
+
+    ######################################################################
+    @classmethod
+    def apply_brightness(cls):
+        return cls.cfg_apply_brightness
+
+    ######################################################################
+    @classmethod
+    def gamma(cls):
+        return cls.cfg_gamma
+
+    ######################################################################
+    @classmethod
+    def color_order(cls):
+        return cls.cfg_color_order
+
+    ######################################################################
+    @classmethod
+    def udp_port(cls):
+        return cls.cfg_udp_port
+
+    ######################################################################
+    @classmethod
+    def dmx(cls):
+        return cls.cfg_dmx
+
+    ######################################################################
+    @classmethod
+    def capture_file(cls):
+        return cls.cfg_capture_file
+
+    ######################################################################
+    @classmethod
+    def strings(cls):
+        """
+        Returns the list of LED strings to be emulated
+        """
+        if cls.cfg_strings:
+            return cls.cfg_strings
+        return [{"name": "LED string", "port": cls.cfg_port, "num_pixels": cls.cfg_num_pixels,
+                 "layout": cls.cfg_layout, "udp_port": cls.cfg_udp_port, "dmx": cls.cfg_dmx}]
+
     ######################################################################
     @classmethod
     def log_console(cls):
@@ -0,0 +1,302 @@
+#
+# LED frame capture files
+# Copyright © 2019  Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# A capture file holds every frame a LED string received, in the order
+# received. All values are little endian.
+#
+# Header
+#   magic       8 bytes  b"LEDCAP01"
+#   header_size uint32   offset of the first record
+#   num_pixels  uint32
+#   record_size uint32   16 + (num_pixels * 4)
+#   layout_size uint32   length of the layout JSON
+#   created     float64  time.time() when the capture was started
+#   layout      layout_size bytes of UTF-8 JSON (see LEDLayout.to_dict)
+#   padding to a multiple of 8 bytes
+#
+# Records, each record_size bytes
+#   timestamp   float64  time.time() when the frame was received
+#   seq         uint64   frame sequence number, starting at 0
+#   data        num_pixels * 4 bytes of (brightness, r, g, b)
+#
+# Because records are fixed size, frame N is at
+# header_size + (N * record_size) and the number of frames follows from
+# the file size. A capture cut short by a crash is still readable.
+#
+
+import json
+import mmap
+import os
+import threading
+import time
+from struct import Struct
+import app_logger
+from led_frame import LEDFrame
+# NumPy is optional. When it is available it is used for bulk operations.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = app_logger.getAppLogger()
+
+capture_magic = b"LEDCAP01"
+header_struct = Struct("<8sIIIId")
+record_header_struct = Struct("<dQ")
+
+
+class CaptureWriter:
+    """
+    Appends frames to a capture file. Frames are queued by the socket
+    server threads and written in large batches by a writer thread, so
+    file I/O never holds up ingest.
+    """
+    def __init__(self, file_path, num_pixels, layout=None, batch_frames=256, flush_interval=0.5,
+                 max_pending=8192):
+        """
+        Constructor
+        :param file_path: Capture file to be created
+        :param num_pixels: Number of pixels in every frame
+        :param layout: The LED string's LEDLayout or None
+        :param batch_frames: Number of queued frames that triggers a write
+        :param flush_interval: Maximum time in seconds a frame waits to be written
+        :param max_pending: Frames queued beyond this number are dropped
+        (the disk is not keeping up)
+        """
+        self.file_path = file_path
+        self.num_pixels = num_pixels
+        self.record_size = record_header_struct.size + (num_pixels * LEDFrame.pixel_size)
+        self.batch_frames = batch_frames
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self._next_seq = 0
+        self._pending = []
+        self._closed = False
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+
+        self._file = open(file_path, "wb")
+        self._file.write(build_header(num_pixels, layout))
+        self._thread = threading.Thread(target=self._run, name="CaptureWriter")
+        self._thread.daemon = True
+        self._thread.start()
+        logger.info("Capturing frames to %s", file_path)
+
+    def write(self, frame):
+        """
+        Queue a frame to be written. Called by the socket server threads.
+        :param frame: A LEDFrame
+        :return: Returns False if the frame was dropped
+        """
+        with self._lock:
+            if self._closed or len(self._pending) >= self.max_pending:
+                self.frames_dropped += 1
+                return False
+            self._pending.append((frame.timestamp or time.time(), self._next_seq, frame.data))
+            self._next_seq += 1
+            if len(self._pending) >= self.batch_frames:
+                self._wakeup.notify()
+        return True
+
+    def write_many(self, frames):
+        """
+        Queue a batch of frames to be written
+        :param frames: A list of LEDFrame
+        :return: Returns the number of frames dropped
+        """
+        with self._lock:
+            room = 0 if self._closed else max(0, self.max_pending - len(self._pending))
+            for frame in frames[0:room]:
+                self._pending.append((frame.timestamp or time.time(), self._next_seq, frame.data))
+                self._next_seq += 1
+            dropped = max(0, len(frames) - room)
+            self.frames_dropped += dropped
+            if len(self._pending) >= self.batch_frames:
+                self._wakeup.notify()
+        return dropped
+
+    def _run(self):
+        """
+        Writer thread
+        """
+        while True:
+            with self._lock:
+                if not self._closed and len(self._pending) < self.batch_frames:
+                    self._wakeup.wait(self.flush_interval)
+                batch = self._pending
+                self._pending = []
+                closed = self._closed
+            if batch:
+                self._write_batch(batch)
+            if closed:
+                break
+
+    def _write_batch(self, batch):
+        records = []
+        for timestamp, seq, data in batch:
+            records.append(record_header_struct.pack(timestamp, seq))
+            records.append(data)
+        self._file.write(b"".join(records))
+        self._file.flush()
+        self.frames_written += len(batch)
+
+    def close(self):
+        """
+        Write any queued frames and close the file
+        :return: None
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._wakeup.notify()
+        self._thread.join()
+        self._file.close()
+        logger.info("Captured %d frames to %s (%d dropped)", self.frames_written, self.file_path,
+                    self.frames_dropped)
+
+    def stats(self):
+        return {
+            "file": self.file_path,
+            "frames_written": self.frames_written,
+            "frames_dropped": self.frames_dropped,
+            "pending": len(self._pending),
+        }
+
+
+def build_header(num_pixels, layout=None):
+    """
+    Build a capture file header
+    :param num_pixels:
+    :param layout: LEDLayout or None
+    :return: Returns the header bytes
+    """
+    layout_json = json.dumps(layout.to_dict() if layout else None).encode("utf-8")
+    header_size = header_struct.size + len(layout_json)
+    header_size += (8 - (header_size % 8)) % 8
+    record_size = record_header_struct.size + (num_pixels * LEDFrame.pixel_size)
+    header = header_struct.pack(capture_magic, header_size, num_pixels, record_size, len(layout_json), time.time())
+    header += layout_json
+    return header + bytes(header_size - len(header))
+
+
+class CaptureReader:
+    """
+    Random access to the frames in a capture file. The file is memory
+    mapped and frames are returned as views of the mapped data, so
+    opening even a very large capture is immediate.
+    """
+    def __init__(self, file_path):
+        """
+        Constructor
+        :param file_path: Capture file
+        """
+        self.file_path = file_path
+        self._file = open(file_path, "rb")
+        file_size = os.fstat(self._file.fileno()).st_size
+        if file_size < header_struct.size:
+            self._file.close()
+            raise ValueError("{0} is not a capture file".format(file_path))
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+
+        magic, self.header_size, self.num_pixels, self.record_size, layout_size, self.created = \
+            header_struct.unpack_from(self._mmap, 0)
+        if magic != capture_magic:
+            self.close()
+            raise ValueError("{0} is not a capture file".format(file_path))
+        self.layout = json.loads(bytes(self._mmap[header_struct.size:header_struct.size + layout_size]).decode("utf-8"))
+        self.frame_body_size = self.num_pixels * LEDFrame.pixel_size
+        # A partially written last record is ignored
+        self.frame_count = (file_size - self.header_size) // self.record_size
+
+    def __len__(self):
+        return self.frame_count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def record_offset(self, index):
+        if index < 0:
+            index += self.frame_count
+        if index < 0 or index >= self.frame_count:
+            raise IndexError("frame index out of range")
+        return self.header_size + (index * self.record_size)
+
+    def record(self, index):
+        """
+        Get a frame record without copying the pixel data
+        :param index: Frame number
+        :return: Returns a tuple (timestamp, seq, data) where data is a
+        memoryview of the pixel data
+        """
+        offset = self.record_offset(index)
+        timestamp, seq = record_header_struct.unpack_from(self._mmap, offset)
+        start = offset + record_header_struct.size
+        return timestamp, seq, self._view[start:start + self.frame_body_size]
+
+    def frame(self, index):
+        """
+        Get a frame
+        :param index: Frame number
+        :return: Returns a LEDFrame whose data is a view of the capture file
+        """
+        timestamp, seq, data = self.record(index)
+        return LEDFrame(data, timestamp=timestamp)
+
+    def __getitem__(self, index):
+        return self.frame(index)
+
+    def __iter__(self):
+        for index in range(self.frame_count):
+            yield self.frame(index)
+
+    def timestamp(self, index):
+        return record_header_struct.unpack_from(self._mmap, self.record_offset(index))[0]
+
+    def as_array(self):
+        """
+        View all records as a NumPy structured array without copying.
+        Requires NumPy.
+        :return: Returns an array with fields timestamp, seq and data, where
+        data has shape (num_pixels, 4)
+        """
+        if numpy is None:
+            raise RuntimeError("NumPy is not installed")
+        dtype = numpy.dtype([("timestamp", "<f8"), ("seq", "<u8"),
+                             ("data", numpy.uint8, (self.num_pixels, LEDFrame.pixel_size))])
+        return numpy.frombuffer(self._mmap, dtype=dtype, count=self.frame_count, offset=self.header_size)
+
+    def close(self):
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Frames returned by the reader are still in use
+                pass
+            self._mmap = None
+        self._file.close()
@@ -0,0 +1,371 @@
+#
+# frame_compare - golden frame regression checker
+# Copyright © 2019  Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Compares the frames of a capture file (see frame_capture.py) against a
+# golden capture. Frames are aligned by sequence (frame N against golden
+# frame N) or by time since the first frame. A pixel differs when any of
+# its (brightness, r, g, b) values differ by more than the tolerance. A
+# frame is a violation when more than max_pixels of its pixels differ.
+# With sequence alignment the captures must also have the same number
+# of frames; a length mismatch is a violation too.
+#
+#   python frame_compare.py golden.cap test.cap --tolerance 2 --report report.json
+#
+# The exit status is 0 when there are no violations and 1 otherwise, so
+# the tool can be used in CI. A live stream can be compared with the
+# compare frame sink (--sink compare --sink-file golden.cap).
+#
+
+import argparse
+import json
+import sys
+from bisect import bisect_right
+import app_logger
+from frame_capture import CaptureReader
+from frame_sinks import FrameSink
+from led_frame import LEDFrame, changed_pixels
+# NumPy is optional. When it is available it is used for bulk operations.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = app_logger.getAppLogger()
+
+# Alignment methods
+align_methods = ["seq", "time"]
+
+
+class ComparisonResult:
+    """
+    Accumulates the results of comparing frames against golden frames
+    """
+    # Largest number of differing frames listed in the report
+    max_listed_frames = 10000
+
+    def __init__(self, tolerance=0, max_pixels=0):
+        """
+        Constructor
+        :param tolerance: Largest allowed difference of a pixel value
+        :param max_pixels: Largest allowed number of differing pixels in a frame
+        """
+        self.tolerance = tolerance
+        self.max_pixels = max_pixels
+        self.frames_compared = 0
+        self.frames_different = 0
+        self.violations = 0
+        self.first_divergence = None
+        self.first_violation = None
+        self.worst_frame = None
+        self.max_delta = 0
+        # Number of frames in the capture (or stream) and the golden capture
+        self.frames = 0
+        self.golden_frames = 0
+        self.length_mismatch = False
+        # (index, golden index, differing pixels, max delta) of differing frames
+        self.different_frames = []
+
+    def add(self, index, golden_index, pixels_over, max_delta):
+        """
+        Add the result of comparing one frame
+        :param index: Frame number
+        :param golden_index: Golden frame number
+        :param pixels_over: Number of pixels that differ by more than the tolerance
+        :param max_delta: Largest difference of any pixel value
+        :return: None
+        """
+        self.frames_compared += 1
+        if max_delta > self.max_delta:
+            self.max_delta = max_delta
+        if not pixels_over:
+            return
+        self.frames_different += 1
+        if self.first_divergence is None:
+            self.first_divergence = [index, golden_index]
+        if self.worst_frame is None or pixels_over > self.worst_frame[2]:
+            self.worst_frame = [index, golden_index, pixels_over, max_delta]
+        if pixels_over > self.max_pixels:
+            self.violations += 1
+            if self.first_violation is None:
+                self.first_violation = [index, golden_index]
+        if len(self.different_frames) < ComparisonResult.max_listed_frames:
+            self.different_frames.append([index, golden_index, pixels_over, max_delta])
+
+    def add_many(self, indexes, golden_indexes, pixels_over, max_deltas):
+        """
+        Add the results of comparing a block of frames. Only the frames
+        that differ are looked at one by one.
+        :param indexes: NumPy array of frame numbers
+        :param golden_indexes: NumPy array of golden frame numbers
+        :param pixels_over: NumPy array of differing pixel counts
+        :param max_deltas: NumPy array of largest differences
+        :return: None
+        """
+        different = numpy.flatnonzero(pixels_over)
+        self.frames_compared += len(indexes) - len(different)
+        if len(max_deltas):
+            self.max_delta = max(self.max_delta, int(max_deltas.max()))
+        for i in different.tolist():
+            self.add(int(indexes[i]), int(golden_indexes[i]), int(pixels_over[i]), int(max_deltas[i]))
+
+    def set_lengths(self, frames, golden_frames, check=True):
+        """
+        Record the number of frames on each side
+        :param frames: Number of frames checked
+        :param golden_frames: Number of golden frames
+        :param check: True if the numbers must match (sequence alignment)
+        :return: None
+        """
+        self.frames = frames
+        self.golden_frames = golden_frames
+        self.length_mismatch = check and frames != golden_frames
+        if self.length_mismatch:
+            # The frames without a counterpart were not compared
+            self.violations += 1
+            logger.error("Frame count %d does not match golden frame count %d", frames, golden_frames)
+
+    def passed(self):
+        return self.violations == 0
+
+    def to_dict(self):
+        return {
+            "tolerance": self.tolerance,
+            "max_pixels": self.max_pixels,
+            "frames_compared": self.frames_compared,
+            "frames_different": self.frames_different,
+            "violations": self.violations,
+            "first_divergence": self.first_divergence,
+            "first_violation": self.first_violation,
+            "worst_frame": self.worst_frame,
+            "max_delta": self.max_delta,
+            "frames": self.frames,
+            "golden_frames": self.golden_frames,
+            "length_mismatch": self.length_mismatch,
+            "passed": self.passed(),
+            "different_frames": self.different_frames,
+        }
+
+
+def compare_data(data, golden, tolerance=0):
+    """
+    Compare the pixel data of one frame against a golden frame
+    :param data: bytes-like pixel data, 4 bytes per pixel
+    :param golden: bytes-like golden pixel data of the same length
+    :param tolerance: Largest allowed difference of a pixel value
+    :return: Returns a tuple (pixels_over, max_delta)
+    """
+    # Comparing bytes is much faster than comparing memoryviews
+    data = bytes(data)
+    golden = bytes(golden)
+    if data == golden:
+        return 0, 0
+    pixels_over = 0
+    max_delta = 0
+    for i in changed_pixels(data, golden):
+        o = i * LEDFrame.pixel_size
+        delta = max([abs(a - b) for a, b in zip(data[o:o + 4], golden[o:o + 4])])
+        if delta > tolerance:
+            pixels_over += 1
+        if delta > max_delta:
+            max_delta = delta
+    return pixels_over, max_delta
+
+
+def compare_blocks(data, golden, tolerance=0):
+    """
+    Compare blocks of frames. Requires NumPy.
+    :param data: (frames, pixels, 4) uint8 array
+    :param golden: (frames, pixels, 4) uint8 array
+    :param tolerance: Largest allowed difference of a pixel value
+    :return: Returns a tuple of arrays (pixels_over, max_delta), one entry per frame
+    """
+    pixels_over = numpy.zeros(len(data), dtype=numpy.int64)
+    max_delta = numpy.zeros(len(data), dtype=numpy.int64)
+    # Most frames usually match, so only the frames that differ are
+    # examined pixel by pixel
+    different = numpy.flatnonzero((data != golden).any(axis=(1, 2)))
+    if len(different):
+        delta = numpy.abs(data[different].astype(numpy.int16) - golden[different].astype(numpy.int16)).max(axis=2)
+        pixels_over[different] = (delta > tolerance).sum(axis=1)
+        max_delta[different] = delta.max(axis=1)
+    return pixels_over, max_delta
+
+
+def align_frames(timestamps, golden_timestamps):
+    """
+    Find the golden frame showing at the time of each frame. Times are
+    relative to the first frame of each capture.
+    :param timestamps: Frame timestamps (list or NumPy array)
+    :param golden_timestamps: Golden frame timestamps
+    :return: Returns a golden frame number for each frame
+    """
+    if numpy is not None:
+        times = numpy.asarray(timestamps) - timestamps[0]
+        golden_times = numpy.asarray(golden_timestamps) - golden_timestamps[0]
+        return numpy.maximum(numpy.searchsorted(golden_times, times, side="right") - 1, 0)
+    golden_times = [t - golden_timestamps[0] for t in golden_timestamps]
+    return [max(bisect_right(golden_times, t - timestamps[0]) - 1, 0) for t in timestamps]
+
+
+def compare_captures(test, golden, align="seq", tolerance=0, max_pixels=0, block_bytes=16 * 1024 * 1024):
+    """
+    Compare a capture against a golden capture
+    :param test: CaptureReader
+    :param golden: CaptureReader
+    :param align: seq or time
+    :param tolerance: Largest allowed difference of a pixel value
+    :param max_pixels: Largest allowed number of differing pixels in a frame
+    :param block_bytes: Approximate amount of pixel data compared at a time
+    :return: Returns a ComparisonResult
+    """
+    if test.num_pixels != golden.num_pixels:
+        raise ValueError("Captures have different pixel counts ({0} and {1})".format(
+            test.num_pixels, golden.num_pixels))
+    result = ComparisonResult(tolerance=tolerance, max_pixels=max_pixels)
+    result.set_lengths(len(test), len(golden), check=(align == "seq"))
+    if not len(test) or not len(golden):
+        return result
+
+    if numpy is not None:
+        test_records = test.as_array()
+        golden_records = golden.as_array()
+        if align == "time":
+            golden_indexes = align_frames(test_records["timestamp"], golden_records["timestamp"])
+            count = len(test)
+        else:
+            count = min(len(test), len(golden))
+            golden_indexes = numpy.arange(count)
+        block_frames = max(1, block_bytes // max(1, test.frame_body_size))
+        for start in range(0, count, block_frames):
+            end = min(start + block_frames, count)
+            indexes = numpy.arange(start, end)
+            pixels_over, max_deltas = compare_blocks(test_records["data"][start:end],
+                                                     golden_records["data"][golden_indexes[start:end]],
+                                                     tolerance)
+            result.add_many(indexes, golden_indexes[start:end], pixels_over, max_deltas)
+        return result
+
+    if align == "time":
+        golden_indexes = align_frames([test.timestamp(i) for i in range(len(test))],
+                                      [golden.timestamp(i) for i in range(len(golden))])
+    else:
+        golden_indexes = list(range(min(len(test), len(golden))))
+    for index, golden_index in enumerate(golden_indexes):
+        pixels_over, max_delta = compare_data(test.record(index)[2], golden.record(golden_index)[2], tolerance)
+        result.add(index, golden_index, pixels_over, max_delta)
+    return result
+
+
+class CompareFrameSink(FrameSink):
+    """
+    Compares a live stream of frames against a golden capture
+    """
+    def __init__(self, golden_path, align="seq", tolerance=0, max_pixels=0, report_file=""):
+        """
+        Constructor
+        :param golden_path: Golden capture file
+        :param align: seq or time
+        :param tolerance: Largest allowed difference of a pixel value
+        :param max_pixels: Largest allowed number of differing pixels in a frame
+        :param report_file: Optional JSON report written when the sink is closed
+        """
+        super(CompareFrameSink, self).__init__()
+        self.golden_path = golden_path
+        self.align = align
+        self.report_file = report_file
+        self.result = ComparisonResult(tolerance=tolerance, max_pixels=max_pixels)
+        self.golden = None
+        self.golden_times = None
+        self.golden_frames = 0
+        self.first_timestamp = None
+
+    def open(self):
+        self.golden = CaptureReader(self.golden_path)
+        self.golden_frames = len(self.golden)
+        if self.align == "time":
+            first = self.golden.timestamp(0) if len(self.golden) else 0.0
+            self.golden_times = [self.golden.timestamp(i) - first for i in range(len(self.golden))]
+        logger.info("Comparing frames against %s", self.golden_path)
+
+    def write_frame(self, frame):
+        index = self.frame_count
+        super(CompareFrameSink, self).write_frame(frame)
+        if not len(self.golden):
+            return
+        if self.align == "time":
+            if self.first_timestamp is None:
+                self.first_timestamp = frame.timestamp
+            golden_index = max(bisect_right(self.golden_times, frame.timestamp - self.first_timestamp) - 1, 0)
+        elif index < len(self.golden):
+            golden_index = index
+        else:
+            # Past the end of the golden capture
+            return
+        pixels_over, max_delta = compare_data(frame.data, self.golden.record(golden_index)[2],
+                                              self.result.tolerance)
+        self.result.add(index, golden_index, pixels_over, max_delta)
+
+    def close(self):
+        if self.golden:
+            self.golden.close()
+            self.golden = None
+        result = self.result
+        result.set_lengths(self.frame_count, self.golden_frames, check=(self.align == "seq"))
+        logger.info("Compared %d frames: %d different, %d violations, first divergence %s",
+                    result.frames_compared, result.frames_different, result.violations,
+                    str(result.first_divergence))
+        if self.report_file:
+            with open(self.report_file, "w") as report:
+                json.dump(result.to_dict(), report, indent=2)
+
+    def passed(self):
+        return self.result.passed()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare a LED Emulator capture against a golden capture")
+    parser.add_argument("golden", help="Golden capture file")
+    parser.add_argument("capture", help="Capture file to be checked")
+    parser.add_argument("--align", choices=align_methods, default="seq",
+                        help="Align frames by sequence or by time")
+    parser.add_argument("--tolerance", type=int, default=0, help="Largest allowed difference of a pixel value")
+    parser.add_argument("--max-pixels", dest="max_pixels", type=int, default=0,
+                        help="Largest allowed number of differing pixels in a frame")
+    parser.add_argument("--report", default="", help="JSON report file")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    with CaptureReader(args.golden) as golden, CaptureReader(args.capture) as test:
+        result = compare_captures(test, golden, align=args.align, tolerance=args.tolerance,
+                                  max_pixels=args.max_pixels)
+        summary = result.to_dict()
+    if args.report:
+        with open(args.report, "w") as report:
+            json.dump(summary, report, indent=2)
+    del summary["different_frames"]
+    print(json.dumps(summary, indent=2))
+    return 0 if result.passed() else 1
+
+
+#
+# Run as an application
+#
+if __name__ == "__main__":
+    sys.exit(main())
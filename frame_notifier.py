@@ -0,0 +1,79 @@
+#
+# Frame arrival notification
+# Copyright © 2019  Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+
+
+class FrameNotifier:
+    """
+    Wakes up an event loop when frames arrive. The socket server threads
+    call notify() after queueing a frame. The event loop watches fileno()
+    for readability (e.g. with Tk's createfilehandler) and calls drain()
+    before taking frames from the queues.
+
+    This is the self-pipe technique. Notifications are coalesced: at most
+    one byte is in the pipe no matter how many frames arrive before the
+    event loop gets around to draining it.
+    """
+    def __init__(self):
+        self._read_fd, self._write_fd = os.pipe()
+        os.set_blocking(self._read_fd, False)
+        os.set_blocking(self._write_fd, False)
+        # True while a byte is in the pipe
+        self._pending = False
+        self.notifications = 0
+
+    def fileno(self):
+        """
+        :return: Returns the file descriptor that becomes readable on notify
+        """
+        return self._read_fd
+
+    def notify(self):
+        """
+        Signal that a frame has arrived. Safe to call from any thread.
+        :return: None
+        """
+        if self._pending:
+            return
+        self._pending = True
+        self.notifications += 1
+        try:
+            os.write(self._write_fd, b"\x00")
+        except (BlockingIOError, OSError):
+            # The pipe is full (or closed), so a wakeup is already due
+            pass
+
+    def drain(self):
+        """
+        Clear pending notifications. Call this before taking frames so a
+        frame that arrives while they are being taken causes a new wakeup.
+        :return: None
+        """
+        self._pending = False
+        try:
+            while os.read(self._read_fd, 4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def close(self):
+        for fd in (self._read_fd, self._write_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
@@ -0,0 +1,205 @@
+#
+# LED data frame queue
+# Copyright © 2019  Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from threading import Lock, Condition
+
+
+class FrameRingBuffer:
+    """
+    A fixed capacity FIFO of LED data frames shared by the socket
+    server threads (producers) and the LED window (consumer).
+
+    Every frame put into the buffer is assigned a sequence number. The
+    frame is stored in slot (sequence % capacity) of a preallocated list.
+    What happens when a frame arrives and the buffer is full depends on
+    the drop policy.
+        drop-oldest - the oldest queued frame is discarded
+        latest-only - every queued frame is discarded, so at most one
+                      frame (the newest) is ever queued
+        block - the producer waits until the consumer makes room
+    """
+
+    DROP_OLDEST = "drop-oldest"
+    LATEST_ONLY = "latest-only"
+    BLOCK = "block"
+    policies = [DROP_OLDEST, LATEST_ONLY, BLOCK]
+
+    def __init__(self, capacity=64, policy=DROP_OLDEST, on_drop=None):
+        """
+        Constructor
+        :param capacity: Maximum number of queued frames
+        :param policy: One of the drop policies
+        :param on_drop: Optional callable that is passed the number
+        of frames each time frames are dropped.
+        """
+        if capacity < 1:
+            raise ValueError("Frame queue capacity must be at least 1")
+        if policy not in FrameRingBuffer.policies:
+            raise ValueError("Unrecognized frame queue policy: {0}".format(policy))
+        self.capacity = capacity
+        self.policy = policy
+        self.on_drop = on_drop
+        self._slots = [None] * capacity
+        # Sequence number of the oldest queued frame
+        self._head_seq = 0
+        # Sequence number that will be assigned to the next frame
+        self._tail_seq = 0
+        self._closed = False
+        self._lock = Lock()
+        self._not_full = Condition(self._lock)
+        self._not_empty = Condition(self._lock)
+        # Number of frames dropped by each policy
+        self._dropped = {policy_name: 0 for policy_name in FrameRingBuffer.policies}
+
+    def __len__(self):
+        with self._lock:
+            return self._tail_seq - self._head_seq
+
+    def _discard(self, count):
+        # Discard the oldest count frames. Caller holds the lock.
+        for seq in range(self._head_seq, self._head_seq + count):
+            self._slots[seq % self.capacity] = None
+        self._head_seq += count
+        self._dropped[self.policy] += count
+        if self.on_drop and count:
+            self.on_drop(count)
+
+    def put(self, frame):
+        """
+        Queue a frame according to the drop policy
+        :param frame: The LED data frame
+        :return: Returns the sequence number assigned to the frame or
+        None if the buffer was closed while waiting for room.
+        """
+        with self._lock:
+            if self.policy == FrameRingBuffer.LATEST_ONLY:
+                self._discard(self._tail_seq - self._head_seq)
+            elif (self._tail_seq - self._head_seq) >= self.capacity:
+                if self.policy == FrameRingBuffer.DROP_OLDEST:
+                    self._discard(1)
+                else:
+                    while (self._tail_seq - self._head_seq) >= self.capacity and not self._closed:
+                        self._not_full.wait()
+                    if self._closed:
+                        return None
+
+            seq = self._tail_seq
+            self._slots[seq % self.capacity] = frame
+            self._tail_seq += 1
+            self._not_empty.notify()
+            return seq
+
+    def put_many(self, frames):
+        """
+        Queue a batch of frames according to the drop policy. The lock
+        is taken once for the whole batch (unless the policy is block and
+        the buffer fills up).
+        :param frames: A list of LED data frames, oldest first
+        :return: Returns the number of frames queued. Under the drop
+        policies every frame counts as queued even if it was immediately
+        dropped to make room for a newer one.
+        """
+        count = len(frames)
+        if not count:
+            return 0
+        with self._lock:
+            if self.policy == FrameRingBuffer.LATEST_ONLY:
+                # Only the newest frame of the batch survives
+                self._discard(self._tail_seq - self._head_seq)
+                self._dropped[self.policy] += count - 1
+                if self.on_drop and count > 1:
+                    self.on_drop(count - 1)
+                frames = frames[-1:]
+            elif self.policy == FrameRingBuffer.DROP_OLDEST:
+                if count > self.capacity:
+                    # The oldest frames of the batch would be dropped right away
+                    self._dropped[self.policy] += count - self.capacity
+                    if self.on_drop:
+                        self.on_drop(count - self.capacity)
+                    frames = frames[count - self.capacity:]
+                excess = (self._tail_seq - self._head_seq) + len(frames) - self.capacity
+                if excess > 0:
+                    self._discard(excess)
+
+            queued = 0
+            for frame in frames:
+                if self.policy == FrameRingBuffer.BLOCK:
+                    while (self._tail_seq - self._head_seq) >= self.capacity and not self._closed:
+                        self._not_empty.notify()
+                        self._not_full.wait()
+                    if self._closed:
+                        return queued
+                self._slots[self._tail_seq % self.capacity] = frame
+                self._tail_seq += 1
+                queued += 1
+            self._not_empty.notify()
+            return count if self.policy != FrameRingBuffer.BLOCK else queued
+
+    def get(self, timeout=None):
+        """
+        Remove and return the oldest queued frame
+        :param timeout: If not None, the maximum time in seconds
+        to wait for a frame to arrive.
+        :return: Returns the frame or None
+        """
+        with self._lock:
+            if timeout and self._tail_seq == self._head_seq and not self._closed:
+                self._not_empty.wait(timeout)
+            if self._tail_seq == self._head_seq:
+                return None
+            slot = self._head_seq % self.capacity
+            frame = self._slots[slot]
+            self._slots[slot] = None
+            self._head_seq += 1
+            self._not_full.notify()
+            return frame
+
+    def get_latest(self):
+        """
+        Remove every queued frame and return the newest one
+        :return: Returns a tuple (frame, skipped) where skipped is the number
+        of older frames that were discarded. The frame is None if the
+        buffer is empty.
+        """
+        with self._lock:
+            queued = self._tail_seq - self._head_seq
+            if queued == 0:
+                return None, 0
+            frame = self._slots[(self._tail_seq - 1) % self.capacity]
+            for seq in range(self._head_seq, self._tail_seq):
+                self._slots[seq % self.capacity] = None
+            self._head_seq = self._tail_seq
+            self._not_full.notify_all()
+            return frame, queued - 1
+
+    def dropped(self):
+        """
+        Number of frames dropped by each policy
+        :return: Returns a dict of policy name: count
+        """
+        with self._lock:
+            return dict(self._dropped)
+
+    def close(self):
+        """
+        Release any waiting producers or consumers. Used at shutdown.
+        :return: None
+        """
+        with self._lock:
+            self._closed = True
+            self._not_full.notify_all()
+            self._not_empty.notify_all()
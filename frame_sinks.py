@@ -0,0 +1,147 @@
+#
+# LED Emulator frame sinks - headless consumers of LED data frames
+# Copyright © 2019  Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import app_logger
+
+logger = app_logger.getAppLogger()
+
+
+class FrameSink:
+    """
+    Base class for a frame sink. A frame sink takes the place of the
+    LED window when the emulator runs headless. It receives every LED data
+    frame that is taken from the LEDConnectionHandler frame queue.
+    """
+    def __init__(self):
+        self.frame_count = 0
+
+    def open(self):
+        """
+        Called once before the first frame is written
+        :return: None
+        """
+        pass
+
+    def write_frame(self, frame):
+        """
+        Consume one LED data frame
+        :param frame: A LEDFrame
+        :return: None
+        """
+        self.frame_count += 1
+
+    def close(self):
+        """
+        Called once after the last frame is written
+        :return: None
+        """
+        pass
+
+    def passed(self):
+        """
+        :return: Returns False if the sink found a problem with the frames
+        """
+        return True
+
+
+class NullFrameSink(FrameSink):
+    """
+    Discards all frames. Useful for measuring ingest speed.
+    """
+    pass
+
+
+class LastFrameSink(FrameSink):
+    """
+    Keeps the most recent frame in memory
+    """
+    def __init__(self):
+        super(LastFrameSink, self).__init__()
+        self.last_frame = None
+
+    def write_frame(self, frame):
+        super(LastFrameSink, self).write_frame(frame)
+        self.last_frame = frame
+
+
+class FileRecorderSink(FrameSink):
+    """
+    Records frames to a file. Each frame is written as (n * 4) bytes of
+    (brightness, r, g, b) data where n is the number of pixels.
+    """
+    def __init__(self, file_path):
+        super(FileRecorderSink, self).__init__()
+        self.file_path = file_path
+        self._file = None
+
+    def open(self):
+        self._file = open(self.file_path, "wb")
+        logger.info("Recording frames to %s", self.file_path)
+
+    def write_frame(self, frame):
+        super(FileRecorderSink, self).write_frame(frame)
+        self._file.write(frame.data)
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+        logger.info("Recorded %d frames to %s", self.frame_count, self.file_path)
+
+
+# Sink names as they appear in the configuration file or on the command line
+sink_names = ["null", "last", "file", "compare"]
+
+
+def string_sink_file(sink_file, string_name):
+    """
+    Derive a per string sink file name when several strings are emulated
+    :param sink_file: Configured sink file, e.g. frames.bin
+    :param string_name: LED string name, e.g. porch
+    :return: Returns a file name like frames-porch.bin
+    """
+    root, ext = os.path.splitext(sink_file)
+    safe_name = "".join([c if c.isalnum() else "_" for c in string_name])
+    return "{0}-{1}{2}".format(root, safe_name, ext)
+
+
+def create_frame_sink(sink_name, sink_file="", compare_options=None):
+    """
+    Create a frame sink by name
+    :param sink_name: One of the names in sink_names
+    :param sink_file: Output file for the file sink or golden capture
+    file for the compare sink
+    :param compare_options: Keyword arguments for the compare sink
+    (align, tolerance, max_pixels, report_file)
+    :return: Returns a FrameSink instance
+    """
+    if sink_name == "null":
+        return NullFrameSink()
+    if sink_name == "last":
+        return LastFrameSink()
+    if sink_name == "file":
+        if not sink_file:
+            raise ValueError("The file sink requires a sink file")
+        return FileRecorderSink(sink_file)
+    if sink_name == "compare":
+        # The sink file is the golden capture
+        if not sink_file:
+            raise ValueError("The compare sink requires a golden capture file")
+        from frame_compare import CompareFrameSink
+        return CompareFrameSink(sink_file, **(compare_options or {}))
+    raise ValueError("Unrecognized frame sink: {0}".format(sink_name))
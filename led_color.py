@@ -0,0 +1,119 @@
+#
+# LED color pipeline
+# Copyright © 2019  Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Converts frames as they arrive from a client into the colors a real
+# APA102 strip would show.
+#   color order - the order of the color bytes on the wire (rgb, grb, bgr, ...)
+#   brightness - the 5 bit global brightness in the low bits of each pixel's first byte
+#   gamma - the gamma of the display showing the emulated lights
+#
+# Every combination of brightness level and color value is looked up in
+# tables built by the constructor. When all pixels have the same
+# brightness (the usual case) a whole color channel is converted with a
+# single bytes.translate() call.
+#
+
+from led_frame import LEDFrame
+# NumPy is optional. When it is available it is used for bulk operations.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class ColorPipeline:
+    """
+    Frame color conversion for display
+    """
+    # Brightness levels are 0-31
+    max_level = 31
+
+    def __init__(self, apply_brightness=False, gamma=1.0, color_order="rgb"):
+        """
+        Constructor
+        :param apply_brightness: Scale colors by the APA102 brightness level
+        :param gamma: Display gamma. 1.0 leaves colors linear.
+        :param color_order: Order of the color bytes on the wire, e.g. grb
+        """
+        color_order = color_order.lower()
+        if sorted(color_order) != ["b", "g", "r"]:
+            raise ValueError("Invalid color order: {0}".format(color_order))
+        if gamma <= 0:
+            raise ValueError("Invalid gamma: {0}".format(gamma))
+        self.apply_brightness = apply_brightness
+        self.gamma = gamma
+        self.color_order = color_order
+        # Offset within a pixel of the red, green and blue bytes
+        self.channel_offsets = [color_order.index(c) + 1 for c in "rgb"]
+
+        # One translate table per brightness level
+        self.level_tables = []
+        for level in range(ColorPipeline.max_level + 1):
+            scale = (level / float(ColorPipeline.max_level)) if apply_brightness else 1.0
+            self.level_tables.append(bytes([self._convert(v, scale) for v in range(256)]))
+        self.identity_table = bytes(range(256))
+        if numpy is not None:
+            self.level_array = numpy.frombuffer(b"".join(self.level_tables), dtype=numpy.uint8).reshape(
+                ColorPipeline.max_level + 1, 256)
+
+    def _convert(self, value, scale):
+        linear = (value / 255.0) * scale
+        return int(round(255.0 * (linear ** (1.0 / self.gamma))))
+
+    def is_identity(self):
+        """
+        :return: Returns True if the pipeline never changes a frame
+        """
+        return (not self.apply_brightness and self.gamma == 1.0 and self.color_order == "rgb")
+
+    def apply(self, frame):
+        """
+        Convert a frame's pixel data for display
+        :param frame: LED data frame as received
+        :return: Returns a LEDFrame holding (brightness, r, g, b) display
+        colors. The brightness byte is passed through.
+        """
+        if self.is_identity():
+            return frame
+        data = bytes(frame.data)
+        num_pixels = frame.num_pixels
+        if not num_pixels:
+            return frame
+        out = bytearray(len(data))
+        brightness = data[0::4]
+        out[0::4] = brightness
+
+        if not self.apply_brightness or brightness.count(brightness[0:1]) == num_pixels:
+            # All pixels are at the same brightness level (or it is ignored)
+            table = self.level_tables[brightness[0] & ColorPipeline.max_level]
+            for i, offset in enumerate(self.channel_offsets):
+                channel = data[offset::4]
+                out[i + 1::4] = channel if table == self.identity_table else channel.translate(table)
+        elif numpy is not None:
+            pixels = numpy.frombuffer(data, dtype=numpy.uint8).reshape(num_pixels, LEDFrame.pixel_size)
+            levels = pixels[:, 0] & ColorPipeline.max_level
+            out_pixels = numpy.frombuffer(out, dtype=numpy.uint8).reshape(num_pixels, LEDFrame.pixel_size)
+            for i, offset in enumerate(self.channel_offsets):
+                out_pixels[:, i + 1] = self.level_array[levels, pixels[:, offset]]
+        else:
+            # Mixed brightness levels without NumPy: one lookup per byte
+            tables = [self.level_tables[b & ColorPipeline.max_level] for b in brightness]
+            for i, offset in enumerate(self.channel_offsets):
+                out[i + 1::4] = bytes([t[v] for t, v in zip(tables, data[offset::4])])
+
+        return LEDFrame(bytes(out), timestamp=frame.timestamp)
@@ -15,10 +15,12 @@
 # along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import time
 import app_logger
-from configuration import Configuration
 # import engine.led_engine
-from threading import Lock
+from led_frame import LEDFrame
+from led_stats import LEDStats
+from led_string import LEDStrings
 
 logger = app_logger.getAppLogger()
 
@@ -33,10 +35,13 @@ class LEDConnectionHandler:
     Each transmission is (n * 4) + 8 bytes in length where n is the
     number of LEDs in the string. The 8 bytes comes from a 4 byte
     header and a 4 byte trailer.
-    """
 
-    frame_list = []
-    frame_lock = Lock()
+    A client may also send several frames in one batch message (see
+    TCPRequestHandler). Those are passed to execute_batch.
+
+    The emulator can host several LED strings (see LEDStrings). The port
+    a connection arrives on determines which string its frames go to.
+    """
 
     def __init__(self):
         """
@@ -47,49 +52,128 @@ class LEDConnectionHandler:
         """
         # There are 4 bytes for each pixel
         self.frame_pixel_size = 4
-        self.num_pixels = Configuration.num_pixels()
-        self.frame_body_size = self.num_pixels * self.frame_pixel_size
         self.frame_start = self.frame_pixel_size # starts after the header
-        self.frame_end = self.frame_start + self.frame_body_size
+        # The LED string this connection is sending to
+        self.led_string = None
+        # Injected by the socket server (see LEDStats.ConnectionStats)
+        self.connection_stats = None
 
     def execute_command(self, port, led_data):
         """
         Execute a client command/request.
-        :param port: The port number receiving the request. It can be used
-        to qualify or descriminate the request. The idea is to be able to
-        map a port number to a device.
+        :param port: The port number receiving the request. It is used
+        to map the request to a LED string.
         :param led_data: The LED data sent by the client.
         :return: None
         """
-        # print("Frame received:", len(led_data))
-        # Let's reformat the frame into something that the LED window can readily use
-        pixels = []
-        for fx in range(self.frame_start, self.frame_end, self.frame_pixel_size):
-            # brightness, r, g, b
-            pixels.append((led_data[fx], led_data[fx + 1], led_data[fx + 2], led_data[fx + 3]))
+        led_string = self.led_string_for_port(port)
 
-        LEDConnectionHandler.frame_lock.acquire()
+        # print("Frame received:", len(led_data))
+        # The frame body is kept as is, 4 bytes per pixel (brightness, r, g, b).
+        # The LED data is only valid until the next frame is received,
+        # so this is the one and only copy of the frame body.
+        frame_end = self.frame_start + led_string.frame_body_size
+        frame = LEDFrame(bytes(led_data[self.frame_start:frame_end]), timestamp=time.time())
+
+        # Capture every frame received, including those the queue drops
+        recorder = led_string.recorder
+        if recorder:
+            recorder.write(frame)
+
+        # In an ingest worker process the frame goes to the render process
+        if led_string.shared_buffer:
+            led_string.shared_buffer.write(frame.data, frame.timestamp)
+            LEDStats.count("frames_queued")
+            if self.connection_stats:
+                self.connection_stats.frames_queued += 1
+            return None
+
+        if led_string.frame_queue.put(frame) is not None:
+            LEDStats.count("frames_queued")
+            if self.connection_stats:
+                self.connection_stats.frames_queued += 1
+            # Wake up the display
+            if led_string.notifier:
+                led_string.notifier.notify()
 
-        LEDConnectionHandler.frame_list.append(pixels)
+        return None
 
-        LEDConnectionHandler.frame_lock.release()
+    def execute_batch(self, port, led_data, frame_count, timestamps=None):
+        """
+        Execute a batch of frames sent in one message.
+        :param port: The port number receiving the request.
+        :param led_data: frame_count complete LED data frames, back to back.
+        Only valid until the next message is received.
+        :param frame_count: Number of frames in led_data
+        :param timestamps: Optional client timestamps (seconds), one per frame.
+        They are used to keep the spacing between the frames of a batch.
+        :return: None
+        """
+        led_string = self.led_string_for_port(port)
+        frame_size = led_string.frame_size
+        body_size = led_string.frame_body_size
+        now = time.time()
+        frames = []
+        for i in range(frame_count):
+            start = (i * frame_size) + self.frame_start
+            # Client times are mapped onto our clock, the last frame being received now
+            timestamp = now - (timestamps[-1] - timestamps[i]) if timestamps else now
+            frames.append(LEDFrame(bytes(led_data[start:start + body_size]), timestamp=timestamp))
+
+        recorder = led_string.recorder
+        if recorder:
+            recorder.write_many(frames)
+
+        # Only the newest frame of the batch can be seen by the render process
+        if led_string.shared_buffer and frames:
+            led_string.shared_buffer.write(frames[-1].data, frames[-1].timestamp, frames=len(frames))
+            LEDStats.count("frames_queued", len(frames))
+            if self.connection_stats:
+                self.connection_stats.frames_queued += len(frames)
+            return None
+
+        # The whole batch is queued with one lock acquisition
+        queued = led_string.frame_queue.put_many(frames)
+        if queued:
+            LEDStats.count("frames_queued", queued)
+            if self.connection_stats:
+                self.connection_stats.frames_queued += queued
+            if led_string.notifier:
+                led_string.notifier.notify()
 
         return None
 
+    def led_string_for_port(self, port):
+        """
+        :param port: Port number of the connection
+        :return: Returns the LED string the connection sends to
+        """
+        if self.led_string is None or self.led_string.port != port:
+            self.led_string = LEDStrings.for_port(port)
+        return self.led_string
+
     @classmethod
-    def get_frame(cls):
+    def get_frame(cls, timeout=None, led_string=None):
         """
-        Gets the next available LED data frame. The frame is a list of 4-tuples,
-        where each tuple is (brightness, r, g, b).
+        Gets the oldest available LED data frame. The frame is a LEDFrame
+        which can be indexed like a list of (brightness, r, g, b) 4-tuples.
+        :param timeout: If not None, the maximum time in seconds to wait
+        for a frame to arrive.
+        :param led_string: The LED string. Defaults to the first string.
         :return: Returns the frame or None
         """
-        frame = None
-
-        LEDConnectionHandler.frame_lock.acquire()
-
-        if len(cls.frame_list):
-            frame = cls.frame_list.pop()
+        if led_string is None:
+            led_string = LEDStrings.default()
+        return led_string.get_frame(timeout=timeout)
 
-        LEDConnectionHandler.frame_lock.release()
-
-        return frame
+    @classmethod
+    def get_latest_frame(cls, led_string=None):
+        """
+        Gets the newest available LED data frame, discarding any older ones.
+        :param led_string: The LED string. Defaults to the first string.
+        :return: Returns a tuple (frame, skipped). The frame is None if
+        no frame is available.
+        """
+        if led_string is None:
+            led_string = LEDStrings.default()
+        return led_string.get_latest_frame()
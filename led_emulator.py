@@ -21,14 +21,61 @@ import os
 import time
 import sys
 import json
-from ledsocketserver import SocketServerThread
+import argparse
+from ledsocketserver import StatsServerThread
+from ledsocketserver import WebViewerServerThread
 # import configuration
 import app_logger
 # import app_trace # in athomeutils package
 import disclaimer.disclaimer
 from configuration import Configuration
-from led_connection_handler import LEDConnectionHandler
-from led_window import run_led_window
+from led_ingest import create_string_servers, group_strings, IngestProcess
+from led_string import LEDStrings
+from led_stats import LEDStats
+from frame_sinks import sink_names, create_frame_sink, string_sink_file
+# Note that led_window (and hence tkinter) is only imported when the
+# emulator is not running headless
+
+
+#
+# Command line arguments override the configuration file
+#
+def parse_args():
+    parser = argparse.ArgumentParser(description="LED string emulator for AtHomeLED")
+    parser.add_argument("--headless", action="store_true", default=None,
+                        help="Run without the LED window, draining frames into a frame sink")
+    parser.add_argument("--sink", choices=sink_names,
+                        help="Frame sink used when running headless")
+    parser.add_argument("--sink-file", dest="sink_file",
+                        help="Output file for the file frame sink")
+    parser.add_argument("--capture", dest="capture_file",
+                        help="Capture every frame received to a capture file")
+    parser.add_argument("--compare-align", dest="compare_align", choices=["seq", "time"],
+                        help="Compare sink: align frames by sequence or by time")
+    parser.add_argument("--compare-tolerance", dest="compare_tolerance", type=int,
+                        help="Compare sink: largest allowed difference of a pixel value")
+    parser.add_argument("--compare-max-pixels", dest="compare_max_pixels", type=int,
+                        help="Compare sink: largest allowed number of differing pixels in a frame")
+    parser.add_argument("--compare-report", dest="compare_report",
+                        help="Compare sink: JSON report file")
+    return parser.parse_args()
+
+
+def compare_options(string_name=None):
+    """
+    Compare sink options from the configuration
+    :param string_name: LED string name when several strings are emulated
+    :return: Returns a dict of CompareFrameSink keyword arguments
+    """
+    report_file = Configuration.compare_report()
+    if report_file and string_name:
+        report_file = string_sink_file(report_file, string_name)
+    return {
+        "align": Configuration.compare_align(),
+        "tolerance": Configuration.compare_tolerance(),
+        "max_pixels": Configuration.compare_max_pixels(),
+        "report_file": report_file,
+    }
 
 
 #
@@ -49,6 +96,11 @@ def main():
         terminate_service = True
         sys.exit(0)
 
+    # Write statistics to the stats file on demand
+    def stats_handler(signum, frame):
+        LEDStats.dump(Configuration.stats_file())
+        logger.info("Statistics written to %s", Configuration.stats_file())
+
     # Orderly clean up of the LED emulator
     def CleanUp():
         logger.info("LEDEmulator shutdown complete")
@@ -63,6 +115,24 @@ def main():
     # Load the configuration file
     Configuration.load_configuration()
 
+    args = parse_args()
+    if args.headless:
+        Configuration.cfg_headless = True
+    if args.sink:
+        Configuration.cfg_sink = args.sink
+    if args.sink_file:
+        Configuration.cfg_sink_file = args.sink_file
+    if args.capture_file:
+        Configuration.cfg_capture_file = args.capture_file
+    if args.compare_align:
+        Configuration.cfg_compare_align = args.compare_align
+    if args.compare_tolerance is not None:
+        Configuration.cfg_compare_tolerance = args.compare_tolerance
+    if args.compare_max_pixels is not None:
+        Configuration.cfg_compare_max_pixels = args.compare_max_pixels
+    if args.compare_report:
+        Configuration.cfg_compare_report = args.compare_report
+
     # Activate logging to console or file
     # Logging.EnableLogging()
     app_logger.EnableEngineLogging()
@@ -87,44 +157,127 @@ def main():
     # Set up handler for the kill signal
     signal.signal(signal.SIGTERM, term_handler)  # Activate the server; this will keep running until you
     # interrupt the program with Ctrl-C or kill the daemon.
+    if Configuration.stats_file() and hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, stats_handler)
+
+    # The emulated LED strings, each with a bounded frame queue
+    # between its socket server and the display
+    LEDStrings.configure_from_configuration()
+    led_strings = LEDStrings.all()
+    # In process mode the ingest workers write the capture files
+    process_mode = Configuration.server_mode() == "process"
+    if Configuration.capture_file() and not process_mode:
+        LEDStrings.start_capture(Configuration.capture_file())
 
     # This accepts connections from any network interface. It was the only
     # way to get it to work in the RPi from remote machines.
-    HOST, PORT = "0.0.0.0", Configuration.cfg_port
+    HOST = "0.0.0.0"
 
-    # Create the TCP socket server on its own thread.
+    # Create a TCP socket server for each string on its own thread.
     # This is done so that we can handle the kill signal which
     # arrives on the main thread. If we didn't put the TCP server
     # on its own thread we would not be able to shut it down in
     # an orderly fashion.
-    server = SocketServerThread.SocketServerThread(HOST, PORT,
-                                                   LEDConnectionHandler,
-                                                   connection_time_out=-1,
-                                                   frame_size=(Configuration.num_pixels() * 4) + 8)
+    # In process mode each string's servers run in a worker process
+    # (strings sharing an E1.31/Art-Net port share one) and only the
+    # display runs in this one.
+    if process_mode:
+        servers = []
+        for group in group_strings(led_strings):
+            capture_files = None
+            if Configuration.capture_file():
+                capture_files = [LEDStrings.capture_file_for(Configuration.capture_file(), led_string)
+                                 for led_string in group]
+            servers.append(IngestProcess(HOST, group, capture_files=capture_files,
+                                         strict_frames=Configuration.strict_frames(),
+                                         max_frame_size=Configuration.max_frame_size()))
+    else:
+        servers = create_string_servers(HOST, led_strings, server_mode=Configuration.server_mode(),
+                                        strict_frames=Configuration.strict_frames(),
+                                        max_frame_size=Configuration.max_frame_size())
+
+    # Statistics are available through the stats port and/or the stats file
+    LEDStats.add_source("strings", LEDStrings.stats)
+    stats_server = None
+    if Configuration.stats_port():
+        stats_server = StatsServerThread.StatsServerThread(HOST, Configuration.stats_port(), LEDStats.snapshot)
+    # Browsers can watch the strings through the web viewer
+    viewer_server = None
+    if Configuration.viewer_port():
+        viewer_server = WebViewerServerThread.WebViewerServerThread(HOST, Configuration.viewer_port(), led_strings,
+                                                                    max_fps=Configuration.viewer_max_fps())
 
-    # Launch the socket server
+    # Launch the socket servers
+    started_servers = []
+    # Frame sinks used when running headless
+    sinks = []
+    exit_status = 0
     try:
         # This runs "forever", until ctrl-c or killed
-        server.Start()
+        for server in servers:
+            server.Start()
+            started_servers.append(server)
+        if stats_server:
+            stats_server.Start()
+            started_servers.append(stats_server)
+        if viewer_server:
+            viewer_server.Start()
+            started_servers.append(viewer_server)
 
         terminate_service = False
-        run_led_window(Configuration.num_pixels())
-    except KeyboardInterrupt:
+        if Configuration.headless():
+            from led_headless import run_headless, run_headless_strings
+            if len(led_strings) == 1:
+                sink = create_frame_sink(Configuration.sink(), Configuration.sink_file(),
+                                         compare_options=compare_options())
+                sinks.append(sink)
+                run_headless(sink, polling_interval_ms=Configuration.polling_interval())
+            else:
+                string_sinks = []
+                for led_string in led_strings:
+                    sink_file = Configuration.sink_file()
+                    if sink_file:
+                        sink_file = string_sink_file(sink_file, led_string.name)
+                    sink = create_frame_sink(Configuration.sink(), sink_file,
+                                             compare_options=compare_options(led_string.name))
+                    sinks.append(sink)
+                    string_sinks.append((led_string, sink))
+                run_headless_strings(string_sinks, polling_interval_ms=Configuration.polling_interval())
+        else:
+            from led_window import run_led_window
+            run_led_window(led_strings, renderer=Configuration.renderer(),
+                           polling_interval_ms=Configuration.polling_interval(),
+                           max_fps=Configuration.max_fps())
+    except (KeyboardInterrupt, SystemExit):
         logger.info("LEDEmulator shutting down...")
     except Exception as e:
         logger.error("Unhandled exception occurred")
-        logger.error(e.strerror)
+        logger.error(str(e))
         logger.error(sys.exc_info()[0])
         # app_trace.log_trace(logger, ex=e)
     finally:
         # We actually get here through ctrl-c or process kill (SIGTERM)
-        server.Stop()
+        # Release any socket server threads waiting on a full frame queue
+        LEDStrings.close()
+        for led_string in led_strings:
+            logger.info("%s dropped frames: %s", led_string.name, str(led_string.frame_queue.dropped()))
+        for server in started_servers:
+            server.Stop()
+        LEDStrings.stop_capture()
+        if Configuration.stats_file():
+            LEDStats.dump(Configuration.stats_file())
+            logger.info("Statistics written to %s", Configuration.stats_file())
+        # A failed comparison (compare sink) fails the run
+        if not all([sink.passed() for sink in sinks]):
+            logger.error("Frame comparison failed")
+            exit_status = 1
         CleanUp()
     print("Exiting main()")
+    return exit_status
 
 
 #
 # Run as an application
 #
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
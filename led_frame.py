@@ -0,0 +1,154 @@
+#
+# LED data frame
+# Copyright © 2019  Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from struct import unpack_from, iter_unpack
+# NumPy is optional. When it is available it is used for bulk operations.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class LEDFrame:
+    """
+    A compact LED data frame. The pixel data is held exactly as it
+    arrives in the body of an APA102 frame, 4 bytes per pixel
+    (brightness, r, g, b), in a bytes-like object.
+
+    Indexing a frame returns a (brightness, r, g, b) tuple, so a frame
+    can be used wherever a list of 4-tuples was used before.
+    """
+
+    __slots__ = ("data", "num_pixels", "timestamp")
+
+    # There are 4 bytes for each pixel
+    pixel_size = 4
+
+    def __init__(self, data, timestamp=None):
+        """
+        Constructor
+        :param data: bytes-like pixel data, 4 bytes per pixel. The frame
+        does not copy the data.
+        :param timestamp: Time the frame was received (time.time())
+        """
+        self.data = data
+        self.num_pixels = len(data) // LEDFrame.pixel_size
+        self.timestamp = timestamp
+
+    @classmethod
+    def from_pixels(cls, pixels):
+        """
+        Create a frame from a sequence of (brightness, r, g, b) tuples
+        :param pixels:
+        :return: Returns a LEDFrame
+        """
+        return cls(bytes([v for pixel in pixels for v in pixel]))
+
+    def __len__(self):
+        return self.num_pixels
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.num_pixels
+        if index < 0 or index >= self.num_pixels:
+            raise IndexError("pixel index out of range")
+        return unpack_from("4B", self.data, index * LEDFrame.pixel_size)
+
+    def __iter__(self):
+        return iter_unpack("4B", self.data)
+
+    def __eq__(self, other):
+        if isinstance(other, LEDFrame):
+            return self.data == other.data
+        return NotImplemented
+
+    def brightness(self):
+        """
+        :return: Returns the brightness byte of every pixel as bytes
+        """
+        return bytes(self.data[0::4])
+
+    def red(self):
+        return bytes(self.data[1::4])
+
+    def green(self):
+        return bytes(self.data[2::4])
+
+    def blue(self):
+        return bytes(self.data[3::4])
+
+    def rgb(self):
+        """
+        :return: Returns the pixels as packed (r, g, b) bytes
+        """
+        rgb = bytearray(self.num_pixels * 3)
+        rgb[0::3] = self.data[1::4]
+        rgb[1::3] = self.data[2::4]
+        rgb[2::3] = self.data[3::4]
+        return bytes(rgb)
+
+    def as_array(self):
+        """
+        View the frame as a NumPy array without copying.
+        Requires NumPy.
+        :return: Returns a (num_pixels, 4) uint8 array
+        """
+        if numpy is None:
+            raise RuntimeError("NumPy is not installed")
+        return numpy.frombuffer(self.data, dtype=numpy.uint8).reshape(self.num_pixels, LEDFrame.pixel_size)
+
+    def changed_pixels(self, previous):
+        """
+        Compare against previous pixel data
+        :param previous: bytes-like pixel data of the same length or None
+        :return: Returns a list of the indexes of pixels that differ
+        """
+        return changed_pixels(self.data, previous)
+
+
+# Number of pixels compared at a time when NumPy is not available.
+# Blocks that are equal are skipped with one bytes compare.
+compare_block_pixels = 64
+
+
+def changed_pixels(data, previous):
+    """
+    Compare two sets of pixel data
+    :param data: bytes-like pixel data, 4 bytes per pixel
+    :param previous: bytes-like pixel data of the same length or None
+    :return: Returns a list of the indexes of pixels that differ
+    """
+    num_pixels = len(data) // LEDFrame.pixel_size
+    if previous is None:
+        return list(range(num_pixels))
+
+    if numpy is not None:
+        a = numpy.frombuffer(data, dtype=numpy.uint32, count=num_pixels)
+        b = numpy.frombuffer(previous, dtype=numpy.uint32, count=num_pixels)
+        return numpy.flatnonzero(a != b).tolist()
+
+    data = memoryview(data)
+    previous = memoryview(previous)
+    changed = []
+    block_size = compare_block_pixels * LEDFrame.pixel_size
+    for block in range(0, num_pixels * LEDFrame.pixel_size, block_size):
+        end = min(block + block_size, len(data))
+        if data[block:end] != previous[block:end]:
+            for offset in range(block, end, LEDFrame.pixel_size):
+                if data[offset:offset + 4] != previous[offset:offset + 4]:
+                    changed.append(offset // LEDFrame.pixel_size)
+    return changed
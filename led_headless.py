@@ -0,0 +1,101 @@
+#
+# LED Emulator headless runner - for running without a display
+# Copyright © 2019  Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Note that this module must not import tkinter (directly or indirectly)
+import time
+import threading
+import app_logger
+from led_connection_handler import LEDConnectionHandler
+from led_stats import LEDStats
+
+logger = app_logger.getAppLogger()
+
+
+def run_headless(sink, polling_interval_ms=20, report_interval=10.0, stop_event=None, led_string=None):
+    """
+    Drain LED data frames into a frame sink until interrupted (ctrl-c).
+    This is the headless counterpart of run_led_window().
+    :param sink: A FrameSink instance
+    :param polling_interval_ms: Longest time to wait for a frame to arrive
+    :param report_interval: Seconds between throughput reports
+    :param stop_event: Optional threading.Event that ends the run when set
+    :param led_string: The LED string to drain. Defaults to the first string.
+    :return: None
+    """
+    logger.info("Running headless with %s", type(sink).__name__)
+    sink.open()
+
+    start_time = time.time()
+    report_time = start_time
+    report_count = 0
+    try:
+        while not (stop_event and stop_event.is_set()):
+            # Wait for a frame, then consume everything that is queued
+            frame = LEDConnectionHandler.get_frame(timeout=polling_interval_ms / 1000.0, led_string=led_string)
+            while frame:
+                if frame.timestamp:
+                    LEDStats.record("queue_wait", time.time() - frame.timestamp)
+                start = time.perf_counter()
+                sink.write_frame(frame)
+                LEDStats.record("render_time", time.perf_counter() - start)
+                LEDStats.count("frames_rendered")
+                frame = LEDConnectionHandler.get_frame(led_string=led_string)
+
+            now = time.time()
+            if (now - report_time) >= report_interval:
+                logger.info("Frame count: %d (%.1f frames/sec)",
+                            sink.frame_count,
+                            (sink.frame_count - report_count) / (now - report_time))
+                report_time = now
+                report_count = sink.frame_count
+    finally:
+        sink.close()
+        elapsed = time.time() - start_time
+        if elapsed > 0:
+            logger.info("Headless run consumed %d frames in %.1f sec (%.1f frames/sec)",
+                        sink.frame_count, elapsed, sink.frame_count / elapsed)
+
+
+def run_headless_strings(string_sinks, polling_interval_ms=20, report_interval=10.0):
+    """
+    Drain several LED strings, each into its own frame sink, until
+    interrupted (ctrl-c). Each string is drained on its own thread.
+    :param string_sinks: A list of (LEDString, FrameSink) tuples
+    :param polling_interval_ms: Longest time to wait for a frame to arrive
+    :param report_interval: Seconds between throughput reports
+    :return: None
+    """
+    stop_event = threading.Event()
+    threads = []
+    for led_string, sink in string_sinks:
+        thread = threading.Thread(target=run_headless, args=(sink,),
+                                  kwargs={"polling_interval_ms": polling_interval_ms,
+                                          "report_interval": report_interval,
+                                          "stop_event": stop_event,
+                                          "led_string": led_string},
+                                  name="headless-" + led_string.name)
+        thread.start()
+        threads.append(thread)
+
+    try:
+        # The main thread waits here so that it can receive ctrl-c
+        while True:
+            time.sleep(0.5)
+    finally:
+        stop_event.set()
+        for thread in threads:
+            thread.join()
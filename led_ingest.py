@@ -0,0 +1,229 @@
+#
+# LED Emulator ingest - socket servers for the LED strings
+# Copyright © 2019  Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Note that this module must not import tkinter (directly or indirectly)
+import signal
+import threading
+from ledsocketserver import SocketServerThread
+from ledsocketserver import AsyncSocketServerThread
+from ledsocketserver import UDPServerThread
+from ledsocketserver import DMXServerThread
+from ledsocketserver.TCPRequestHandler import TCPRequestHandler
+import app_logger
+from led_connection_handler import LEDConnectionHandler
+from led_stats import LEDStats
+from led_string import LEDString, LEDStrings
+from shared_frame_buffer import SharedFrameBuffer, context
+
+logger = app_logger.getAppLogger()
+
+
+def create_string_servers(host, led_strings, server_mode="threaded", strict_frames=False, max_frame_size=0):
+    """
+    Create the socket servers that receive frames for LED strings
+    :param host: Interface address to listen on
+    :param led_strings: List of LEDString instances
+    :param server_mode: threaded or asyncio
+    :param strict_frames: Check every frame received over TCP (see FrameValidator)
+    :param max_frame_size: Largest frame of another size accepted over TCP (see VariableFrame)
+    :return: Returns a list of servers (not yet started)
+    """
+    TCPRequestHandler.set_strict_frames(strict_frames)
+    TCPRequestHandler.set_max_frame_size(max_frame_size)
+    # The asyncio server handles all connections on that one thread
+    # while the threaded server creates a thread per connection.
+    if server_mode == "asyncio":
+        server_class = AsyncSocketServerThread.AsyncSocketServerThread
+    else:
+        server_class = SocketServerThread.SocketServerThread
+    servers = []
+    for led_string in led_strings:
+        servers.append(server_class(host, led_string.port,
+                                    LEDConnectionHandler,
+                                    connection_time_out=-1,
+                                    frame_size=led_string.frame_size))
+        # Datagram frames on the string's UDP port
+        if led_string.udp_port:
+            servers.append(UDPServerThread.UDPServerThread(host, led_string.udp_port,
+                                                           LEDConnectionHandler,
+                                                           frame_size=led_string.frame_size))
+    # E1.31 (sACN) and Art-Net input, one receiver per protocol and port
+    servers.extend(DMXServerThread.create_dmx_servers(host, led_strings, LEDConnectionHandler))
+    return servers
+
+
+def group_strings(led_strings):
+    """
+    Group LED strings for ingest worker processes. Each string gets a
+    worker of its own, except that strings receiving E1.31/Art-Net on
+    the same UDP port share one worker. A port can only have one
+    receiver (a unicast datagram reaches just one of several sockets
+    bound to it).
+    :param led_strings: List of LEDString instances
+    :return: Returns a list of lists of LEDString instances
+    """
+    groups = []
+    by_port = {}
+    for led_string in led_strings:
+        if led_string.dmx:
+            port = DMXServerThread.dmx_endpoint(led_string.dmx)[1]
+            if port in by_port:
+                by_port[port].append(led_string)
+                continue
+            by_port[port] = [led_string]
+            groups.append(by_port[port])
+        else:
+            groups.append([led_string])
+    return groups
+
+
+class IngestProcess:
+    """
+    Runs the socket servers of one or more LED strings in a worker
+    process. Frames are received and decoded in the worker and the newest
+    frame of each string is passed to this (the render) process through
+    a SharedFrameBuffer. Socket I/O and decoding then use another core
+    and cannot starve the LED window. The worker's statistics are sent
+    back through a pipe and merged into this process's statistics.
+
+    Like the socket server threads, an instance is started with Start()
+    and stopped with Stop().
+    """
+    # Longest wait for a worker to shut down before it is terminated
+    stop_timeout = 5.0
+    # Seconds between statistics updates from the worker
+    stats_interval = 1.0
+
+    def __init__(self, host, led_strings, server_mode="threaded", capture_files=None, strict_frames=False,
+                 max_frame_size=0):
+        """
+        Constructor
+        :param host: Interface address to listen on
+        :param led_strings: The LEDStrings served by the worker (see
+        group_strings). Their frames will come from the worker.
+        :param server_mode: threaded or asyncio (used inside the worker)
+        :param capture_files: Optional list of capture files, one per
+        string (None for no capture), written by the worker
+        :param strict_frames: Check every frame received over TCP (see FrameValidator)
+        :param max_frame_size: Largest frame of another size accepted over TCP (see VariableFrame)
+        """
+        self.led_strings = list(led_strings)
+        self.name = "ingest-" + "+".join([led_string.name for led_string in self.led_strings])
+        self.shared_buffers = []
+        string_configs = []
+        for led_string in self.led_strings:
+            shared_buffer = SharedFrameBuffer(led_string.num_pixels)
+            led_string.shared_buffer = shared_buffer
+            self.shared_buffers.append(shared_buffer)
+            string_configs.append({
+                "name": led_string.name,
+                "port": led_string.port,
+                "udp_port": led_string.udp_port,
+                "num_pixels": led_string.num_pixels,
+                "layout": led_string.layout.to_dict(),
+                "dmx": led_string.dmx,
+            })
+        self.stop_event = context.Event()
+        self.stats_receive, self.stats_send = context.Pipe(duplex=False)
+        self.stats_thread = threading.Thread(target=self.receive_stats, name=self.name + "-stats")
+        self.process = context.Process(target=run_ingest_worker, name=self.name,
+                                       args=(host, string_configs, server_mode, capture_files, strict_frames,
+                                             max_frame_size, self.shared_buffers, self.stop_event,
+                                             self.stats_send, IngestProcess.stats_interval))
+
+    def Start(self):
+        for shared_buffer, led_string in zip(self.shared_buffers, self.led_strings):
+            shared_buffer.start_listener(lambda led_string=led_string: self.frames_arrived(led_string))
+        self.process.start()
+        # Only the worker writes statistics. The receiver sees the end
+        # of the pipe when the worker exits.
+        self.stats_send.close()
+        self.stats_thread.start()
+
+    def frames_arrived(self, led_string):
+        # Wake up the display, if it wants to know
+        notifier = led_string.notifier
+        if notifier:
+            notifier.notify()
+
+    def receive_stats(self):
+        while True:
+            try:
+                exported = self.stats_receive.recv()
+            except (EOFError, OSError):
+                break
+            LEDStats.set_remote(self.name, exported)
+
+    def Stop(self):
+        print("Shutting down ingest process {0}".format(self.name))
+        self.stop_event.set()
+        self.process.join(IngestProcess.stop_timeout)
+        if self.process.is_alive():
+            logger.error("Ingest process %s did not stop", self.name)
+            self.process.terminate()
+            self.process.join()
+        self.stats_thread.join()
+        self.stats_receive.close()
+        for shared_buffer in self.shared_buffers:
+            shared_buffer.close()
+        print("Ingest process down")
+
+
+def run_ingest_worker(host, string_configs, server_mode, capture_files, strict_frames, max_frame_size,
+                      shared_buffers, stop_event, stats_send, stats_interval):
+    """
+    Ingest worker process main
+    """
+    # Ctrl-C reaches every process in the group. The render process
+    # decides when the worker stops.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    led_strings = []
+    for string_config, shared_buffer in zip(string_configs, shared_buffers):
+        led_string = LEDString(string_config["name"], string_config["port"], string_config["num_pixels"],
+                               layout=string_config["layout"], udp_port=string_config["udp_port"],
+                               dmx=string_config["dmx"])
+        # Frames go to the render process instead of the frame queue
+        led_string.shared_buffer = shared_buffer
+        led_strings.append(led_string)
+    LEDStrings.configure(led_strings)
+    for led_string, capture_file in zip(led_strings, capture_files or []):
+        if capture_file:
+            led_string.start_capture(capture_file)
+
+    servers = create_string_servers(host, led_strings, server_mode=server_mode, strict_frames=strict_frames,
+                                    max_frame_size=max_frame_size)
+    started_servers = []
+    try:
+        for server in servers:
+            server.Start()
+            started_servers.append(server)
+        while not stop_event.wait(stats_interval):
+            stats_send.send(LEDStats.export())
+    finally:
+        for server in started_servers:
+            server.Stop()
+        for led_string in led_strings:
+            led_string.stop_capture()
+        # The final statistics
+        try:
+            stats_send.send(LEDStats.export())
+        except OSError:
+            pass
+        stats_send.close()
+        for shared_buffer in shared_buffers:
+            shared_buffer.close()
@@ -0,0 +1,202 @@
+#
+# LED string layouts
+# Copyright © 2019  Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# A layout maps each pixel index in a LED data frame to a position on a
+# grid of width x height cells. Layouts are described in the configuration
+# file like this.
+#   {"type": "zigzag", "width": 50}
+#   {"type": "serpentine", "width": 64}
+#   {"type": "ring"}
+#   {"type": "file", "file": "tree.json"}
+#
+# zigzag - rows of width pixels, every row runs left to right (the default)
+# serpentine - rows of width pixels, alternate rows run right to left
+# ring - pixels are evenly spaced around a circle
+# file - a JSON list of [x, y] positions or a text file of x,y lines,
+#        one per pixel
+#
+# All of the mapping work is done once when the layout is created.
+#
+
+import json
+import math
+from operator import itemgetter
+# NumPy is optional. When it is available it is used for bulk operations.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class LEDLayout:
+    """
+    Pixel index to grid position mapping for one LED string
+    """
+    def __init__(self, layout_type, positions):
+        """
+        Constructor
+        :param layout_type: Name of the layout type
+        :param positions: A list of (x, y) positions, one per pixel.
+        Positions are in grid cells and may be fractional.
+        """
+        if not positions:
+            raise ValueError("The {0} layout has no pixel positions".format(layout_type))
+        self.layout_type = layout_type
+        self.num_pixels = len(positions)
+        min_x = min([p[0] for p in positions])
+        min_y = min([p[1] for p in positions])
+        # Normalize so the top left cell is (0, 0)
+        self.positions = [(x - min_x, y - min_y) for x, y in positions]
+        self.width = int(round(max([p[0] for p in self.positions]))) + 1
+        self.height = int(round(max([p[1] for p in self.positions]))) + 1
+
+        # Index table for the bitmap renderer. For each grid cell (row
+        # major) there are 3 offsets into the frame pixel data, one each
+        # for r, g and b. Empty cells point one past the end of the pixel
+        # data, where a zero byte is appended.
+        empty = self.num_pixels * 4
+        cells = [None] * (self.width * self.height)
+        for i, (x, y) in enumerate(self.positions):
+            cells[(int(round(y)) * self.width) + int(round(x))] = i
+        # Rows of pixels in wiring order need no rearranging, only padding
+        self.sequential = all([cells[i] == i for i in range(self.num_pixels)])
+        self.cell_offsets = []
+        for i in cells:
+            if i is None:
+                self.cell_offsets.extend([empty, empty, empty])
+            else:
+                self.cell_offsets.extend([(i * 4) + 1, (i * 4) + 2, (i * 4) + 3])
+        self._gather = itemgetter(*self.cell_offsets)
+        if numpy is not None:
+            self._gather_index = numpy.array(self.cell_offsets, dtype=numpy.intp)
+
+    def grid_rgb(self, data):
+        """
+        Rearrange frame pixel data into grid order
+        :param data: bytes-like pixel data, 4 bytes per pixel (brightness, r, g, b)
+        :return: Returns packed (r, g, b) bytes for every grid cell, row major
+        """
+        if self.sequential:
+            rgb = bytearray(len(self.cell_offsets))
+            n = self.num_pixels * 3
+            rgb[0:n:3] = data[1::4]
+            rgb[1:n:3] = data[2::4]
+            rgb[2:n:3] = data[3::4]
+            return bytes(rgb)
+        padded = bytes(data) + b"\x00"
+        if numpy is not None:
+            return numpy.frombuffer(padded, dtype=numpy.uint8)[self._gather_index].tobytes()
+        return bytes(self._gather(padded))
+
+    def to_dict(self):
+        """
+        :return: Returns a JSON serializable description of the layout
+        """
+        return {
+            "type": self.layout_type,
+            "width": self.width,
+            "height": self.height,
+            "positions": self.positions,
+        }
+
+
+def zigzag_positions(num_pixels, width):
+    return [(i % width, i // width) for i in range(num_pixels)]
+
+
+def serpentine_positions(num_pixels, width):
+    positions = []
+    for i in range(num_pixels):
+        row = i // width
+        column = i % width
+        if row % 2:
+            column = width - 1 - column
+        positions.append((column, row))
+    return positions
+
+
+def ring_positions(num_pixels):
+    # Space the pixels 1.5 cells apart around the circle so that
+    # neighbors do not round to the same grid cell
+    radius = max((num_pixels * 1.5) / (2.0 * math.pi), 1.0)
+    positions = []
+    for i in range(num_pixels):
+        angle = (2.0 * math.pi * i) / num_pixels
+        positions.append((radius + (radius * math.sin(angle)), radius - (radius * math.cos(angle))))
+    return positions
+
+
+def file_positions(num_pixels, file_path):
+    """
+    Load pixel positions from a file
+    :param num_pixels:
+    :param file_path: A JSON list of [x, y] positions or a text file with
+    one x,y line per pixel
+    :return: Returns a list of (x, y)
+    """
+    with open(file_path, "r") as layout_file:
+        text = layout_file.read()
+    try:
+        positions = [(float(p[0]), float(p[1])) for p in json.loads(text)]
+    except ValueError:
+        positions = []
+        for line in text.splitlines():
+            line = line.strip()
+            if line and not line.startswith("#"):
+                x, y = line.split(",")[0:2]
+                positions.append((float(x), float(y)))
+    if len(positions) < num_pixels:
+        raise ValueError("Layout file {0} has {1} positions for {2} pixels".format(
+            file_path, len(positions), num_pixels))
+    return positions[0:num_pixels]
+
+
+# Layout types as they appear in the configuration file
+layout_types = ["zigzag", "serpentine", "ring", "file"]
+
+
+def create_layout(layout_config, num_pixels):
+    """
+    Create a layout from its configuration
+    :param layout_config: A dict like {"type": "serpentine", "width": 64} or None
+    for the default layout (rows of 50 pixels)
+    :param num_pixels: Number of pixels in the string
+    :return: Returns a LEDLayout
+    """
+    if num_pixels < 1:
+        raise ValueError("A LED string must have at least one pixel, not {0}".format(num_pixels))
+    if not layout_config:
+        layout_config = {}
+    layout_type = layout_config.get("type", "zigzag")
+    # A layout saved with LEDLayout.to_dict (e.g. in a capture file)
+    if "positions" in layout_config:
+        return LEDLayout(layout_type, [tuple(p) for p in layout_config["positions"][0:num_pixels]])
+    width = int(layout_config.get("width", 50))
+    width = max(1, min(width, num_pixels))
+
+    if layout_type == "zigzag":
+        positions = zigzag_positions(num_pixels, width)
+    elif layout_type == "serpentine":
+        positions = serpentine_positions(num_pixels, width)
+    elif layout_type == "ring":
+        positions = ring_positions(num_pixels)
+    elif layout_type == "file":
+        positions = file_positions(num_pixels, layout_config["file"])
+    else:
+        raise ValueError("Unrecognized layout type: {0}".format(layout_type))
+    return LEDLayout(layout_type, positions)
@@ -0,0 +1,375 @@
+#
+# LED Emulator statistics
+# Copyright © 2019  Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Frame counters and timing histograms. Like Configuration, this class
+# behaves like a singleton and everything about it is static.
+#
+# Frames are stamped as they pass through the emulator:
+#   read_led_data (socket server) - frames received/rejected, bytes in, receive time
+#   UDP server - frames lost (sequence gaps) and stale (out of order or duplicate)
+#   execute_command (LEDConnectionHandler) - frames queued
+#   next_frame (LED window) or the headless runner - frames rendered/dropped,
+#   queue wait and render time
+#
+# In process server mode the socket servers run in ingest worker
+# processes. Their statistics are exported to the main process and
+# merged into its snapshots (see export and set_remote).
+#
+
+import json
+import time
+from bisect import bisect_left
+from threading import Lock
+
+
+class Histogram:
+    """
+    A fixed bucket histogram of durations
+    """
+    # Bucket upper bounds in ms. The last bucket holds everything larger.
+    bounds_ms = [0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+    def __init__(self):
+        self.buckets = [0] * (len(Histogram.bounds_ms) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, seconds):
+        """
+        Record one duration
+        :param seconds:
+        :return: None
+        """
+        ms = seconds * 1000.0
+        self.buckets[bisect_left(Histogram.bounds_ms, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        if ms > self.max_ms:
+            self.max_ms = ms
+
+    def percentile(self, pct):
+        """
+        Estimate a percentile as the upper bound of the bucket holding it
+        :param pct: 0-100
+        :return: Returns the estimate in ms or None if nothing was recorded
+        """
+        if not self.count:
+            return None
+        rank = (pct / 100.0) * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n:
+                return Histogram.bounds_ms[i] if i < len(Histogram.bounds_ms) else self.max_ms
+        return self.max_ms
+
+    def state(self):
+        """
+        :return: Returns the raw histogram (for passing between processes)
+        """
+        return {"buckets": list(self.buckets), "count": self.count,
+                "total_ms": self.total_ms, "max_ms": self.max_ms}
+
+    def add_state(self, state):
+        """
+        Add another histogram's raw state (see state()) to this one
+        :param state:
+        :return: None
+        """
+        self.buckets = [a + b for a, b in zip(self.buckets, state["buckets"])]
+        self.count += state["count"]
+        self.total_ms += state["total_ms"]
+        self.max_ms = max(self.max_ms, state["max_ms"])
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean_ms": (self.total_ms / self.count) if self.count else None,
+            "p50_ms": self.percentile(50),
+            "p90_ms": self.percentile(90),
+            "p99_ms": self.percentile(99),
+            "max_ms": self.max_ms,
+            "buckets": [[bound, n] for bound, n in zip(Histogram.bounds_ms + ["inf"], self.buckets)],
+        }
+
+
+class ConnectionStats:
+    """
+    Counters for one client connection. Only the connection's own
+    thread updates them.
+    """
+    def __init__(self, connection_id, address):
+        self.connection_id = connection_id
+        self.address = address
+        self.connected = time.time()
+        self.frames_received = 0
+        self.frames_rejected = 0
+        self.frames_queued = 0
+        self.frames_lost = 0
+        self.frames_stale = 0
+        # Frames failing strict checks, by reason (see FrameValidator)
+        self.frames_invalid = {}
+        self.resyncs = 0
+        self.bytes_discarded = 0
+        self.bytes_in = 0
+
+    def to_dict(self):
+        return {
+            "id": self.connection_id,
+            "address": self.address,
+            "connected": self.connected,
+            "frames_received": self.frames_received,
+            "frames_rejected": self.frames_rejected,
+            "frames_queued": self.frames_queued,
+            "frames_lost": self.frames_lost,
+            "frames_stale": self.frames_stale,
+            "frames_invalid": dict(self.frames_invalid),
+            "resyncs": self.resyncs,
+            "bytes_discarded": self.bytes_discarded,
+            "bytes_in": self.bytes_in,
+        }
+
+
+class LEDStats:
+    counter_names = ["frames_received", "frames_rejected", "frames_queued",
+                     "frames_rendered", "frames_dropped", "frames_skipped", "frames_lost", "frames_stale", "frames_invalid",
+                     "resyncs", "bytes_in"]
+    histogram_names = ["receive_time", "queue_wait", "render_time"]
+
+    _lock = Lock()
+    _start_time = time.time()
+    _counters = {name: 0 for name in counter_names}
+    _histograms = {name: Histogram() for name in histogram_names}
+    _connections = {}
+    _next_connection_id = 1
+    # Other components that contribute to the snapshot (name: callable returning a dict)
+    _sources = {}
+    # Statistics exported by ingest worker processes (name: export())
+    _remote = {}
+
+    ######################################################################
+    @classmethod
+    def count(cls, name, n=1):
+        """
+        Increment a global counter
+        :param name: One of counter_names
+        :param n: Amount to add
+        :return: None
+        """
+        with cls._lock:
+            cls._counters[name] += n
+
+    ######################################################################
+    @classmethod
+    def record(cls, name, seconds):
+        """
+        Record a duration in a histogram
+        :param name: One of histogram_names
+        :param seconds:
+        :return: None
+        """
+        with cls._lock:
+            cls._histograms[name].record(seconds)
+
+    ######################################################################
+    @classmethod
+    def frame_received(cls, connection, num_bytes, receive_seconds, frames=1):
+        """
+        Count a complete frame (or batch of frames) read from a connection
+        :param connection: The connection's ConnectionStats
+        :param num_bytes: Bytes read, including the frame size
+        :param receive_seconds: Time taken to read the frame
+        :param frames: Number of frames read
+        :return: None
+        """
+        connection.frames_received += frames
+        connection.bytes_in += num_bytes
+        with cls._lock:
+            cls._counters["frames_received"] += frames
+            cls._counters["bytes_in"] += num_bytes
+            cls._histograms["receive_time"].record(receive_seconds)
+
+    ######################################################################
+    @classmethod
+    def bytes_received(cls, connection, num_bytes):
+        """
+        Count bytes read from a connection that are not part of a frame
+        :param connection: The connection's ConnectionStats
+        :param num_bytes: Bytes read
+        :return: None
+        """
+        connection.bytes_in += num_bytes
+        cls.count("bytes_in", num_bytes)
+
+    ######################################################################
+    @classmethod
+    def frame_rejected(cls, connection):
+        connection.frames_rejected += 1
+        cls.count("frames_rejected")
+
+    ######################################################################
+    @classmethod
+    def frames_lost(cls, connection, count):
+        """
+        Count frames missing from a sequence numbered stream
+        :param connection: The source's ConnectionStats
+        :param count: Number of missing frames
+        :return: None
+        """
+        connection.frames_lost += count
+        cls.count("frames_lost", count)
+
+    ######################################################################
+    @classmethod
+    def frame_stale(cls, connection):
+        """
+        Count a frame discarded because a newer frame already arrived
+        :param connection: The source's ConnectionStats
+        :return: None
+        """
+        connection.frames_stale += 1
+        cls.count("frames_stale")
+
+    ######################################################################
+    @classmethod
+    def frame_invalid(cls, connection, reason):
+        """
+        Count a frame that failed a strict check
+        :param connection: The connection's ConnectionStats
+        :param reason: Why the frame is invalid (see FrameValidator.reasons)
+        :return: None
+        """
+        connection.frames_invalid[reason] = connection.frames_invalid.get(reason, 0) + 1
+        cls.count("frames_invalid")
+
+    ######################################################################
+    @classmethod
+    def resynced(cls, connection, bytes_discarded):
+        """
+        Count a resynchronization of a connection's stream
+        :param connection: The connection's ConnectionStats
+        :param bytes_discarded: Bytes skipped to find the next message
+        :return: None
+        """
+        connection.resyncs += 1
+        connection.bytes_discarded += bytes_discarded
+        cls.count("resyncs")
+
+    ######################################################################
+    @classmethod
+    def open_connection(cls, address):
+        """
+        Start tracking a client connection
+        :param address: Client address
+        :return: Returns the connection's ConnectionStats
+        """
+        with cls._lock:
+            connection = ConnectionStats(cls._next_connection_id, address)
+            cls._next_connection_id += 1
+            cls._connections[connection.connection_id] = connection
+        return connection
+
+    ######################################################################
+    @classmethod
+    def close_connection(cls, connection):
+        with cls._lock:
+            cls._connections.pop(connection.connection_id, None)
+
+    ######################################################################
+    @classmethod
+    def add_source(cls, name, source):
+        """
+        Add another component's statistics to the snapshot
+        :param name: Key in the snapshot
+        :param source: A callable that returns a JSON serializable dict
+        :return: None
+        """
+        cls._sources[name] = source
+
+    ######################################################################
+    @classmethod
+    def export(cls):
+        """
+        The raw counters, histograms and connections of this process, to
+        be merged into another process's statistics (see set_remote)
+        :return: Returns a picklable dict
+        """
+        with cls._lock:
+            return {
+                "counters": dict(cls._counters),
+                "histograms": {name: h.state() for name, h in cls._histograms.items()},
+                "connections": [c.to_dict() for c in cls._connections.values()],
+            }
+
+    ######################################################################
+    @classmethod
+    def set_remote(cls, name, exported):
+        """
+        Replace the statistics of another process. They are included in
+        every snapshot.
+        :param name: Name of the process
+        :param exported: The other process's export()
+        :return: None
+        """
+        with cls._lock:
+            cls._remote[name] = exported
+
+    ######################################################################
+    @classmethod
+    def snapshot(cls):
+        """
+        :return: Returns all statistics as a JSON serializable dict
+        """
+        with cls._lock:
+            counters = dict(cls._counters)
+            histograms = {}
+            for name, h in cls._histograms.items():
+                histograms[name] = Histogram()
+                histograms[name].add_state(h.state())
+            connections = [c.to_dict() for c in cls._connections.values()]
+            for remote_name, exported in cls._remote.items():
+                for name, n in exported["counters"].items():
+                    counters[name] = counters.get(name, 0) + n
+                for name, state in exported["histograms"].items():
+                    histograms[name].add_state(state)
+                for connection in exported["connections"]:
+                    connection = dict(connection)
+                    connection["ingest"] = remote_name
+                    connections.append(connection)
+            stats = {
+                "time": time.time(),
+                "uptime": time.time() - cls._start_time,
+                "counters": counters,
+                "histograms": {name: h.to_dict() for name, h in histograms.items()},
+                "connections": connections,
+            }
+        for name, source in cls._sources.items():
+            stats[name] = source()
+        return stats
+
+    ######################################################################
+    @classmethod
+    def dump(cls, file_path):
+        """
+        Write a snapshot to a file as JSON
+        :param file_path:
+        :return: None
+        """
+        with open(file_path, "w") as stats_file:
+            json.dump(cls.snapshot(), stats_file, indent=2)
@@ -0,0 +1,287 @@
+#
+# Emulated LED strings
+# Copyright © 2019  Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from threading import Lock
+from configuration import Configuration
+from frame_queue import FrameRingBuffer
+from frame_capture import CaptureWriter
+from frame_sinks import string_sink_file
+from led_color import ColorPipeline
+from led_frame import LEDFrame
+from led_layout import create_layout
+from led_stats import LEDStats
+
+
+class LEDString:
+    """
+    One emulated LED string. Each string listens on its own port and has
+    its own pixel count and frame queue. The frames in the queue are
+    displayed by the string's render target (LED window view or frame sink).
+    """
+    def __init__(self, name, port, num_pixels, queue_size=64, queue_policy=FrameRingBuffer.DROP_OLDEST,
+                 layout=None, color_pipeline=None, udp_port=0, dmx=None):
+        """
+        Constructor
+        :param name: Name shown in the LED window and logs
+        :param port: Port number the string listens on
+        :param num_pixels: Number of pixels in the string
+        :param queue_size: Frame queue capacity
+        :param queue_policy: Frame queue drop policy
+        :param layout: Layout configuration (see led_layout.py). None
+        for rows of 50 pixels.
+        :param color_pipeline: ColorPipeline that converts frames for display.
+        None applies the APA102 brightness only.
+        :param udp_port: Port number the string receives datagram frames on (0 for none)
+        :param dmx: E1.31/Art-Net input configuration (see DMXServerThread) or None
+        """
+        self.name = name
+        self.port = port
+        self.udp_port = udp_port
+        self.dmx = dmx
+        self.num_pixels = num_pixels
+        # There are 4 bytes for each pixel plus a 4 byte header and a 4 byte trailer
+        self.frame_body_size = num_pixels * 4
+        self.frame_size = self.frame_body_size + 8
+        self.layout = create_layout(layout, num_pixels)
+        self.color_pipeline = color_pipeline if color_pipeline else ColorPipeline()
+        self.frame_queue = FrameRingBuffer(capacity=queue_size, policy=queue_policy,
+                                           on_drop=lambda n: LEDStats.count("frames_dropped", n))
+        # Records every frame received when capturing (see start_capture)
+        self.recorder = None
+        # Told when a frame is queued (see FrameNotifier)
+        self.notifier = None
+        # Set when the string's frames are received by an ingest worker
+        # process (see led_ingest.py). Frames are passed through it instead
+        # of the frame queue.
+        self.shared_buffer = None
+        # Given every frame taken for display (see WebViewerServerThread)
+        self.viewer = None
+
+    def start_capture(self, file_path):
+        """
+        Record every frame received by this string to a capture file
+        :param file_path: Capture file to be created
+        :return: None
+        """
+        self.stop_capture()
+        self.recorder = CaptureWriter(file_path, self.num_pixels, layout=self.layout)
+
+    def stop_capture(self):
+        """
+        Finish writing the capture file, if any
+        :return: None
+        """
+        recorder = self.recorder
+        self.recorder = None
+        if recorder:
+            recorder.close()
+
+    def get_frame(self, timeout=None):
+        """
+        Gets the oldest available LED data frame
+        :param timeout: If not None, the maximum time in seconds to wait
+        for a frame to arrive.
+        :return: Returns the frame or None
+        """
+        if self.shared_buffer:
+            # Only the newest frame is available from an ingest worker
+            if timeout and not self.shared_buffer.wait(timeout):
+                return None
+            frame, skipped = self.shared_buffer.read_latest()
+            if not frame:
+                return None
+            if skipped:
+                # Replaced by a newer frame before this one was taken
+                LEDStats.count("frames_skipped", skipped)
+            # The caller may keep the frame
+            frame = LEDFrame(bytes(frame.data), timestamp=frame.timestamp)
+        else:
+            frame = self.frame_queue.get(timeout=timeout)
+        viewer = self.viewer
+        if frame and viewer:
+            viewer.publish(self, frame)
+        return frame
+
+    def get_latest_frame(self):
+        """
+        Gets the newest available LED data frame, discarding any older ones.
+        :return: Returns a tuple (frame, skipped)
+        """
+        if self.shared_buffer:
+            # The frame is a view of shared memory, valid until the next frame is taken
+            frame, skipped = self.shared_buffer.read_latest()
+        else:
+            frame, skipped = self.frame_queue.get_latest()
+        viewer = self.viewer
+        if frame and viewer:
+            viewer.publish(self, frame)
+        return frame, skipped
+
+    def queue_stats(self):
+        """
+        Frame queue statistics
+        :return: Returns a dict
+        """
+        return {
+            "name": self.name,
+            "port": self.port,
+            "udp_port": self.udp_port,
+            "dmx": self.dmx,
+            "num_pixels": self.num_pixels,
+            "layout": self.layout.layout_type,
+            "capacity": self.frame_queue.capacity,
+            "policy": self.frame_queue.policy,
+            "queued": len(self.frame_queue),
+            "dropped": self.frame_queue.dropped(),
+            "capture": self.recorder.stats() if self.recorder else None,
+            "ingest": "process" if self.shared_buffer else "thread",
+        }
+
+
+class LEDStrings:
+    """
+    The set of emulated LED strings. Like Configuration, this class
+    behaves like a singleton and everything about it is static.
+    """
+    _lock = Lock()
+    _strings = []
+    _by_port = {}
+
+    ######################################################################
+    @classmethod
+    def configure(cls, strings):
+        """
+        Replace the set of strings. This should be done before the
+        socket servers are started.
+        :param strings: A list of LEDString instances
+        :return: None
+        """
+        if not strings:
+            raise ValueError("At least one LED string must be configured")
+        by_port = {}
+        for led_string in strings:
+            for port in [led_string.port, led_string.udp_port]:
+                if not port:
+                    continue
+                if port in by_port:
+                    raise ValueError("Port {0} is used by more than one LED string".format(port))
+                by_port[port] = led_string
+        with cls._lock:
+            cls._strings = list(strings)
+            cls._by_port = by_port
+
+    ######################################################################
+    @classmethod
+    def configure_from_configuration(cls):
+        """
+        Create the strings described by the configuration file
+        :return: None
+        """
+        # The color tables are shared by all strings
+        color_pipeline = ColorPipeline(apply_brightness=Configuration.apply_brightness(),
+                                       gamma=Configuration.gamma(),
+                                       color_order=Configuration.color_order())
+        cls.configure([LEDString(s["name"], s["port"], s["num_pixels"],
+                                 queue_size=Configuration.frame_queue_size(),
+                                 queue_policy=Configuration.frame_queue_policy(),
+                                 layout=s["layout"], color_pipeline=color_pipeline,
+                                 udp_port=s["udp_port"], dmx=s["dmx"])
+                       for s in Configuration.strings()])
+
+    ######################################################################
+    @classmethod
+    def all(cls):
+        """
+        :return: Returns a list of all LED strings
+        """
+        if not cls._strings:
+            cls.configure_from_configuration()
+        return list(cls._strings)
+
+    ######################################################################
+    @classmethod
+    def default(cls):
+        """
+        :return: Returns the first LED string
+        """
+        return cls.all()[0]
+
+    ######################################################################
+    @classmethod
+    def for_port(cls, port):
+        """
+        Map a port number to a LED string
+        :param port:
+        :return: Returns the string listening on the port. If no string
+        is listening on the port the first string is returned.
+        """
+        if not cls._strings:
+            cls.configure_from_configuration()
+        return cls._by_port.get(port, cls._strings[0])
+
+    ######################################################################
+    @classmethod
+    def close(cls):
+        """
+        Release any socket server threads waiting on a full frame queue
+        :return: None
+        """
+        for led_string in cls._strings:
+            led_string.frame_queue.close()
+
+    ######################################################################
+    @classmethod
+    def start_capture(cls, capture_file):
+        """
+        Capture the frames received by every string. When there are
+        several strings, each has its own file (e.g. capture-porch.cap).
+        :param capture_file: Capture file name
+        :return: None
+        """
+        for led_string in cls.all():
+            led_string.start_capture(cls.capture_file_for(capture_file, led_string))
+
+    ######################################################################
+    @classmethod
+    def capture_file_for(cls, capture_file, led_string):
+        """
+        :param capture_file: Capture file name
+        :param led_string:
+        :return: Returns the name of the string's capture file
+        """
+        if len(cls.all()) > 1:
+            return string_sink_file(capture_file, led_string.name)
+        return capture_file
+
+    ######################################################################
+    @classmethod
+    def stop_capture(cls):
+        """
+        Finish writing all capture files. This should be done after the
+        socket servers are stopped.
+        :return: None
+        """
+        for led_string in cls._strings:
+            led_string.stop_capture()
+
+    ######################################################################
+    @classmethod
+    def stats(cls):
+        """
+        :return: Returns the frame queue statistics of every string
+        """
+        return [led_string.queue_stats() for led_string in cls._strings]
@@ -17,99 +17,377 @@
 
 # Python 2/3
 import sys
+import time
+from bisect import bisect_left
 if sys.version_info.major is 3:
     import tkinter as Tk, tkinter.font as tkFont
 else:
     import Tkinter as Tk, tkFont
-from led_connection_handler import LEDConnectionHandler
+from led_frame import LEDFrame
+from led_stats import LEDStats
+from frame_notifier import FrameNotifier
 
-class LEDTestFrame(Tk.Tk):
-    def __init__(self, num_pixels, polling_interval_ms=20, frame_size=0):
+class LEDStringView(Tk.Frame):
+    """
+    Displays one LED string: a display of lights and the string's metrics.
+    The display itself is created by a subclass (see LEDCanvasView and
+    LEDBitmapView).
+    """
+
+    def __init__(self, parent, led_string, light_width, fixed_font, show_name=False):
         """
         Constructor
-        :param num_pixels: Number of pixels in LED string
-        :param polling_interval: Polling time in ms.
+        :param parent: Parent widget
+        :param led_string: The LEDString to be displayed
+        :param light_width: Width of a light in pixels
+        :param fixed_font: Font for the metrics
+        :param show_name: Show the string's name above the lights
         """
-        super(LEDTestFrame, self).__init__()
-        self.title("LED Emulator")
-        self.num_pixels = num_pixels
+        super(LEDStringView, self).__init__(parent)
+        self.led_string = led_string
+        self.num_pixels = led_string.num_pixels
 
-        # Largest row size, max 50 LEDs per line
-        if self.num_pixels < 50:
-            max_row_size = self.num_pixels
-        else:
-            max_row_size = 50
+        # view grid row tracker
+        view_gr = 0
 
-        # Determine width of a light for max of 50 LEDs per line
-        sw = self.winfo_screenwidth()
-        # Use 3/4 of screen for 50 pixels wide
-        w = int((sw * 0.75) / 50)
+        if show_name:
+            self.name_w = Tk.Label(self, font=fixed_font)
+            self.name_w.grid(row=view_gr, column=0)
+            self.name_w["text"] = "{0} (port {1})".format(led_string.name, led_string.port)
+            view_gr += 1
+
+        self.create_display(view_gr, light_width)
+        view_gr += 1
+
+        # Metrics frame
+        self.metrics_frame = Tk.Frame(self)
+        self.metrics_frame.grid(row=view_gr, column=0)
+
+        # Metrics frame grid row tracker
+        metrics_gr = 0
+
+        self.frame_pixels = Tk.Label(self.metrics_frame, font=fixed_font)
+        self.frame_pixels.grid(row=metrics_gr, column=0)
+        self.frame_pixels["text"] = "Number pixels: " + str(self.num_pixels)
+
+        self.frame_count = 0
+        self.frame_count_w = Tk.Label(self.metrics_frame, font=fixed_font)
+        self.frame_count_w.grid(row=metrics_gr, column=1)
+        self.frame_count_w["text"] = "Frame count: " + str(self.frame_count)
+
+        # Queued frames replaced by a newer one before they were painted
+        self.skipped_count = 0
+        self.skipped_count_w = Tk.Label(self.metrics_frame, font=fixed_font)
+        self.skipped_count_w.grid(row=metrics_gr, column=2)
+        self.skipped_count_w["text"] = "Skipped: " + str(self.skipped_count)
+
+    def create_display(self, row, light_width):
+        """
+        Create the widgets that display the lights. The base view has no display.
+        :param row: Grid row for the display
+        :param light_width: Width of a light in pixels
+        :return: None
+        """
+        pass
+
+    def fit_light_width(self, light_width):
+        """
+        Shrink lights so the string's layout fits on the screen
+        :param light_width: Preferred width of a light in pixels
+        :return: Returns the width of a light in pixels
+        """
+        layout = self.led_string.layout
+        max_width = int((self.winfo_screenwidth() * 0.75) / layout.width)
+        max_height = int((self.winfo_screenheight() * 0.6) / layout.height)
+        return max(1, min(light_width, max_width, max_height))
+
+    def show_frame(self, frame):
+        """
+        Start displaying a new frame. The base view only counts frames.
+        :param frame: LED data frame
+        :return: None
+        """
+        pass
+
+    def painting(self):
+        """
+        :return: Returns True if the current frame is not completely painted
+        """
+        return False
+
+    def paint(self, deadline):
+        """
+        Continue painting the current frame
+        :param deadline: time.perf_counter() value when painting must stop
+        :return: None
+        """
+        pass
+
+    def next_frame(self, deadline):
+        """
+        Paint the newest queued LED data frame. Older queued frames are
+        never visible, so they are counted and skipped.
+        :param deadline: time.perf_counter() value when painting must stop
+        :return: Returns True if the frame is not completely painted
+        """
+        # Here's where we need to get the next data frame
+        start = time.perf_counter()
+        frame, skipped = self.led_string.get_latest_frame()
+        if frame:
+            if frame.timestamp:
+                LEDStats.record("queue_wait", time.time() - frame.timestamp)
+            LEDStats.count("frames_rendered")
+            self.frame_count += skipped + 1
+            self.frame_count_w["text"] = "Frame count: " + str(self.frame_count)
+            if skipped:
+                LEDStats.count("frames_skipped", skipped)
+                self.skipped_count += skipped
+                self.skipped_count_w["text"] = "Skipped: " + str(self.skipped_count)
+            # Show the colors a real strip would show
+            self.show_frame(self.led_string.color_pipeline.apply(frame))
+
+        if self.painting():
+            self.paint(deadline)
+        if frame or self.painting():
+            LEDStats.record("render_time", time.perf_counter() - start)
+
+        return self.painting()
+
+
+class LEDCanvasView(LEDStringView):
+    """
+    Displays a LED string as one canvas oval per light
+    """
+    # Number of lights painted between checks of the render time budget
+    paint_chunk_size = 50
+    # Maximum number of cached fill color strings
+    color_cache_size = 4096
+
+    def create_display(self, row, light_width):
+        layout = self.led_string.layout
+        w = self.fit_light_width(light_width)
         # Diameter of a pixel (aka height of a pixel)
         # h = 30
         h = w + 3
 
-        # This is the polling time
-        self.polling_interval__ms = polling_interval_ms
+        # Frame currently being painted and the lights that differ from it.
+        # Painting resumes at the cursor (wrapping around) so that every
+        # light is eventually painted even when frames arrive faster
+        # than they can be painted.
+        self.pending_frame = None
+        self.pending_lights = []
+        self.pending_index = 0
+        self.paint_cursor = 0
 
-        # main frame grid row tracker
-        main_gr = 0
-
-        # How many rows of 50 pixels do we need?
-        nrows = int((self.num_pixels - 1) / max_row_size) + 1
+        # Pixel data last painted on the lights (4 bytes per light) and the
+        # fill color strings for recently seen pixel values
+        # All lights start out off (black)
+        self.painted_data = bytearray(self.num_pixels * LEDFrame.pixel_size)
+        self.color_cache = {}
 
         # Height of canvas accounts for border of 1 px
-        self.canvas = Tk.Canvas(self, height=(h * nrows) + 4, width=(max_row_size * w) + 4, bd=1, relief="solid")
-        self.canvas.grid(row=main_gr, column=0)
+        self.canvas = Tk.Canvas(self, height=(h * layout.height) + 4, width=(layout.width * w) + 4,
+                                bd=1, relief="solid")
+        self.canvas.grid(row=row, column=0)
 
+        # One light per pixel, placed by the string's layout. Top and
+        # left are offset from the border.
         self.lights = []
-        # Top and bottom
-        # Top is offset from border
-        y0 = 6
-        y1 = y0 + h - 8
-        npx = self.num_pixels
-        while npx > 0:
-            if npx >= 50:
-                row_size = 50
-            else:
-                row_size = npx
-            for i in range(row_size):
-                # n circles across
-                # oval(x0, y0, x1, y1)
-                # Left and right
-                x0 = (w * i) + 6
-                x1 = x0 + w - 3
-                # http://infohost.nmt.edu/tcc/help/pubs/tkinter/web/create_oval.html
-                self.lights.append(self.canvas.create_oval(x0, y0, x1, y1))
-
-            # Set up for next row
-            y0 += h
-            y1 += h
-            npx -= 50
+        for x, y in layout.positions:
+            # oval(x0, y0, x1, y1)
+            x0 = (w * x) + 6
+            x1 = x0 + w - 3
+            y0 = (h * y) + 6
+            y1 = y0 + h - 8
+            # http://infohost.nmt.edu/tcc/help/pubs/tkinter/web/create_oval.html
+            self.lights.append(self.canvas.create_oval(x0, y0, x1, y1, fill="#000000"))
 
-        main_gr += 1
+    def show_frame(self, frame):
+        # A partially painted frame is superseded by the new one
+        self.pending_frame = frame
+        self.pending_lights = self.changed_lights(frame)
+        self.pending_index = 0
 
-        # Metrics frame
-        self.metrics_frame = Tk.Frame(self, height=h + w + 5, width=(self.num_pixels * w))
-        self.metrics_frame.grid(row=main_gr, column=0)
+    def painting(self):
+        return self.pending_index < len(self.pending_lights)
 
-        # Metrics frame grid row tracker
-        metrics_gr = 0
+    def paint(self, deadline):
+        self.paint_pending_frame(deadline)
+
+    def changed_lights(self, frame):
+        """
+        Determine which lights do not show the pixel values in a frame
+        :param frame: LED data frame
+        :return: Returns a list of light indexes, starting at the paint cursor
+        """
+        changed = frame.changed_pixels(self.painted_data)
+        # Rotate so painting continues where it left off
+        k = bisect_left(changed, self.paint_cursor)
+        return changed[k:] + changed[:k]
+
+    def fill_color(self, pixel):
+        """
+        Tk fill color for a pixel
+        :param pixel: (brightness, r, g, b)
+        :return: Returns a color string like #rrggbb
+        """
+        fill = self.color_cache.get(pixel)
+        if fill is None:
+            if len(self.color_cache) >= LEDCanvasView.color_cache_size:
+                self.color_cache.clear()
+            fill = "#%02x%02x%02x" % (pixel[1], pixel[2], pixel[3])
+            self.color_cache[pixel] = fill
+        return fill
+
+    def paint_pending_frame(self, deadline):
+        """
+        Paint the changed lights from the pending frame until it is
+        complete or the render time budget is used up.
+        :param deadline: time.perf_counter() value when painting must stop
+        :return: None
+        """
+        frame = self.pending_frame
+        lights = self.pending_lights
+        while self.pending_index < len(lights):
+            end = min(self.pending_index + LEDCanvasView.paint_chunk_size, len(lights))
+            for i in lights[self.pending_index:end]:
+                pixel = frame[i]
+                self.canvas.itemconfigure(self.lights[i], fill=self.fill_color(pixel))
+                o = i * LEDFrame.pixel_size
+                self.painted_data[o:o + LEDFrame.pixel_size] = frame.data[o:o + LEDFrame.pixel_size]
+            self.paint_cursor = (lights[end - 1] + 1) % len(self.lights)
+            self.pending_index = end
+            if time.perf_counter() >= deadline:
+                break
+
+        if self.pending_index >= len(lights):
+            self.pending_frame = None
+            self.pending_lights = []
+            self.pending_index = 0
+
+
+class LEDBitmapView(LEDStringView):
+    """
+    Displays a LED string as a single bitmap. Each pixel is a square block
+    in a Tk PhotoImage. Displaying a frame costs one image update no matter
+    how many pixels the string has.
+    """
+    def create_display(self, row, light_width):
+        self.columns = self.led_string.layout.width
+        self.rows = self.led_string.layout.height
+        # Scale a pixel up to the width of a light, but keep
+        # large layouts on the screen
+        self.scale = self.fit_light_width(light_width)
+
+        # The source image has one image pixel per LED pixel. It is zoomed
+        # into the displayed image.
+        self.source = Tk.PhotoImage(width=self.columns, height=self.rows)
+        self.image = Tk.PhotoImage(width=self.columns * self.scale, height=self.rows * self.scale)
+        self.canvas = Tk.Canvas(self, width=(self.columns * self.scale) + 4, height=(self.rows * self.scale) + 4,
+                                bd=1, relief="solid", background="#000000")
+        self.canvas.grid(row=row, column=0)
+        self.canvas.create_image(3, 3, image=self.image, anchor=Tk.NW)
+
+        # Pixel data currently displayed
+        self.painted_data = None
+        # PPM image header. Putting binary PPM data is the fastest way to
+        # update the image. If this Tk does not support it, fall back to
+        # putting rows of color strings.
+        self.ppm_header = "P6 {0} {1} 255\n".format(self.columns, self.rows).encode("ascii")
+        self.ppm_supported = True
+
+    def show_frame(self, frame):
+        # Frame data may be a view of a buffer that will be reused (see SharedFrameBuffer)
+        data = frame.data if isinstance(frame.data, bytes) else bytes(frame.data)
+        if self.painted_data is not None and data == self.painted_data:
+            return
+        # The layout rearranges the pixels into image order
+        rgb = self.led_string.layout.grid_rgb(data)
+        if self.ppm_supported:
+            try:
+                self.source.put(self.ppm_header + rgb)
+            except Tk.TclError:
+                self.ppm_supported = False
+        if not self.ppm_supported:
+            self.source.put(self.color_rows(rgb), to=(0, 0))
+        # Zoom the source image into the displayed image
+        self.image.tk.call(self.image, "copy", self.source, "-zoom", self.scale, self.scale)
+        self.painted_data = data
+
+    def color_rows(self, rgb):
+        """
+        Format pixel data as a Tk color list
+        :param rgb: Packed (r, g, b) bytes for every image pixel
+        :return: Returns a string like {#rrggbb #rrggbb ...} {...}
+        """
+        hex_rgb = rgb.hex()
+        colors = ["#" + hex_rgb[i:i + 6] for i in range(0, len(hex_rgb), 6)]
+        return " ".join(["{" + " ".join(colors[r:r + self.columns]) + "}"
+                         for r in range(0, len(colors), self.columns)])
+
+
+class LEDTestFrame(Tk.Tk):
+    # LED string view classes by renderer name
+    view_classes = {
+        "canvas": LEDCanvasView,
+        "bitmap": LEDBitmapView,
+    }
+
+    def __init__(self, led_strings, polling_interval_ms=20, frame_size=0, render_budget_ms=10, renderer="canvas",
+                 max_fps=60):
+        """
+        Constructor
+        :param led_strings: List of LEDString instances to display
+        :param polling_interval: Polling time in ms. Only used when frame
+        arrival notification is not available (or max_fps is 0).
+        :param render_budget_ms: Maximum time spent painting per polling
+        cycle before returning to the Tk event loop.
+        :param renderer: canvas (one oval per light) or bitmap (one image)
+        :param max_fps: Maximum number of times per second the window is
+        repainted when frames arrive
+        """
+        super(LEDTestFrame, self).__init__()
+        self.title("LED Emulator")
+
+        # Determine width of a light for max of 50 LEDs per line.
+        # Views shrink their lights when their layout is larger.
+        sw = self.winfo_screenwidth()
+        # Use 3/4 of screen for 50 pixels wide
+        w = int((sw * 0.75) / 50)
+
+        # This is the polling time
+        self.polling_interval__ms = polling_interval_ms
+        self.render_budget_ms = render_budget_ms
+        self.max_fps = max_fps
+
+        # main frame grid row tracker
+        main_gr = 0
 
         # Metrics
         self.fixed_font = tkFont.Font(family="Courier New", size=14, weight=tkFont.NORMAL)
 
-        self.speed_wait = Tk.Label(self.metrics_frame, font=self.fixed_font)
-        self.speed_wait.grid(row=metrics_gr, column=0)
-        self.speed_wait["text"] = "Polling Interval: " + str(self.polling_interval__ms) + "ms"
+        # One view per LED string
+        self.views = []
+        for led_string in led_strings:
+            view = LEDTestFrame.view_classes[renderer](self, led_string, w, self.fixed_font,
+                                                       show_name=len(led_strings) > 1)
+            view.grid(row=main_gr, column=0)
+            self.views.append(view)
+            main_gr += 1
 
-        self.frame_pixels = Tk.Label(self.metrics_frame, font=self.fixed_font)
-        self.frame_pixels.grid(row=metrics_gr, column=1)
-        self.frame_pixels["text"] = "Number pixels: " + str(self.num_pixels)
+        # The socket server threads wake up the window when frames arrive.
+        # If that is not possible, the window polls for frames.
+        self.notifier = self.start_notifications(led_strings) if max_fps else None
+        # Time of the last repaint and whether a repaint is scheduled
+        self.last_frame_time = 0.0
+        self.frame_scheduled = False
 
-        self.frame_count = 0
-        self.frame_count_w = Tk.Label(self.metrics_frame, font=self.fixed_font)
-        self.frame_count_w.grid(row=metrics_gr, column=2)
-        self.frame_count_w["text"] = "Frame count: " + str(self.frame_count)
+        self.speed_wait = Tk.Label(self, font=self.fixed_font)
+        self.speed_wait.grid(row=main_gr, column=0)
+        if self.notifier:
+            self.speed_wait["text"] = "Max Frame Rate: " + str(self.max_fps) + "fps"
+        else:
+            self.speed_wait["text"] = "Polling Interval: " + str(self.polling_interval__ms) + "ms"
 
         main_gr += 1
 
@@ -118,29 +396,81 @@ class LEDTestFrame(Tk.Tk):
         self.q.grid(row=main_gr, column=0)
 
         # Prime the color and timer event
+        self.frame_scheduled = True
         self.next_frame()
 
+    def start_notifications(self, led_strings):
+        """
+        Have the LED strings signal the window when frames arrive
+        :param led_strings:
+        :return: Returns the FrameNotifier or None if Tk cannot watch it
+        """
+        try:
+            notifier = FrameNotifier()
+        except (AttributeError, OSError):
+            return None
+        try:
+            # Not available on Windows
+            self.tk.createfilehandler(notifier.fileno(), Tk.READABLE, self.frames_arrived)
+        except (AttributeError, RuntimeError, Tk.TclError):
+            notifier.close()
+            return None
+        for led_string in led_strings:
+            led_string.notifier = notifier
+        return notifier
+
+    def stop_notifications(self):
+        if self.notifier:
+            for view in self.views:
+                view.led_string.notifier = None
+            self.tk.deletefilehandler(self.notifier.fileno())
+            self.notifier.close()
+            self.notifier = None
+
+    def destroy(self):
+        self.stop_notifications()
+        super(LEDTestFrame, self).destroy()
+
+    def frames_arrived(self, fd, mask):
+        """
+        Tk file handler called when the notifier is signalled
+        """
+        self.notifier.drain()
+        if self.frame_scheduled:
+            return
+        # Repaint now, or as soon as the frame rate cap allows
+        self.frame_scheduled = True
+        wait = (1.0 / self.max_fps) - (time.perf_counter() - self.last_frame_time)
+        if wait > 0:
+            self.after(int(wait * 1000) + 1, self.next_frame)
+        else:
+            self.next_frame()
+
     def next_frame(self):
         """
-        Process all queued LED data frames
+        Paint the newest queued LED data frame of every LED string
         :return:
         """
-        # Here's where we need to get the next data frame
-        frame = LEDConnectionHandler.get_frame()
-        while frame:
-            self.frame_count += 1
-            self.frame_count_w["text"] = "Frame count: " + str(self.frame_count)
-            for i in range(len(self.lights)):
-                p = (frame[i][1], frame[i][2], frame[i][3])
-                self.canvas.itemconfigure(self.lights[i], fill="#%02x%02x%02x" % p)
-
-            # Check for another LED data frame
-            frame = LEDConnectionHandler.get_frame()
+        self.last_frame_time = time.perf_counter()
+        deadline = self.last_frame_time + (self.render_budget_ms / 1000.0)
+        painting = False
+        for view in self.views:
+            if view.next_frame(deadline):
+                painting = True
 
-        # Scehdule next polling cycle
-        self.after(self.polling_interval__ms, self.next_frame)
+        # Scehdule next polling cycle. If a frame could not be painted
+        # within the time budget, continue as soon as Tk is idle.
+        # When notified of frame arrival, nothing is scheduled until
+        # the next frame arrives.
+        if painting:
+            self.after(1, self.next_frame)
+        elif self.notifier:
+            self.frame_scheduled = False
+        else:
+            self.after(self.polling_interval__ms, self.next_frame)
 
-def run_led_window(num_pixels):
-    test_frame = LEDTestFrame(num_pixels)
+def run_led_window(led_strings, renderer="canvas", polling_interval_ms=20, max_fps=60):
+    test_frame = LEDTestFrame(led_strings, polling_interval_ms=polling_interval_ms, renderer=renderer,
+                              max_fps=max_fps)
     test_frame.mainloop()
-    print("LED window closed")
\ No newline at end of file
+    print("LED window closed")
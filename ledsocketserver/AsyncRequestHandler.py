@@ -0,0 +1,385 @@
+# coding: utf-8
+#
+# AtHomeSocketServer
+# Copyright © 2016, 2018  Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# See the LICENSE file for more details.
+#
+
+import asyncio
+import time
+from struct import unpack, pack
+from led_stats import LEDStats
+from .TCPRequestHandler import TCPRequestHandler
+from .FrameDecoder import FrameDecoder
+from .FrameValidator import FrameValidator
+from .VariableFrame import VariableFrame
+
+
+class AsyncRequestHandler:
+    """
+    The asyncio counterpart of TCPRequestHandler. One coroutine runs
+    for each connection instead of one thread.
+
+    The framing (4 byte frame size followed by an APA102 frame) and the
+    injected command handler class and frame size are the same ones
+    TCPRequestHandler uses, so both servers behave identically.
+
+    Note that the command handler runs on the event loop. If it blocks
+    (for example, the frame queue is full and its policy is block)
+    every connection waits. That is the backpressure.
+    """
+
+    @staticmethod
+    async def handle_connection(reader, writer):
+        # Resynchronizing can read past a frame. Those bytes are read again.
+        reader = PendingStreamReader(reader)
+        client_address = writer.get_extra_info("peername")
+        print("Connection from {0}".format(client_address[0]))
+
+        port = writer.get_extra_info("sockname")[1]
+        frame_size = TCPRequestHandler.frame_size_for_port(port)
+        stats = LEDStats.open_connection(client_address[0])
+        handler = None
+        if TCPRequestHandler.command_handler_class:
+            # Create an instance of the command handler for this connection
+            handler = TCPRequestHandler.command_handler_class()
+            # Give the command handler access to the connection's counters
+            if hasattr(handler, "connection_stats"):
+                handler.connection_stats = stats
+
+        # The connection's latest frame. Encoded frames are decoded into a copy of it.
+        frame_buffer = FrameDecoder.new_frame_buffer(frame_size)
+        # Frames of other sizes are fitted into it
+        variable = None
+        if TCPRequestHandler.max_frame_size:
+            variable = VariableFrameState(frame_size)
+        try:
+            # Do until the client closes the connection
+            while True:
+                client_frame_size = await AsyncRequestHandler.read_frame_size(reader)
+                if client_frame_size is None:
+                    break
+                if client_frame_size == TCPRequestHandler.BATCH_MESSAGE:
+                    if not await AsyncRequestHandler.handle_batch(reader, stats, frame_size, handler, port):
+                        break
+                    continue
+
+                if client_frame_size in (FrameDecoder.DELTA_FRAME, FrameDecoder.RLE_FRAME):
+                    if not isinstance(frame_buffer, bytearray):
+                        frame_buffer = bytearray(frame_buffer)
+                    led_data = await AsyncRequestHandler.read_encoded_frame(reader, stats, frame_size,
+                                                                            client_frame_size, frame_buffer)
+                elif (client_frame_size != frame_size and
+                      TCPRequestHandler.variable_frame_size_ok(client_frame_size)):
+                    if not isinstance(frame_buffer, bytearray):
+                        frame_buffer = bytearray(frame_buffer)
+                    led_data = await AsyncRequestHandler.read_variable_frame(reader, stats, frame_size,
+                                                                             client_frame_size, frame_buffer,
+                                                                             variable)
+                    if led_data is not None and len(led_data) == 0:
+                        # An invalid frame was dropped
+                        continue
+                    if led_data:
+                        # A frame found by resynchronizing is not in the frame buffer
+                        frame_buffer = led_data
+                else:
+                    led_data = await AsyncRequestHandler.read_led_data(reader, stats, frame_size, client_frame_size)
+                    if led_data is not None and len(led_data) == 0:
+                        # An invalid frame was dropped
+                        continue
+                    # Kept without copying in case the next frame is a delta
+                    frame_buffer = led_data
+                if not led_data:
+                    # We consider this an error, so we force close the socket
+                    break
+
+                try:
+                    if handler:
+                        # Pass the LED data to the command handler
+                        response = handler.execute_command(port, led_data)
+                except Exception as ex:
+                    LEDStats.frame_rejected(stats)
+                    print("Exception occurred while handling LED data")
+                    print(str(ex))
+                    print(led_data)
+
+                TCPRequestHandler.next_call_sequence()
+        except asyncio.CancelledError:
+            # The server is shutting down
+            pass
+        finally:
+            LEDStats.close_connection(stats)
+            writer.close()
+            print("Connection closed")
+
+    @staticmethod
+    async def read_frame_size(reader):
+        """
+        Read the frame size (or extended message selector) that starts every message
+        :param reader: The connection's PendingStreamReader
+        :return: Returns the frame size or None
+        """
+        try:
+            client_frame_size = await reader.readexactly(4)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            print("Unable to read client frame size")
+            return None
+        # Note that the result of unpack is a tuple with one value
+        return unpack('!i', client_frame_size)[0]
+
+    @staticmethod
+    async def read_led_data(reader, stats, frame_size, client_frame_size):
+        """
+        Read a stream of LED data from a stream reader
+        :param reader: The connection's PendingStreamReader
+        :param stats: The connection's ConnectionStats
+        :param frame_size: Complete LED data frame size expected on the connection
+        :param client_frame_size: The frame size sent by the client
+        :return: Returns the frame as bytes or None
+        """
+        if client_frame_size != frame_size:
+            LEDStats.frame_rejected(stats)
+            if TCPRequestHandler.strict_frames:
+                LEDStats.frame_invalid(stats, FrameValidator.BAD_SIZE)
+                return await AsyncRequestHandler.resync(reader, stats, frame_size, pack("!i", client_frame_size))
+            print("Client frame size does not match configured number of pixels")
+            return None
+
+        start = time.perf_counter()
+        try:
+            led_data = await reader.readexactly(frame_size)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            print("Failed to receive complete frame")
+            return None
+        LEDStats.frame_received(stats, 4 + len(led_data), time.perf_counter() - start)
+
+        if TCPRequestHandler.strict_frames:
+            reason = FrameValidator.check(led_data)
+            if reason is not None:
+                LEDStats.frame_rejected(stats)
+                LEDStats.frame_invalid(stats, reason)
+                if reason == FrameValidator.BAD_START_BITS:
+                    # The frame is intact but its pixel data is not
+                    return b""
+                # The stream is out of step
+                return await AsyncRequestHandler.resync(reader, stats, frame_size, pack("!i", frame_size) + led_data)
+        return led_data
+
+    @staticmethod
+    async def read_variable_frame(reader, stats, frame_size, client_frame_size, frame_buffer, variable):
+        """
+        Read a frame whose size differs from the LED string's frame size
+        and fit it into the connection's frame buffer
+        :param reader: The connection's PendingStreamReader
+        :param stats: The connection's ConnectionStats
+        :param frame_size: Complete LED data frame size expected on the connection
+        :param client_frame_size: The frame size sent by the client
+        :param frame_buffer: bytearray holding the connection's latest frame
+        :param variable: The connection's VariableFrameState
+        :return: Returns the fitted frame (frame_buffer), b"" if it was dropped or None
+        """
+        start = time.perf_counter()
+        try:
+            received = await reader.readexactly(client_frame_size)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            print("Failed to receive complete frame")
+            return None
+        LEDStats.frame_received(stats, 4 + client_frame_size, time.perf_counter() - start)
+
+        num_pixels = VariableFrame.pixel_count(received, client_frame_size)
+        if num_pixels is None:
+            LEDStats.frame_rejected(stats)
+            if TCPRequestHandler.strict_frames:
+                LEDStats.frame_invalid(stats, FrameValidator.BAD_TRAILER)
+                return await AsyncRequestHandler.resync(reader, stats, frame_size,
+                                                        pack("!i", client_frame_size) + received)
+            print("Client frame does not end with an end frame")
+            return b""
+        if num_pixels != variable.client_pixels:
+            print("Client frames have {0} pixels, the LED string has {1}".format(
+                num_pixels, (frame_size - 8) // 4))
+            variable.client_pixels = num_pixels
+        VariableFrame.fit(received, num_pixels, frame_buffer, variable.padding)
+
+        if TCPRequestHandler.strict_frames:
+            reason = FrameValidator.check(frame_buffer)
+            if reason is not None:
+                LEDStats.frame_rejected(stats)
+                LEDStats.frame_invalid(stats, reason)
+                if reason == FrameValidator.BAD_START_BITS:
+                    return b""
+                return await AsyncRequestHandler.resync(reader, stats, frame_size,
+                                                        pack("!i", client_frame_size) + received)
+        return frame_buffer
+
+    @staticmethod
+    async def resync(reader, stats, frame_size, received):
+        """
+        Find the next raw frame in the stream after a bad one (strict mode).
+        See TCPRequestHandler.resync.
+        :param reader: The connection's PendingStreamReader
+        :param stats: The connection's ConnectionStats
+        :param frame_size: Complete LED data frame size expected on the connection
+        :param received: The bytes received since the last good message
+        :return: Returns the next valid frame, b"" if it was dropped or None if the connection broke
+        """
+        marker = FrameValidator.sync_marker(frame_size)
+        read_size = FrameValidator.resync_read_size(frame_size)
+        buffer = bytes(received)
+        # The bad message itself does not start the next one
+        search_start = 1
+        discarded = 0
+        while True:
+            i = buffer.find(marker, search_start)
+            if i < 0:
+                # Keep what could be the start of a marker
+                keep = min(len(buffer), len(marker) - 1)
+                discarded += len(buffer) - keep
+                buffer = buffer[len(buffer) - keep:]
+                search_start = 0
+                try:
+                    data = await reader.read(read_size)
+                except ConnectionError:
+                    data = None
+                if not data:
+                    print("Connection closed while resynchronizing")
+                    return None
+                buffer += data
+                continue
+
+            discarded += i
+            # Whatever follows the frame size is the start of the frame,
+            # and anything past the frame is the start of the next message
+            start = buffer[i + 4:i + 4 + frame_size]
+            reader.pending = buffer[i + 4 + frame_size:] + reader.pending
+            try:
+                led_data = start + await reader.readexactly(frame_size - len(start))
+            except (asyncio.IncompleteReadError, ConnectionError):
+                print("Failed to receive complete frame")
+                return None
+            LEDStats.frame_received(stats, 4 + len(led_data), 0.0)
+
+            reason = FrameValidator.check(led_data)
+            if reason != FrameValidator.BAD_TRAILER:
+                LEDStats.resynced(stats, discarded)
+                print("Resynchronized after discarding {0} bytes".format(discarded))
+                if reason is None:
+                    return led_data
+                LEDStats.frame_rejected(stats)
+                LEDStats.frame_invalid(stats, reason)
+                return b""
+            # The marker was in corrupt data. Keep searching after it.
+            LEDStats.frame_rejected(stats)
+            LEDStats.frame_invalid(stats, reason)
+            buffer = buffer[i:i + 4] + led_data
+            search_start = 1
+
+    @staticmethod
+    async def read_encoded_frame(reader, stats, frame_size, encoding, frame_buffer):
+        """
+        Read a delta or run length encoded frame and decode it
+        :param reader: The connection's PendingStreamReader
+        :param stats: The connection's ConnectionStats
+        :param frame_size: Complete LED data frame size expected on the connection
+        :param encoding: FrameDecoder.DELTA_FRAME or FrameDecoder.RLE_FRAME
+        :param frame_buffer: bytearray holding the connection's latest frame
+        :return: Returns the decoded frame (frame_buffer) or None
+        """
+        try:
+            header = await reader.readexactly(FrameDecoder.encoded_header.size)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            print("Failed to receive encoded frame header")
+            return None
+        entries_size = FrameDecoder.parse_header(header, frame_size)
+        if entries_size is None:
+            LEDStats.frame_rejected(stats)
+            return None
+
+        start = time.perf_counter()
+        try:
+            entries = await reader.readexactly(entries_size)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            print("Failed to receive complete encoded frame")
+            return None
+        if not FrameDecoder.decode(encoding, frame_buffer, entries):
+            LEDStats.frame_rejected(stats)
+            return None
+        LEDStats.frame_received(stats, 4 + len(header) + entries_size, time.perf_counter() - start)
+        return frame_buffer
+
+    @staticmethod
+    async def handle_batch(reader, stats, frame_size, handler, port):
+        """
+        Receive a batch message (see TCPRequestHandler). Everything after
+        the batch header is received with one read.
+        :return: Returns False if the connection should be closed
+        """
+        try:
+            header = await reader.readexactly(TCPRequestHandler.batch_header.size)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            print("Failed to receive batch header")
+            return False
+        batch = TCPRequestHandler.parse_batch_header(header, frame_size)
+        if batch is None:
+            LEDStats.frame_rejected(stats)
+            return False
+        frame_count, timestamps_size, frames_size = batch
+
+        start = time.perf_counter()
+        try:
+            batch_data = await reader.readexactly(timestamps_size + frames_size)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            print("Failed to receive complete batch")
+            return False
+        LEDStats.frame_received(stats, 4 + len(header) + len(batch_data), time.perf_counter() - start,
+                                frames=frame_count)
+        try:
+            if handler:
+                TCPRequestHandler.execute_batch(handler, port, memoryview(batch_data), frame_count, timestamps_size)
+        except Exception as ex:
+            LEDStats.frame_rejected(stats)
+            print("Exception occurred while handling LED data batch")
+            print(str(ex))
+        TCPRequestHandler.next_call_sequence(frame_count)
+        return True
+
+
+class VariableFrameState:
+    """
+    What a connection keeps for fitting frames of other sizes
+    """
+    def __init__(self, frame_size):
+        self.padding = memoryview(VariableFrame.off_pixel * ((frame_size - 8) // 4))
+        # Pixel count of the client's latest frame
+        self.client_pixels = None
+
+
+class PendingStreamReader:
+    """
+    A connection's asyncio.StreamReader. Bytes read past a frame while
+    resynchronizing start the next message, so every read takes them first.
+    """
+    def __init__(self, reader):
+        self.reader = reader
+        self.pending = b""
+
+    async def readexactly(self, n):
+        if not self.pending:
+            return await self.reader.readexactly(n)
+        data = self.pending[0:n]
+        self.pending = self.pending[n:]
+        if len(data) < n:
+            data += await self.reader.readexactly(n - len(data))
+        return data
+
+    async def read(self, n):
+        if not self.pending:
+            return await self.reader.read(n)
+        data = self.pending[0:n]
+        self.pending = self.pending[n:]
+        return data
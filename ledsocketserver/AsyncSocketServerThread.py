@@ -0,0 +1,105 @@
+# coding: utf-8
+#
+# AtHomeSocketServer
+# Copyright © 2016, 2018  Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# See the LICENSE file for more details.
+#
+
+#
+# asyncio socket server running its event loop on its own thread.
+# This is a drop in replacement for SocketServerThread that serves
+# every connection from a single thread.
+#
+
+import asyncio
+import threading
+from .TCPRequestHandler import TCPRequestHandler
+from .AsyncRequestHandler import AsyncRequestHandler
+
+# This class should be used as a singleton
+class AsyncSocketServerThread:
+    # Pending connection queue size. Sized for hundreds of clients.
+    backlog = 512
+
+    # Constructor of an instance to serve a given host:port
+    def __init__(self, host, port, handler, connection_time_out=-1, frame_size=None):
+        self.host = host
+        self.port = port
+        self.server_thread = threading.Thread(target=self.RunServer)
+        # Inject the command handler class into the request handler
+        TCPRequestHandler.set_command_handler_class(handler, connection_time_out=connection_time_out)
+        # Inject LED data frame size for this port
+        if frame_size:
+            TCPRequestHandler.set_frame_size(frame_size, port=port)
+
+        self.loop = None
+        self.stop_event = None
+        # Open connections (task: writer), closed when the server stops
+        self.connections = {}
+        self.started = threading.Event()
+        self.start_error = None
+
+    # Start the server on its own thread
+    def Start(self):
+        self.server_thread.start()
+        # Wait until the server is listening (or failed to)
+        self.started.wait()
+        if self.start_error:
+            raise self.start_error
+
+    # Stop the server thread
+    def Stop(self):
+        print("Shutting down asyncio server thread")
+        if self.loop and self.stop_event and self.server_thread.is_alive():
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+        self.server_thread.join()
+        print("asyncio server thread down")
+
+    # Run the event loop on a new thread
+    def RunServer(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        try:
+            # The stream reader buffer only needs to hold about one frame
+            server = await asyncio.start_server(self.handle_connection,
+                                                self.host, self.port,
+                                                reuse_address=True,
+                                                backlog=AsyncSocketServerThread.backlog,
+                                                limit=max(TCPRequestHandler.frame_size_for_port(self.port), 4096))
+        except Exception as ex:
+            self.start_error = ex
+            return
+        finally:
+            self.started.set()
+
+        print("Now serving sockets at {0}:{1} (asyncio)".format(self.host, self.port))
+        async with server:
+            await self.stop_event.wait()
+            # Leaving the server context waits for open connections (3.12+)
+            await self.close_connections()
+
+    async def handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections[task] = writer
+        try:
+            await AsyncRequestHandler.handle_connection(reader, writer)
+        finally:
+            del self.connections[task]
+
+    async def close_connections(self):
+        """
+        Close every open connection and wait for its handler to finish
+        """
+        tasks = list(self.connections)
+        for task, writer in list(self.connections.items()):
+            writer.close()
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,325 @@
+# coding: utf-8
+#
+# AtHomeSocketServer
+# Copyright © 2016, 2018  Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# See the LICENSE file for more details.
+#
+
+#
+# E1.31 (sACN) and Art-Net receiver running on its own thread.
+#
+# DMX packets are gathered into pixel frames by each LED string's
+# UniverseMap. A frame is published (passed to the command handler like
+# a frame received over TCP) when
+#   - a synchronization packet (E1.31 sync or ArtSync) arrives, once the
+#     sender has been seen to use synchronization, or otherwise
+#   - every universe of the string has arrived.
+# If a universe arrives again before the others, the incomplete frame is
+# published and the missing universes are counted as lost.
+#
+# Only DMX data packets with a null start code are used. E1.31 priority
+# and multiple sources are not arbitrated.
+#
+
+import socket
+import threading
+import time
+from struct import unpack_from
+from led_stats import LEDStats
+from .UniverseMap import UniverseMap
+
+
+class DMXPacket:
+    """
+    E1.31 and Art-Net packet parsing
+    """
+    DATA = "data"
+    SYNC = "sync"
+
+    E131_PORT = 5568
+    E131_ACN_ID = b"ASC-E1.17\x00\x00\x00"
+    E131_ROOT_DATA = 0x00000004
+    E131_ROOT_EXTENDED = 0x00000008
+    E131_FRAMING_DATA = 0x00000002
+    E131_EXTENDED_SYNC = 0x00000001
+
+    ARTNET_PORT = 6454
+    ARTNET_ID = b"Art-Net\x00"
+    ARTNET_OP_DMX = 0x5000
+    ARTNET_OP_SYNC = 0x5200
+
+    @classmethod
+    def parse_e131(cls, packet, length):
+        """
+        Parse an E1.31 packet
+        :param packet: Received packet buffer
+        :param length: Number of bytes received
+        :return: Returns (DATA, universe, sequence, data start, data end, sync universe),
+        (SYNC, sync universe, sequence) or None
+        """
+        if length < 49 or packet[4:16] != cls.E131_ACN_ID:
+            return None
+        root_vector, = unpack_from("!I", packet, 18)
+        framing_vector, = unpack_from("!I", packet, 40)
+        if root_vector == cls.E131_ROOT_EXTENDED and framing_vector == cls.E131_EXTENDED_SYNC:
+            sequence, sync_universe = unpack_from("!BH", packet, 44)
+            return cls.SYNC, sync_universe, sequence
+        if root_vector != cls.E131_ROOT_DATA or framing_vector != cls.E131_FRAMING_DATA or length < 126:
+            return None
+        sync_universe, sequence, options, universe = unpack_from("!HBBH", packet, 109)
+        property_count, = unpack_from("!H", packet, 123)
+        # The first property value is the DMX start code
+        if packet[125] != 0:
+            return None
+        data_end = min(length, 125 + property_count)
+        return cls.DATA, universe, sequence, 126, data_end, sync_universe
+
+    @classmethod
+    def parse_artnet(cls, packet, length):
+        """
+        Parse an Art-Net packet
+        :param packet: Received packet buffer
+        :param length: Number of bytes received
+        :return: Returns (DATA, universe, sequence, data start, data end, 0),
+        (SYNC, 0, 0) or None
+        """
+        if length < 14 or packet[0:8] != cls.ARTNET_ID:
+            return None
+        opcode, = unpack_from("<H", packet, 8)
+        if opcode == cls.ARTNET_OP_SYNC:
+            return cls.SYNC, 0, 0
+        if opcode != cls.ARTNET_OP_DMX or length < 18:
+            return None
+        sequence, physical, sub_universe, net, data_length = unpack_from("!BBBBH", packet, 12)
+        universe = (net << 8) | sub_universe
+        return cls.DATA, universe, sequence, 18, min(length, 18 + data_length), 0
+
+
+class DMXTarget:
+    """
+    One LED string fed by the receiver
+    """
+    def __init__(self, port, universe_map, handler_class):
+        """
+        :param port: The string's TCP port. It identifies the string to the command handler.
+        :param universe_map: The string's UniverseMap
+        :param handler_class: The command handler class
+        """
+        self.port = port
+        self.universe_map = universe_map
+        self.handler = handler_class() if handler_class else None
+        # Set once a sync packet has been received for one of the string's universes
+        self.synchronized = False
+        self.sync_universe = 0
+        # Bytes of the packets gathered into the frame, and when the first one arrived
+        self.frame_bytes = 0
+        self.frame_start = 0.0
+
+
+# This class should be used as a singleton
+class DMXServerThread:
+    # Socket receive buffer size. Large enough to absorb bursts of universes.
+    receive_buffer_size = 4 * 1024 * 1024
+    # How often the server thread checks for Stop
+    poll_interval = 0.25
+
+    protocols = ["e131", "artnet"]
+
+    def __init__(self, host, port, handler, targets, protocol="e131", multicast=True):
+        """
+        :param host:
+        :param port: UDP port, usually 5568 (E1.31) or 6454 (Art-Net)
+        :param handler: The command handler class (see TCPRequestHandler)
+        :param targets: A list of (string port, UniverseMap)
+        :param protocol: e131 or artnet
+        :param multicast: Join the E1.31 multicast group of each universe
+        """
+        if protocol not in DMXServerThread.protocols:
+            raise ValueError("Unrecognized DMX protocol: {0}".format(protocol))
+        self.host = host
+        self.port = port
+        self.protocol = protocol
+        self.parse = DMXPacket.parse_e131 if protocol == "e131" else DMXPacket.parse_artnet
+        self.server_thread = threading.Thread(target=self.RunServer)
+        self.stop_event = threading.Event()
+        self.stats = LEDStats.open_connection("{0} receiver".format(protocol))
+
+        self.targets = [DMXTarget(string_port, universe_map, handler) for string_port, universe_map in targets]
+        # Universe number: targets using it
+        self.universe_targets = {}
+        for target in self.targets:
+            for universe in target.universe_map.universes():
+                self.universe_targets.setdefault(universe, []).append(target)
+        # Last sequence number of each universe
+        self.sequences = {}
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, DMXServerThread.receive_buffer_size)
+        except OSError:
+            pass
+        self.sock.settimeout(DMXServerThread.poll_interval)
+        self.sock.bind((host, port))
+        if protocol == "e131" and multicast:
+            self.join_multicast_groups()
+
+        self.buffer = bytearray(1024)
+        self.view = memoryview(self.buffer)
+
+    def join_multicast_groups(self):
+        # E1.31 universe N is multicast to 239.255.(N >> 8).(N & 0xFF)
+        for universe in self.universe_targets:
+            group = socket.inet_aton("239.255.{0}.{1}".format(universe >> 8, universe & 0xFF))
+            try:
+                self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, group + socket.inet_aton("0.0.0.0"))
+            except OSError as ex:
+                print("Unable to join multicast group for universe {0}: {1}".format(universe, str(ex)))
+
+    # Start the receiver on its own thread
+    def Start(self):
+        self.server_thread.start()
+
+    # Stop the receiver thread
+    def Stop(self):
+        print("Shutting down {0} receiver thread".format(self.protocol))
+        self.stop_event.set()
+        self.server_thread.join()
+        self.sock.close()
+        LEDStats.close_connection(self.stats)
+        print("{0} receiver thread down".format(self.protocol))
+
+    # Run the receiver on a new thread
+    def RunServer(self):
+        print("Now receiving {0} at {1}:{2}".format(self.protocol, self.host, self.port))
+        while not self.stop_event.is_set():
+            try:
+                nbytes = self.sock.recv_into(self.view)
+            except socket.timeout:
+                continue
+            except OSError as ex:
+                if not self.stop_event.is_set():
+                    print("DMX receive failed:", str(ex))
+                continue
+            packet = self.parse(self.buffer, nbytes)
+            if packet is None:
+                LEDStats.frame_rejected(self.stats)
+                LEDStats.bytes_received(self.stats, nbytes)
+                continue
+            if packet[0] == DMXPacket.SYNC:
+                LEDStats.bytes_received(self.stats, nbytes)
+                self.handle_sync(packet[1])
+            else:
+                self.handle_data(nbytes, *packet[1:])
+
+    def handle_data(self, nbytes, universe, sequence, data_start, data_end, sync_universe):
+        targets = self.universe_targets.get(universe)
+        if not targets:
+            LEDStats.bytes_received(self.stats, nbytes)
+            return
+        # Discard out of order packets (E1.31 section 6.7.2). Art-Net
+        # sequence 0 means sequencing is disabled.
+        last = self.sequences.get(universe)
+        if sequence and last is not None:
+            behind = (last - sequence) & 0xFF
+            if behind < 20:
+                LEDStats.frame_stale(self.stats)
+                LEDStats.bytes_received(self.stats, nbytes)
+                return
+        self.sequences[universe] = sequence
+
+        data = self.view[data_start:data_end]
+        now = time.perf_counter()
+        for target in targets:
+            universe_map = target.universe_map
+            if sync_universe:
+                target.synchronized = True
+                target.sync_universe = sync_universe
+            if not target.synchronized and universe_map.received_universe(universe):
+                # A universe is missing from the previous frame
+                LEDStats.frames_lost(self.stats, universe_map.missing())
+                self.publish(target)
+            if not universe_map.received:
+                target.frame_start = now
+            universe_map.gather(universe, data)
+            # A packet's bytes are counted once, in the first string's frame
+            target.frame_bytes += nbytes
+            nbytes = 0
+            if not target.synchronized and universe_map.complete():
+                self.publish(target)
+
+    def handle_sync(self, sync_universe):
+        for target in self.targets:
+            if self.protocol == "e131" and sync_universe != target.sync_universe:
+                continue
+            target.synchronized = True
+            if target.universe_map.received:
+                if not target.universe_map.complete():
+                    LEDStats.frames_lost(self.stats, target.universe_map.missing())
+                self.publish(target)
+
+    def publish(self, target):
+        led_data = target.universe_map.publish()
+        # The receive time runs from the frame's first universe to its publication
+        LEDStats.frame_received(self.stats, target.frame_bytes, time.perf_counter() - target.frame_start)
+        target.frame_bytes = 0
+        if target.handler:
+            try:
+                target.handler.execute_command(target.port, led_data)
+            except Exception as ex:
+                LEDStats.frame_rejected(self.stats)
+                print("Exception occurred while handling LED data")
+                print(str(ex))
+
+
+def dmx_endpoint(dmx):
+    """
+    :param dmx: A LED string's dmx configuration (see create_dmx_servers)
+    :return: Returns a tuple (protocol, port) of the receiver it needs
+    """
+    protocol = str(dmx.get("protocol", "e131")).lower()
+    default_port = DMXPacket.E131_PORT if protocol == "e131" else DMXPacket.ARTNET_PORT
+    return protocol, int(dmx.get("port", default_port))
+
+
+def create_dmx_servers(host, led_strings, handler):
+    """
+    Create a receiver for each protocol and port used by the LED strings
+    :param host:
+    :param led_strings: LEDString instances. Strings whose dmx configuration
+    is None are not included.
+    A dmx configuration is a dict with the keys
+      protocol              "e131" (default) or "artnet"
+      port                  default 5568 (e131) or 6454 (artnet)
+      universe              first universe, default 1 (e131) or 0 (artnet)
+      channels_per_universe default 510
+      universes             explicit universe map (see UniverseMap)
+      multicast             join E1.31 multicast groups, default true
+    :param handler: The command handler class
+    :return: Returns a list of DMXServerThread
+    """
+    groups = {}
+    for led_string in led_strings:
+        dmx = led_string.dmx
+        if not dmx:
+            continue
+        protocol, port = dmx_endpoint(dmx)
+        default_universe = 1 if protocol == "e131" else 0
+        universe_map = UniverseMap(led_string.num_pixels,
+                                   first_universe=int(dmx.get("universe", default_universe)),
+                                   channels_per_universe=int(dmx.get("channels_per_universe", 510)),
+                                   universes=dmx.get("universes"))
+        group = groups.setdefault((protocol, port), {"targets": [], "multicast": True})
+        group["targets"].append((led_string.port, universe_map))
+        group["multicast"] = group["multicast"] and bool(dmx.get("multicast", True))
+
+    servers = []
+    for (protocol, port), group in groups.items():
+        servers.append(DMXServerThread(host, port, handler, group["targets"], protocol=protocol,
+                                       multicast=group["multicast"]))
+    return servers
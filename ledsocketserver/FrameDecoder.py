@@ -0,0 +1,148 @@
+# coding: utf-8
+#
+# AtHomeSocketServer
+# Copyright © 2016, 2018  Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# See the LICENSE file for more details.
+#
+
+#
+# Compressed frame encodings. Like a batch, an encoded frame is selected
+# by a negative frame size.
+#
+# Delta (-2): the pixels that changed since the previous frame on the connection
+#   pixel count  uint32 must match the LED string
+#   entry count  uint32
+#   entries      entry count of (index uint16, brightness, r, g, b)
+#
+# Run length (-3): runs of identical pixels
+#   pixel count  uint32 must match the LED string
+#   run count    uint32
+#   runs         run count of (length uint16, brightness, r, g, b)
+#                The run lengths must add up to the pixel count.
+#
+# All values are in network byte order. A frame is decoded into the
+# connection's frame buffer, which always holds a complete APA102 frame
+# (header, pixels, trailer). A delta is applied to whatever frame the
+# buffer holds, so it may follow a raw, delta or run length frame.
+# Before the first frame every pixel is off.
+#
+
+from struct import Struct, iter_unpack
+# NumPy is optional. When it is available it is used for bulk operations.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class FrameDecoder:
+    DELTA_FRAME = -2
+    RLE_FRAME = -3
+    encoded_header = Struct("!II")
+    # Size of a delta entry or a run
+    entry_size = 6
+    if numpy is not None:
+        entry_dtype = numpy.dtype([("n", ">u2"), ("pixel", numpy.uint8, (4,))])
+
+    @staticmethod
+    def new_frame_buffer(frame_size):
+        """
+        Create a frame buffer holding an all off frame
+        :param frame_size: Complete LED data frame size
+        :return: Returns a bytearray
+        """
+        frame_buffer = bytearray(frame_size)
+        frame_buffer[-4:] = b"\xff\xff\xff\xff"
+        return frame_buffer
+
+    @classmethod
+    def parse_header(cls, header, frame_size):
+        """
+        Check an encoded frame header
+        :param header: The encoded frame header bytes
+        :param frame_size: Complete LED data frame size expected on the connection
+        :return: Returns the size of the entries or runs that follow,
+        or None if the frame is not acceptable
+        """
+        pixel_count, entry_count = cls.encoded_header.unpack_from(header)
+        if (pixel_count * 4) + 8 != frame_size:
+            print("Encoded frame pixel count does not match configured number of pixels")
+            return None
+        if entry_count > pixel_count:
+            print("Encoded frame has too many entries")
+            return None
+        return entry_count * cls.entry_size
+
+    @classmethod
+    def decode(cls, encoding, frame_buffer, entries):
+        """
+        Decode a frame into a frame buffer
+        :param encoding: DELTA_FRAME or RLE_FRAME
+        :param frame_buffer: bytearray holding a complete frame
+        :param entries: The entries (delta) or runs (RLE) of the frame
+        :return: Returns True if the frame was decoded
+        """
+        if encoding == cls.DELTA_FRAME:
+            return cls.apply_delta(frame_buffer, entries)
+        return cls.apply_rle(frame_buffer, entries)
+
+    @classmethod
+    def apply_delta(cls, frame_buffer, entries):
+        """
+        Update the changed pixels of a frame
+        :param frame_buffer: bytearray holding a complete frame
+        :param entries: (index, pixel) entries
+        :return: Returns False if an index is out of range
+        """
+        num_pixels = (len(frame_buffer) - 8) // 4
+        if numpy is not None:
+            delta = numpy.frombuffer(entries, dtype=cls.entry_dtype)
+            indexes = delta["n"]
+            if len(indexes) and int(indexes.max()) >= num_pixels:
+                print("Delta pixel index out of range")
+                return False
+            # Pixels are copied 4 bytes at a time
+            pixels = numpy.frombuffer(frame_buffer, dtype=numpy.uint32, count=num_pixels, offset=4)
+            pixels[indexes] = numpy.ascontiguousarray(delta["pixel"]).view(numpy.uint32).reshape(-1)
+            return True
+
+        for index, pixel in iter_unpack("!H4s", entries):
+            if index >= num_pixels:
+                print("Delta pixel index out of range")
+                return False
+            offset = 4 + (index * 4)
+            frame_buffer[offset:offset + 4] = pixel
+        return True
+
+    @classmethod
+    def apply_rle(cls, frame_buffer, runs):
+        """
+        Replace the pixels of a frame with runs of pixels
+        :param frame_buffer: bytearray holding a complete frame
+        :param runs: (length, pixel) runs
+        :return: Returns False if the runs do not cover the frame exactly
+        """
+        num_pixels = (len(frame_buffer) - 8) // 4
+        if numpy is not None:
+            rle = numpy.frombuffer(runs, dtype=cls.entry_dtype)
+            lengths = rle["n"]
+            if int(lengths.sum()) != num_pixels:
+                print("Run lengths do not match the number of pixels")
+                return False
+            values = numpy.ascontiguousarray(rle["pixel"]).view(numpy.uint32).reshape(-1)
+            pixels = numpy.frombuffer(frame_buffer, dtype=numpy.uint32, count=num_pixels, offset=4)
+            pixels[:] = numpy.repeat(values, lengths)
+            return True
+
+        # Each run is expanded by bytes repetition
+        body = b"".join([pixel * length for length, pixel in iter_unpack("!H4s", runs)])
+        if len(body) != num_pixels * 4:
+            print("Run lengths do not match the number of pixels")
+            return False
+        frame_buffer[4:4 + len(body)] = body
+        return True
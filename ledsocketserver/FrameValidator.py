@@ -0,0 +1,78 @@
+# coding: utf-8
+#
+# AtHomeSocketServer
+# Copyright © 2016, 2018  Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# See the LICENSE file for more details.
+#
+
+#
+# Strict APA102 frame checking. A frame is
+#   header   4 bytes of 0x00
+#   pixels   4 bytes each, the first being 111xxxxx (start bits + brightness)
+#   trailer  4 bytes of 0xFF
+#
+# Every check is a bulk bytes operation; no Python code runs per pixel.
+#
+# When a stream goes wrong (a bad frame size, header or trailer) the
+# socket servers look for the next message by searching the stream for
+# the frame size followed by the 4 byte header. Inside valid pixel data
+# every 4th byte is at least 0xE0, so that pattern (which has 4 zero
+# bytes in a row) can only start at a real message boundary or in
+# corrupt data.
+#
+
+from struct import pack
+
+
+class FrameValidator:
+    # Classification of bad frames
+    BAD_SIZE = "size"
+    BAD_HEADER = "header"
+    BAD_TRAILER = "trailer"
+    BAD_START_BITS = "start_bits"
+    reasons = [BAD_SIZE, BAD_HEADER, BAD_TRAILER, BAD_START_BITS]
+
+    header = b"\x00\x00\x00\x00"
+    trailer = b"\xff\xff\xff\xff"
+    # Brightness bytes with the start bits set. Deleting them from the
+    # brightness bytes leaves only the bad ones.
+    valid_brightness = bytes(range(0xE0, 0x100))
+
+    @classmethod
+    def check(cls, frame):
+        """
+        Check a complete frame
+        :param frame: bytes-like APA102 frame (header, pixels, trailer)
+        :return: Returns None if the frame is valid, otherwise the reason it is not
+        """
+        if frame[0:4] != cls.header:
+            return cls.BAD_HEADER
+        if frame[-4:] != cls.trailer:
+            return cls.BAD_TRAILER
+        if bytes(frame[4:-4:4]).translate(None, cls.valid_brightness):
+            return cls.BAD_START_BITS
+        return None
+
+    @staticmethod
+    def sync_marker(frame_size):
+        """
+        :param frame_size: Complete LED data frame size expected on the connection
+        :return: Returns the bytes that start a raw frame message
+        """
+        return pack("!i", frame_size) + FrameValidator.header
+
+    @staticmethod
+    def resync_read_size(frame_size):
+        """
+        How much to read at a time while searching for a message. Less
+        than a message, so a read never goes past the end of the message
+        whose start it finds.
+        :param frame_size:
+        :return: Returns a number of bytes
+        """
+        return max(1, frame_size - 3)
@@ -28,9 +28,9 @@ class SocketServerThread:
         ThreadedTCPServer.allow_reuse_address = True
         # Inject the command handler class into the request handler
         TCPRequestHandler.set_command_handler_class(handler, connection_time_out=connection_time_out)
-        # Inject LED data frame size
+        # Inject LED data frame size for this port
         if frame_size:
-            TCPRequestHandler.set_frame_size(frame_size)
+            TCPRequestHandler.set_frame_size(frame_size, port=port)
 
         self.server = ThreadedTCPServer((host, port), TCPRequestHandler)
 
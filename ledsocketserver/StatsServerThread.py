@@ -0,0 +1,67 @@
+# coding: utf-8
+#
+# AtHomeSocketServer
+# Copyright © 2016, 2018  Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# See the LICENSE file for more details.
+#
+
+#
+# Statistics server running on its own thread.
+# A client connects and receives one line of JSON, then the
+# connection is closed. For example:
+#   nc localhost 5560
+#
+
+import json
+import threading
+try:
+    import socketserver as socketserver
+except ImportError:
+    import SocketServer as socketserver
+from .ThreadedTCPServer import ThreadedTCPServer
+
+
+class StatsRequestHandler(socketserver.BaseRequestHandler):
+    # The snapshot callable is injected by StatsServerThread
+    snapshot = None
+
+    def handle(self):
+        response = json.dumps(StatsRequestHandler.snapshot()) + "\n"
+        self.request.sendall(response.encode("utf-8"))
+
+
+# This class should be used as a singleton
+class StatsServerThread:
+    # Constructor of an instance to serve a given host:port
+    def __init__(self, host, port, snapshot):
+        """
+        :param host:
+        :param port:
+        :param snapshot: A callable that returns the statistics as a JSON serializable dict
+        """
+        self.host = host
+        self.port = port
+        self.server_thread = threading.Thread(target=self.RunServer)
+        ThreadedTCPServer.allow_reuse_address = True
+        StatsRequestHandler.snapshot = snapshot
+        self.server = ThreadedTCPServer((host, port), StatsRequestHandler)
+
+    # Start the stats server on its own thread
+    def Start(self):
+        self.server_thread.start()
+
+    # Stop the stats server thread
+    def Stop(self):
+        self.server.shutdown()
+        self.server_thread.join()
+        self.server.server_close()
+
+    # Run the stats server on a new thread
+    def RunServer(self):
+        print("Now serving statistics at {0}:{1}".format(self.host, self.port))
+        self.server.serve_forever()
@@ -12,11 +12,17 @@
 
 
 import sys
+import time
+from threading import Lock
 try:
     import socketserver as socketserver
 except ImportError:
     import SocketServer as socketserver
-from struct import unpack
+from struct import unpack_from, Struct
+from led_stats import LEDStats
+from .FrameDecoder import FrameDecoder
+from .FrameValidator import FrameValidator
+from .VariableFrame import VariableFrame
 
 
 class TCPRequestHandler(socketserver.BaseRequestHandler):
@@ -29,6 +35,7 @@ class TCPRequestHandler(socketserver.BaseRequestHandler):
     """
 
     call_sequence = 1
+    call_sequence_lock = Lock()
 
     # The command_handler_class is injected by the user of this class
     # See dmx_client.py for an example implementation.
@@ -36,15 +43,133 @@ class TCPRequestHandler(socketserver.BaseRequestHandler):
 
     # Default size of a complete LED data frame for 50 pixels
     frame_size = 8 + (50 * 4)
+    # Frame sizes for ports serving different size LED strings
+    port_frame_sizes = {}
+    # Check the header, trailer and pixel start bits of raw frames and
+    # resynchronize instead of closing the connection (see FrameValidator)
+    strict_frames = False
+    # Largest frame accepted when its size differs from the string's
+    # frame size (0 = only the exact frame size). See VariableFrame.
+    max_frame_size = 0
+
+    # Extended messages. A client normally sends a frame size followed by
+    # a frame. A negative frame size selects a different message type.
+    #
+    # Batch (-1): several frames in one message
+    #   frame count  uint16
+    #   flags        uint8  bit 0: per frame timestamps follow the header
+    #   reserved     uint8
+    #   pixel count  uint32 must match the LED string
+    #   timestamps   frame count float64 values (seconds), if flagged
+    #   frames       frame count complete APA102 frames, back to back
+    # All values are in network byte order.
+    BATCH_MESSAGE = -1
+    batch_header = Struct("!HBxI")
+    BATCH_TIMESTAMPS = 0x01
+    # Largest number of frames accepted in one batch
+    max_batch_frames = 1024
+    #
+    # Delta (-2) and run length (-3) encoded frames: see FrameDecoder
 
     @classmethod
-    def set_frame_size(cls, frame_size):
+    def set_frame_size(cls, frame_size, port=None):
         """
         Complete LED data frame size injection
         :param frame_size:
+        :param port: If given, the frame size only applies to this port
+        :return:
+        """
+        if port is None:
+            cls.frame_size = frame_size
+        else:
+            cls.port_frame_sizes[port] = frame_size
+
+    @classmethod
+    def set_strict_frames(cls, strict_frames):
+        """
+        Strict frame checking injection
+        :param strict_frames: True to check raw frames
+        :return:
+        """
+        cls.strict_frames = strict_frames
+
+    @classmethod
+    def set_max_frame_size(cls, max_frame_size):
+        """
+        Variable frame size injection
+        :param max_frame_size: Largest frame accepted, 0 to only accept the exact frame size
         :return:
         """
-        cls.frame_size = frame_size
+        cls.max_frame_size = max_frame_size
+
+    @classmethod
+    def variable_frame_size_ok(cls, client_frame_size):
+        """
+        :param client_frame_size: The frame size sent by the client
+        :return: Returns True if a frame of that size is fitted to the LED string
+        """
+        return VariableFrame.min_frame_size <= client_frame_size <= cls.max_frame_size
+
+    @classmethod
+    def frame_size_for_port(cls, port):
+        """
+        :param port: Local port number of a connection
+        :return: Returns the complete LED data frame size expected on the port
+        """
+        return cls.port_frame_sizes.get(port, cls.frame_size)
+
+    @classmethod
+    def next_call_sequence(cls, count=1):
+        """
+        Count handled frames. Called from every connection thread.
+        :param count: Number of frames handled
+        :return: Returns the new call sequence
+        """
+        with cls.call_sequence_lock:
+            cls.call_sequence += count
+            return cls.call_sequence
+
+    @classmethod
+    def parse_batch_header(cls, header, frame_size):
+        """
+        Check a batch message header
+        :param header: The batch header bytes
+        :param frame_size: Complete LED data frame size expected on the connection
+        :return: Returns a tuple (frame_count, timestamps_size, frames_size)
+        or None if the batch is not acceptable
+        """
+        frame_count, flags, pixel_count = cls.batch_header.unpack_from(header)
+        if (pixel_count * 4) + 8 != frame_size:
+            print("Batch pixel count does not match configured number of pixels")
+            return None
+        if frame_count < 1 or frame_count > cls.max_batch_frames:
+            print("Batch frame count {0} is out of range".format(frame_count))
+            return None
+        timestamps_size = (frame_count * 8) if flags & cls.BATCH_TIMESTAMPS else 0
+        return frame_count, timestamps_size, frame_count * frame_size
+
+    @classmethod
+    def execute_batch(cls, handler, port, batch_data, frame_count, timestamps_size):
+        """
+        Pass a received batch to the command handler. A handler without an
+        execute_batch method is given the frames one at a time.
+        :param handler: The connection's command handler
+        :param port: Local port number of the connection
+        :param batch_data: The timestamps followed by the frames
+        :param frame_count:
+        :param timestamps_size: Size of the timestamps in bytes (0 if none)
+        :return: None
+        """
+        timestamps = None
+        if timestamps_size:
+            timestamps = unpack_from("!{0}d".format(frame_count), batch_data, 0)
+        frames = batch_data[timestamps_size:]
+        if hasattr(handler, "execute_batch"):
+            handler.execute_batch(port, frames, frame_count, timestamps=timestamps)
+        else:
+            frame_size = len(frames) // frame_count
+            for i in range(frame_count):
+                handler.execute_command(port, frames[i * frame_size:(i + 1) * frame_size])
 
     @classmethod
     def set_command_handler_class(cls, command_handler_to_use, connection_time_out=-1):
@@ -62,84 +187,352 @@ class TCPRequestHandler(socketserver.BaseRequestHandler):
     This handler uses raw data from the SocketServer.TCPServer class.
     """
 
+    def setup(self):
+        """
+        Allocate the per connection receive buffers. Frames are received
+        directly into these buffers, so no memory is allocated per frame.
+        """
+        self.port = self.request.getsockname()[1]
+        self.frame_size = TCPRequestHandler.frame_size_for_port(self.port)
+        self.size_buffer = bytearray(4)
+        self.size_view = memoryview(self.size_buffer)
+        # The frame buffer always holds the connection's latest frame.
+        # Encoded frames are decoded into it.
+        self.frame_buffer = FrameDecoder.new_frame_buffer(self.frame_size)
+        self.frame_view = memoryview(self.frame_buffer)
+        # What the command handler sees. It is only valid until the next frame is read.
+        self.led_data_view = self.frame_view.toreadonly()
+        self.stats = LEDStats.open_connection(self.client_address[0])
+        # Batch messages are received into a buffer that grows as needed
+        self.batch_header_buffer = bytearray(TCPRequestHandler.batch_header.size)
+        self.batch_buffer = bytearray()
+        self.encoded_header_buffer = bytearray(FrameDecoder.encoded_header.size)
+        self.entries_buffer = bytearray()
+        # Bytes read past a frame while resynchronizing. They start the
+        # next message, so every read takes them first.
+        self.pending = b""
+        # Frames of other sizes are received into a buffer of the largest
+        # size accepted and then fitted into the frame buffer
+        self.variable_view = None
+        if TCPRequestHandler.max_frame_size:
+            self.variable_buffer = bytearray(TCPRequestHandler.max_frame_size)
+            self.variable_view = memoryview(self.variable_buffer)
+            self.padding = memoryview(VariableFrame.off_pixel * ((self.frame_size - 8) // 4))
+            self.client_pixels = None
+
+    def finish(self):
+        LEDStats.close_connection(self.stats)
+        if self.variable_view is not None:
+            self.variable_view.release()
+        self.led_data_view.release()
+        self.frame_view.release()
+        self.size_view.release()
+
     def handle(self):
         print("Connection from {0}".format(self.client_address[0]))
 
+        port = self.port
+        handler = None
+        # The command handler generates the response
+        if TCPRequestHandler.command_handler_class:
+            # Create an instance of the command handler for this connection
+            handler = TCPRequestHandler.command_handler_class()
+            # Give the command handler access to the connection's counters
+            if hasattr(handler, "connection_stats"):
+                handler.connection_stats = self.stats
+
         # Do until close is received
         connection_open = True
         while connection_open:
             # self.request is the TCP socket connected to the client
-            led_data = self.read_led_data()
+            client_frame_size = self.read_frame_size()
+            if client_frame_size is None:
+                # We consider this an error, so we force close the socket
+                break
+            if client_frame_size == TCPRequestHandler.BATCH_MESSAGE:
+                connection_open = self.handle_batch(handler, port)
+                continue
+
+            if client_frame_size in (FrameDecoder.DELTA_FRAME, FrameDecoder.RLE_FRAME):
+                led_data = self.read_encoded_frame(client_frame_size)
+            else:
+                led_data = self.read_led_data(client_frame_size)
 
+            if led_data is not None and len(led_data) == 0:
+                # An invalid frame was dropped
+                continue
             if led_data and len(led_data) > 0:
                 try:
-                    # The command handler generates the response
-                    if TCPRequestHandler.command_handler_class:
-                        # Create an instance of the command handler
-                        handler = TCPRequestHandler.command_handler_class()
-                        # Pass the command string to the command handler
-                        response = handler.execute_command(self.request.getsockname()[1], led_data)
+                    if handler:
+                        # Pass the LED data to the command handler
+                        response = handler.execute_command(port, led_data)
                 except Exception as ex:
+                    LEDStats.frame_rejected(self.stats)
                     print("Exception occurred while handling LED data")
                     print(str(ex))
-                    print(led_data)
+                    print(bytes(led_data))
                 finally:
                     pass
 
-                TCPRequestHandler.call_sequence += 1
+                TCPRequestHandler.next_call_sequence()
             else:
                 # We consider this an error, so we force close the socket
                 connection_open = False
         print("Connection closed")
 
-    def read_led_data(self):
+    def read_frame_size(self):
+        """
+        Read the frame size (or extended message selector) that starts every message
+        :return: Returns the frame size or None if the socket broke
+        """
+        if not self.receive_into(self.size_view):
+            print("Unable to read client frame size")
+            return None
+        # Note that the result of unpack is a tuple with one value
+        return unpack_from('!i', self.size_buffer)[0]
+
+    def read_led_data(self, client_frame_size):
         """
         Read a stream of LED data from a socket
-        :return: Returns a list of bytes or None
+        :param client_frame_size: The frame size sent by the client
+        :return: Returns a read-only memoryview of the frame or None.
+        The view refers to the connection's receive buffer, so it is
+        only valid until the next frame is read. Copy whatever needs to be kept.
         """
         # This is essentially APA102 format.
         # client_frame_size followed by
         # 4 bytes all zeroes header + 4 bytes per pixel * pixels + 4 bytes all ones trailer
-        client_frame_size = self.receive(4)
-        if not client_frame_size:
-            print("Unable to read client frame size")
-            return None
-        # Note that the result of unpack is a tuple with one value
-        client_frame_size = unpack('!i', client_frame_size)[0]
-        if client_frame_size != TCPRequestHandler.frame_size:
+        if client_frame_size != self.frame_size:
+            if TCPRequestHandler.variable_frame_size_ok(client_frame_size):
+                return self.read_variable_frame(client_frame_size)
+            LEDStats.frame_rejected(self.stats)
+            if TCPRequestHandler.strict_frames:
+                LEDStats.frame_invalid(self.stats, FrameValidator.BAD_SIZE)
+                return self.resync(self.size_buffer)
             print("Client frame size does not match configured number of pixels")
             return None
 
-        led_data = self.receive(TCPRequestHandler.frame_size)
-        if not led_data:
+        start = time.perf_counter()
+        if not self.receive_into(self.frame_view):
             print("Failed to receive complete frame")
             return None
+        LEDStats.frame_received(self.stats, len(self.size_buffer) + len(self.frame_buffer),
+                                time.perf_counter() - start)
 
-        # It is likely that some sort of data conversion will be required.
-        # For now we'll coerce the frame into a list of bytes (which
-        # should be the format it is already in)
-        led_data = bytes(led_data)
-        return led_data
+        if TCPRequestHandler.strict_frames:
+            return self.check_frame()
+        return self.led_data_view
 
-    def receive(self, block_size):
+    def read_variable_frame(self, client_frame_size):
         """
-        Read a given number of bytes from stream
-        :param block_size:
-        :return:
+        Read a frame whose size differs from the LED string's frame size
+        and fit it into the frame buffer
+        :param client_frame_size: The frame size sent by the client
+        :return: Returns a read-only memoryview of the frame, b"" if it was
+        dropped or None if the socket broke
+        """
+        start = time.perf_counter()
+        received = self.variable_view[0:client_frame_size]
+        if not self.receive_into(received):
+            print("Failed to receive complete frame")
+            return None
+        LEDStats.frame_received(self.stats, len(self.size_buffer) + client_frame_size,
+                                time.perf_counter() - start)
+
+        num_pixels = VariableFrame.pixel_count(self.variable_buffer, client_frame_size)
+        if num_pixels is None:
+            LEDStats.frame_rejected(self.stats)
+            if TCPRequestHandler.strict_frames:
+                LEDStats.frame_invalid(self.stats, FrameValidator.BAD_TRAILER)
+                return self.resync(bytes(self.size_buffer) + received)
+            print("Client frame does not end with an end frame")
+            return b""
+        if num_pixels != self.client_pixels:
+            print("Client frames have {0} pixels, the LED string has {1}".format(
+                num_pixels, (self.frame_size - 8) // 4))
+            self.client_pixels = num_pixels
+        VariableFrame.fit(received, num_pixels, self.frame_buffer, self.padding)
+
+        if TCPRequestHandler.strict_frames:
+            # The stream is searched, not the fitted frame
+            return self.check_frame(received)
+        return self.led_data_view
+
+    def check_frame(self, received=None):
+        """
+        Check the frame in the frame buffer (strict mode)
+        :param received: The frame as received, if it was fitted into the frame buffer
+        :return: Returns the frame, b"" if it was dropped or None if the socket broke
+        """
+        reason = FrameValidator.check(self.frame_buffer)
+        if reason is None:
+            return self.led_data_view
+        LEDStats.frame_rejected(self.stats)
+        LEDStats.frame_invalid(self.stats, reason)
+        if reason == FrameValidator.BAD_START_BITS:
+            # The frame is intact but its pixel data is not
+            return b""
+        # The stream is out of step
+        if received is None:
+            received = self.frame_buffer
+        return self.resync(bytes(self.size_buffer) + received)
+
+    def resync(self, received):
+        """
+        Find the next raw frame in the stream after a bad one (strict mode).
+        The stream is searched for the frame size followed by the frame header.
+        :param received: The bytes received since the last good message
+        :return: Returns the next valid frame, b"" if it was dropped or None if the socket broke
+        """
+        marker = FrameValidator.sync_marker(self.frame_size)
+        read_size = FrameValidator.resync_read_size(self.frame_size)
+        buffer = bytes(received)
+        # The bad message itself does not start the next one
+        search_start = 1
+        discarded = 0
+        while True:
+            i = buffer.find(marker, search_start)
+            if i < 0:
+                # Keep what could be the start of a marker
+                keep = min(len(buffer), len(marker) - 1)
+                discarded += len(buffer) - keep
+                buffer = buffer[len(buffer) - keep:]
+                search_start = 0
+                try:
+                    data = self.receive_some(read_size)
+                except OSError:
+                    data = None
+                if not data:
+                    print("Connection closed while resynchronizing")
+                    return None
+                buffer += data
+                continue
+
+            discarded += i
+            # Whatever follows the frame size is the start of the frame,
+            # and anything past the frame is the start of the next message
+            start = buffer[i + 4:i + 4 + self.frame_size]
+            self.pending = buffer[i + 4 + self.frame_size:] + self.pending
+            self.frame_buffer[0:len(start)] = start
+            if not self.receive_into(self.frame_view[len(start):]):
+                print("Failed to receive complete frame")
+                return None
+            LEDStats.frame_received(self.stats, len(self.size_buffer) + len(self.frame_buffer), 0.0)
+
+            reason = FrameValidator.check(self.frame_buffer)
+            if reason != FrameValidator.BAD_TRAILER:
+                LEDStats.resynced(self.stats, discarded)
+                print("Resynchronized after discarding {0} bytes".format(discarded))
+                if reason is None:
+                    return self.led_data_view
+                LEDStats.frame_rejected(self.stats)
+                LEDStats.frame_invalid(self.stats, reason)
+                return b""
+            # The marker was in corrupt data. Keep searching after it.
+            LEDStats.frame_rejected(self.stats)
+            LEDStats.frame_invalid(self.stats, reason)
+            buffer = buffer[i:i + 4] + self.frame_buffer
+            search_start = 1
+
+    def read_encoded_frame(self, encoding):
         """
-        count = block_size
-        led_data = b''
+        Read a delta or run length encoded frame and decode it into the
+        connection's frame buffer
+        :param encoding: FrameDecoder.DELTA_FRAME or FrameDecoder.RLE_FRAME
+        :return: Returns a read-only memoryview of the decoded frame or None
+        """
+        if not self.receive_into(memoryview(self.encoded_header_buffer)):
+            print("Failed to receive encoded frame header")
+            return None
+        entries_size = FrameDecoder.parse_header(self.encoded_header_buffer, self.frame_size)
+        if entries_size is None:
+            LEDStats.frame_rejected(self.stats)
+            return None
+
+        if len(self.entries_buffer) < entries_size:
+            self.entries_buffer = bytearray(entries_size)
+        start = time.perf_counter()
+        with memoryview(self.entries_buffer) as entries_view:
+            entries = entries_view[0:entries_size]
+            if not self.receive_into(entries):
+                print("Failed to receive complete encoded frame")
+                return None
+            if not FrameDecoder.decode(encoding, self.frame_buffer, entries):
+                LEDStats.frame_rejected(self.stats)
+                return None
+        LEDStats.frame_received(self.stats, len(self.size_buffer) + len(self.encoded_header_buffer) + entries_size,
+                                time.perf_counter() - start)
+
+        return self.led_data_view
+
+    def handle_batch(self, handler, port):
+        """
+        Receive a batch message. Everything after the batch header is
+        received with one bulk read.
+        :param handler: The connection's command handler
+        :param port: Local port number of the connection
+        :return: Returns False if the connection should be closed
+        """
+        if not self.receive_into(memoryview(self.batch_header_buffer)):
+            print("Failed to receive batch header")
+            return False
+        batch = TCPRequestHandler.parse_batch_header(self.batch_header_buffer, self.frame_size)
+        if batch is None:
+            LEDStats.frame_rejected(self.stats)
+            return False
+        frame_count, timestamps_size, frames_size = batch
+
+        size = timestamps_size + frames_size
+        if len(self.batch_buffer) < size:
+            self.batch_buffer = bytearray(size)
+        start = time.perf_counter()
+        with memoryview(self.batch_buffer) as batch_view:
+            if not self.receive_into(batch_view[0:size]):
+                print("Failed to receive complete batch")
+                return False
+            LEDStats.frame_received(self.stats, len(self.size_buffer) + len(self.batch_header_buffer) + size,
+                                    time.perf_counter() - start, frames=frame_count)
+            try:
+                if handler:
+                    TCPRequestHandler.execute_batch(handler, port, batch_view[0:size].toreadonly(),
+                                                    frame_count, timestamps_size)
+            except Exception as ex:
+                LEDStats.frame_rejected(self.stats)
+                print("Exception occurred while handling LED data batch")
+                print(str(ex))
+        TCPRequestHandler.next_call_sequence(frame_count)
+        return True
+
+    def receive_into(self, view):
+        """
+        Read exactly len(view) bytes from stream into a buffer
+        :param view: A writable memoryview of the receive buffer
+        :return: Returns True if the view was filled, False if the socket broke
+        """
+        received = 0
+        count = len(view)
+        if self.pending:
+            received = min(count, len(self.pending))
+            view[0:received] = self.pending[0:received]
+            self.pending = self.pending[received:]
         # Read exactly "count" bytes
-        while count:
-            seg = self.request.recv(count)
-            if seg:
-                led_data += seg
-                count -= len(seg)
+        while received < count:
+            n = self.request.recv_into(view[received:])
+            if n:
+                received += n
             else:
                 # Broken socket
-                return None
-        # It is likely that some sort of data conversion will be required.
-        # For now we'll coerce the frame into a list of bytes (which
-        # should be the format it is already in)
-        led_data = bytes(led_data)
-        return led_data
+                return False
+        return True
+
+    def receive_some(self, size):
+        """
+        Read up to size bytes from the stream
+        :param size: Largest number of bytes to read
+        :return: Returns the bytes read, b"" if the socket broke
+        """
+        if self.pending:
+            data = self.pending[0:size]
+            self.pending = self.pending[size:]
+            return data
+        return self.request.recv(size)
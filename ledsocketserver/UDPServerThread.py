@@ -0,0 +1,202 @@
+# coding: utf-8
+#
+# AtHomeSocketServer
+# Copyright © 2016, 2018  Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# See the LICENSE file for more details.
+#
+
+#
+# UDP frame server running on its own thread.
+#
+# Each datagram holds one frame.
+#   sequence number  uint32, network byte order, incremented for each frame
+#   frame            complete APA102 frame (header, pixels, trailer)
+#
+# A frame that arrives after a newer frame from the same source is
+# stale and is discarded, as is a duplicate. A gap in the sequence
+# numbers is counted as lost frames.
+#
+# A source that sends nothing for source_timeout seconds is forgotten,
+# and so is the least recently seen source when there are more than
+# max_sources. A forgotten source's next frame starts a new sequence.
+#
+
+import socket
+import threading
+import time
+from collections import OrderedDict
+from struct import unpack_from
+from led_stats import LEDStats
+
+
+class UDPSource:
+    """
+    Sequence tracking for one sending address
+    """
+    # A frame this far behind the newest one means the sender restarted
+    # its sequence numbers
+    restart_window = 1024
+
+    def __init__(self, address, handler_class):
+        self.address = address
+        self.last_seq = None
+        # time.perf_counter() when the source's last datagram arrived
+        self.last_seen = 0.0
+        self.stats = LEDStats.open_connection(address[0])
+        self.handler = handler_class() if handler_class else None
+        # Give the command handler access to the source's counters
+        if self.handler and hasattr(self.handler, "connection_stats"):
+            self.handler.connection_stats = self.stats
+
+    def accept(self, seq):
+        """
+        Check a frame's sequence number
+        :param seq:
+        :return: Returns True if the frame is the newest one from this source
+        """
+        if self.last_seq is None:
+            self.last_seq = seq
+            return True
+        ahead = (seq - self.last_seq) & 0xFFFFFFFF
+        if ahead == 0:
+            # Duplicate
+            LEDStats.frame_stale(self.stats)
+            return False
+        if ahead < 0x80000000:
+            if ahead > 1:
+                LEDStats.frames_lost(self.stats, ahead - 1)
+            self.last_seq = seq
+            return True
+        behind = (self.last_seq - seq) & 0xFFFFFFFF
+        if behind <= UDPSource.restart_window:
+            # Out of order. A late frame is worse than a lost one.
+            LEDStats.frame_stale(self.stats)
+            return False
+        self.last_seq = seq
+        return True
+
+    def close(self):
+        LEDStats.close_connection(self.stats)
+
+
+# This class should be used as a singleton
+class UDPServerThread:
+    # Socket receive buffer size. Large enough to absorb bursts of frames.
+    receive_buffer_size = 4 * 1024 * 1024
+    # How often the server thread checks for Stop
+    poll_interval = 0.25
+    # Sources that send nothing for this many seconds are forgotten
+    source_timeout = 10.0
+    # Most sources tracked at once
+    max_sources = 64
+
+    # Constructor of an instance to serve a given host:port
+    def __init__(self, host, port, handler, frame_size=None):
+        """
+        :param host:
+        :param port:
+        :param handler: The command handler class (see TCPRequestHandler)
+        :param frame_size: Complete LED data frame size expected on the port
+        """
+        self.host = host
+        self.port = port
+        self.handler_class = handler
+        self.frame_size = frame_size
+        self.server_thread = threading.Thread(target=self.RunServer)
+        self.stop_event = threading.Event()
+        # Sending address: UDPSource, least recently seen first
+        self.sources = OrderedDict()
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDPServerThread.receive_buffer_size)
+        except OSError:
+            pass
+        self.sock.settimeout(UDPServerThread.poll_interval)
+        self.sock.bind((host, port))
+
+        # Datagrams are received directly into this buffer. One extra
+        # byte detects datagrams that are too large.
+        self.datagram_size = 4 + frame_size
+        self.buffer = bytearray(self.datagram_size + 1)
+        self.view = memoryview(self.buffer)
+        # What the command handler sees. It is only valid until the next datagram is received.
+        self.led_data_view = self.view[4:self.datagram_size].toreadonly()
+
+    # Start the UDP server on its own thread
+    def Start(self):
+        self.server_thread.start()
+
+    # Stop the UDP server thread
+    def Stop(self):
+        print("Shutting down UDP server thread")
+        self.stop_event.set()
+        self.server_thread.join()
+        self.sock.close()
+        for source in self.sources.values():
+            source.close()
+        print("UDP server thread down")
+
+    # Run the UDP server on a new thread
+    def RunServer(self):
+        print("Now serving datagrams at {0}:{1}".format(self.host, self.port))
+        while not self.stop_event.is_set():
+            try:
+                nbytes, address = self.sock.recvfrom_into(self.view)
+            except socket.timeout:
+                continue
+            except OSError as ex:
+                if not self.stop_event.is_set():
+                    print("UDP receive failed:", str(ex))
+                continue
+            self.handle_datagram(nbytes, address)
+
+    def handle_datagram(self, nbytes, address):
+        start = time.perf_counter()
+        self.expire_sources(start)
+        source = self.sources.get(address)
+        if source is None:
+            print("Datagrams from {0}:{1}".format(address[0], address[1]))
+            source = UDPSource(address, self.handler_class)
+            self.sources[address] = source
+            if len(self.sources) > UDPServerThread.max_sources:
+                # Forget the least recently seen source
+                self.sources.popitem(last=False)[1].close()
+        else:
+            self.sources.move_to_end(address)
+        source.last_seen = start
+
+        if nbytes != self.datagram_size:
+            LEDStats.frame_rejected(source.stats)
+            return
+        seq = unpack_from("!I", self.buffer)[0]
+        if not source.accept(seq):
+            return
+        LEDStats.frame_received(source.stats, nbytes, time.perf_counter() - start)
+
+        if source.handler:
+            try:
+                source.handler.execute_command(self.port, self.led_data_view)
+            except Exception as ex:
+                LEDStats.frame_rejected(source.stats)
+                print("Exception occurred while handling LED data")
+                print(str(ex))
+
+    def expire_sources(self, now):
+        """
+        Forget the sources that have not sent anything for source_timeout seconds
+        :param now: time.perf_counter()
+        :return: None
+        """
+        while self.sources:
+            address, source = next(iter(self.sources.items()))
+            if now - source.last_seen < UDPServerThread.source_timeout:
+                break
+            del self.sources[address]
+            source.close()
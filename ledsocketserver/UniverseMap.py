@@ -0,0 +1,127 @@
+# coding: utf-8
+#
+# AtHomeSocketServer
+# Copyright © 2016, 2018  Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# See the LICENSE file for more details.
+#
+
+#
+# Maps DMX universes onto the pixels of one LED string. Each pixel takes
+# 3 DMX channels (r, g, b). By default the pixels fill consecutive
+# universes starting at a first universe, 170 pixels (510 channels) per
+# universe. An explicit map can be given instead:
+#   [{"universe": 1, "start_pixel": 0, "pixels": 170, "offset": 0}, ...]
+# where offset is the first DMX channel (0 based) of the pixels.
+#
+# The map is turned into a list of slice copies per universe when it is
+# created. Universe data is copied into an (r, g, b) staging buffer as it
+# arrives and the staging buffer is copied into a complete APA102 frame
+# when the frame is published. Neither step loops over channels in Python.
+#
+
+
+class UniverseMap:
+    # Channels used by each pixel
+    channels_per_pixel = 3
+
+    def __init__(self, num_pixels, first_universe=1, channels_per_universe=510, universes=None):
+        """
+        Constructor
+        :param num_pixels: Number of pixels in the LED string
+        :param first_universe: First universe when universes is not given
+        :param channels_per_universe: Channels used in each universe when
+        universes is not given. Rounded down to whole pixels.
+        :param universes: Optional explicit map, a list of dicts with keys
+        universe, start_pixel, pixels and offset
+        """
+        self.num_pixels = num_pixels
+        if universes is None:
+            pixels_per_universe = max(1, channels_per_universe // UniverseMap.channels_per_pixel)
+            universes = []
+            for i, start_pixel in enumerate(range(0, num_pixels, pixels_per_universe)):
+                universes.append({"universe": first_universe + i, "start_pixel": start_pixel,
+                                  "pixels": min(pixels_per_universe, num_pixels - start_pixel), "offset": 0})
+
+        # universe: list of (source start, source end, staging offset)
+        self.copies = {}
+        for entry in universes:
+            start_pixel = int(entry["start_pixel"])
+            pixels = min(int(entry["pixels"]), num_pixels - start_pixel)
+            if start_pixel < 0 or pixels <= 0:
+                raise ValueError("Universe map entry is outside the LED string: {0}".format(entry))
+            offset = int(entry.get("offset", 0))
+            if offset + (pixels * UniverseMap.channels_per_pixel) > 512:
+                raise ValueError("Universe map entry does not fit in a universe: {0}".format(entry))
+            self.copies.setdefault(int(entry["universe"]), []).append(
+                (offset, offset + (pixels * UniverseMap.channels_per_pixel), start_pixel * UniverseMap.channels_per_pixel))
+
+        # Each universe has a bit in the set of universes received
+        self.universe_bits = {universe: 1 << i for i, universe in enumerate(sorted(self.copies))}
+        self.all_bits = (1 << len(self.copies)) - 1
+        self.received = 0
+
+        self.rgb = bytearray(num_pixels * UniverseMap.channels_per_pixel)
+        # A complete APA102 frame at full brightness
+        self.frame_buffer = bytearray(8 + (num_pixels * 4))
+        self.frame_buffer[4:-4:4] = b"\xff" * num_pixels
+        self.frame_buffer[-4:] = b"\xff\xff\xff\xff"
+        # What the command handler sees
+        self.frame_view = memoryview(self.frame_buffer).toreadonly()
+
+    def universes(self):
+        """
+        :return: Returns the list of mapped universe numbers
+        """
+        return sorted(self.copies)
+
+    def gather(self, universe, data):
+        """
+        Copy the channels of a universe into the staging buffer
+        :param universe: Universe number
+        :param data: The universe's DMX channel data (without start code)
+        :return: Returns False if the universe is not mapped
+        """
+        copies = self.copies.get(universe)
+        if copies is None:
+            return False
+        available = len(data)
+        for src_start, src_end, dst_start in copies:
+            if src_end > available:
+                # A short universe only updates the channels it has
+                src_end = max(src_start, available)
+            self.rgb[dst_start:dst_start + (src_end - src_start)] = data[src_start:src_end]
+        self.received |= self.universe_bits[universe]
+        return True
+
+    def received_universe(self, universe):
+        return bool(self.received & self.universe_bits.get(universe, 0))
+
+    def complete(self):
+        """
+        :return: Returns True if every mapped universe arrived since the last publish
+        """
+        return self.received == self.all_bits
+
+    def missing(self):
+        """
+        :return: Returns the number of mapped universes that have not arrived since the last publish
+        """
+        return bin(self.all_bits & ~self.received).count("1")
+
+    def publish(self):
+        """
+        Build a frame from the staging buffer
+        :return: Returns a read-only view of a complete APA102 frame. It
+        is only valid until the next publish.
+        """
+        end = len(self.frame_buffer) - 4
+        self.frame_buffer[5:end:4] = self.rgb[0::3]
+        self.frame_buffer[6:end:4] = self.rgb[1::3]
+        self.frame_buffer[7:end:4] = self.rgb[2::3]
+        self.received = 0
+        return self.frame_view
@@ -0,0 +1,92 @@
+# coding: utf-8
+#
+# AtHomeSocketServer
+# Copyright © 2016, 2018  Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# See the LICENSE file for more details.
+#
+
+#
+# Frames whose size differs from the LED string's frame size. Real
+# APA102 and SK9822 drivers end a frame in different ways.
+#   APA102 (as sent to the emulator)  4 bytes of 0xFF
+#   APA102 (what the strip needs)     at least n/2 bits, ceil(n / 16) bytes
+#   SK9822                            4 byte reset frame of 0x00 followed
+#                                     by ceil(n / 16) bytes
+# End frame bytes are 0x00 or 0xFF and some drivers round the end frame
+# up to a multiple of 4 bytes. The pixel count n of a frame is inferred
+# from its length and its end frame, and the pixels are then copied into
+# a frame of the LED string's size, dropping extra pixels or padding
+# with pixels that are off.
+#
+
+
+class VariableFrame:
+    # Smallest frame: a header and no pixels
+    min_frame_size = 4
+    # Longest end frame beyond ceil(n / 16) bytes: a reset frame plus
+    # rounding up to a multiple of 4 bytes
+    end_frame_slack = 4 + 3
+    # A pixel that is off, with the start bits set
+    off_pixel = b"\xe0\x00\x00\x00"
+
+    @classmethod
+    def end_frame_size_ok(cls, num_pixels, end_size):
+        """
+        :param num_pixels: Pixel count
+        :param end_size: Bytes following the pixels
+        :return: Returns True if a driver could have sent an end frame of that size
+        """
+        if end_size == 4:
+            return True
+        minimum = (num_pixels + 15) // 16
+        return minimum <= end_size <= minimum + cls.end_frame_slack
+
+    @classmethod
+    def pixel_count(cls, frame, length):
+        """
+        Infer the number of pixels in a frame
+        :param frame: bytes-like frame (header, pixels, end frame)
+        :param length: Length of the frame in bytes
+        :return: Returns the number of pixels or None if the frame
+        does not end with a recognizable end frame
+        """
+        if length < cls.min_frame_size:
+            return None
+        body_size = length - 4
+        # The most pixels that fit, then fewer pixels and a longer end frame
+        for num_pixels in range(body_size // 4, -1, -1):
+            end_size = body_size - (num_pixels * 4)
+            if end_size > 4 and end_size > ((num_pixels + 15) // 16) + cls.end_frame_slack:
+                # Fewer pixels only make the end frame longer
+                return None
+            if not cls.end_frame_size_ok(num_pixels, end_size):
+                continue
+            end = 4 + (num_pixels * 4)
+            if bytes(frame[end:length]).translate(None, b"\x00\xff"):
+                # Not an end frame, and fewer pixels would include these bytes too
+                return None
+            if num_pixels and frame[end - 4] == 0:
+                # A pixel always has start bits. This is an SK9822 reset frame.
+                continue
+            return num_pixels
+        return None
+
+    @classmethod
+    def fit(cls, frame, num_pixels, frame_buffer, padding):
+        """
+        Copy a frame into a frame buffer of a different size
+        :param frame: bytes-like received frame
+        :param num_pixels: Number of pixels in the received frame
+        :param frame_buffer: bytearray holding a complete frame of the LED string's size
+        :param padding: off_pixel repeated for every pixel of the LED string
+        :return: None
+        """
+        display_pixels = (len(frame_buffer) - 8) // 4
+        copy_size = min(num_pixels, display_pixels) * 4
+        frame_buffer[0:4 + copy_size] = frame[0:4 + copy_size]
+        frame_buffer[4 + copy_size:-4] = padding[0:(display_pixels * 4) - copy_size]
@@ -0,0 +1,521 @@
+# coding: utf-8
+#
+# AtHomeSocketServer
+# Copyright © 2016, 2018  Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# See the LICENSE file for more details.
+#
+
+#
+# Web viewer server running an asyncio event loop on its own thread.
+# A browser opening http://host:port/ gets a small canvas page that
+# connects back over a WebSocket (/ws) and draws the LED strings.
+#
+# Every frame a LED string hands to the display is also published to
+# this server (see LEDString.viewer). Only the newest frame of each
+# string is kept. Each viewer is sent the newest frame at most max_fps
+# times per second, so a slow viewer skips frames instead of falling
+# behind. A viewer can ask for a lower rate with /?fps=n.
+#
+# Messages sent to a viewer
+#   text      JSON {"strings": [{"name", "num_pixels", "layout"}]}, once
+#   binary    header  type uint8 (1 = frame, 2 = delta), string index
+#                     uint8, reserved uint16, count uint32
+#             frame   count (r, g, b) pixels
+#             delta   count changed pixels, each a pixel index uint32
+#                     followed by (r, g, b)
+# All values are in network byte order. Colors have been through the
+# string's color pipeline, just like the LED window.
+#
+
+import asyncio
+import base64
+import hashlib
+import json
+import threading
+from struct import Struct, pack
+from urllib.parse import urlsplit, parse_qs
+from led_frame import LEDFrame, changed_pixels
+
+
+class ViewerConnection:
+    """
+    What the server keeps for one viewer
+    """
+    def __init__(self, writer, num_strings, interval):
+        self.writer = writer
+        # Seconds between messages to this viewer
+        self.interval = interval
+        # Sequence number and display pixel data of the last frame sent, per string
+        self.sent_seqs = [0] * num_strings
+        self.sent_data = [None] * num_strings
+
+
+# This class should be used as a singleton
+class WebViewerServerThread:
+    # Message types
+    FRAME_MESSAGE = 1
+    DELTA_MESSAGE = 2
+    message_header = Struct("!BBxxI")
+    # Pixel index of a delta entry
+    delta_index = Struct("!I")
+
+    # WebSocket opcodes (RFC 6455)
+    OP_TEXT = 0x1
+    OP_BINARY = 0x2
+    OP_CLOSE = 0x8
+    OP_PING = 0x9
+    OP_PONG = 0xA
+    websocket_guid = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+    # Longest message accepted from a browser. Viewers only send control messages.
+    max_client_message = 4096
+    # Longest HTTP request header
+    max_request_size = 16384
+
+    # Constructor of an instance to serve a given host:port
+    def __init__(self, host, port, led_strings, max_fps=30):
+        """
+        :param host:
+        :param port:
+        :param led_strings: The LEDString instances to show
+        :param max_fps: Most messages per second sent to a viewer
+        """
+        self.host = host
+        self.port = port
+        self.led_strings = list(led_strings)
+        self.max_fps = max(1, max_fps)
+        self.server_thread = threading.Thread(target=self.RunServer)
+        self.strings_message = json.dumps({"strings": [{"name": s.name,
+                                                        "num_pixels": s.num_pixels,
+                                                        "layout": s.layout.to_dict()}
+                                                       for s in self.led_strings]})
+
+        # The newest frame of each string, published from the display thread
+        self.lock = threading.Lock()
+        self.index = {}
+        for i, led_string in enumerate(self.led_strings):
+            self.index[led_string] = i
+        self.frames = [None] * len(self.led_strings)
+        self.seqs = [0] * len(self.led_strings)
+        self.wake_pending = False
+        # Display data of the newest frames (seq, LEDFrame, rgb) and the
+        # last delta built (base seq, seq, message), per string. Viewers
+        # that keep up all share the same delta.
+        self.display = [(0, None, None)] * len(self.led_strings)
+        self.deltas = [(0, 0, None)] * len(self.led_strings)
+
+        self.viewers = set()
+        # Open connections (task: writer), closed when the server stops
+        self.connections = {}
+        self.loop = None
+        self.stop_event = None
+        self.frame_event = None
+        self.started = threading.Event()
+        self.start_error = None
+
+        for led_string in self.led_strings:
+            led_string.viewer = self
+
+    # Start the server on its own thread
+    def Start(self):
+        self.server_thread.start()
+        # Wait until the server is listening (or failed to)
+        self.started.wait()
+        if self.start_error:
+            raise self.start_error
+
+    # Stop the server thread
+    def Stop(self):
+        print("Shutting down web viewer server thread")
+        for led_string in self.led_strings:
+            led_string.viewer = None
+        if self.loop and self.stop_event and self.server_thread.is_alive():
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+        self.server_thread.join()
+        print("Web viewer server thread down")
+
+    # Run the event loop on a new thread
+    def RunServer(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        self.frame_event = asyncio.Event()
+        try:
+            server = await asyncio.start_server(self.handle_connection, self.host, self.port,
+                                                reuse_address=True,
+                                                limit=WebViewerServerThread.max_request_size)
+        except Exception as ex:
+            self.start_error = ex
+            return
+        finally:
+            self.started.set()
+
+        print("Now serving web viewer at http://{0}:{1}/".format(self.host, self.port))
+        async with server:
+            await self.stop_event.wait()
+            # Viewers and idle browser connections stay open until they are
+            # closed, and leaving the server context waits for them (3.12+)
+            await self.close_connections()
+
+    async def close_connections(self):
+        """
+        Close every open connection and wait for its handler to finish
+        """
+        tasks = list(self.connections)
+        for task, writer in list(self.connections.items()):
+            writer.close()
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def publish(self, led_string, frame):
+        """
+        Make a frame the newest frame of a string. Called from the thread
+        that takes frames for display.
+        :param led_string: The LEDString
+        :param frame: A LEDFrame as received
+        :return: None
+        """
+        i = self.index.get(led_string)
+        if i is None:
+            return
+        if not isinstance(frame.data, bytes):
+            # The data is only valid until the next frame is taken
+            frame = LEDFrame(bytes(frame.data), timestamp=frame.timestamp)
+        with self.lock:
+            self.frames[i] = frame
+            self.seqs[i] += 1
+            if self.wake_pending or not self.viewers:
+                return
+            self.wake_pending = True
+        try:
+            self.loop.call_soon_threadsafe(self.frames_arrived)
+        except RuntimeError:
+            # The event loop has been closed
+            pass
+
+    def frames_arrived(self):
+        # Wake up every viewer waiting for a frame
+        with self.lock:
+            self.wake_pending = False
+        event = self.frame_event
+        self.frame_event = asyncio.Event()
+        event.set()
+
+    def display_frame(self, i):
+        """
+        :param i: String index
+        :return: Returns a tuple (seq, LEDFrame in display colors, rgb bytes)
+        for the newest frame of a string
+        """
+        with self.lock:
+            seq = self.seqs[i]
+            frame = self.frames[i]
+        if self.display[i][0] != seq:
+            display = self.led_strings[i].color_pipeline.apply(frame)
+            self.display[i] = (seq, display, display.rgb())
+        return self.display[i]
+
+    def frame_message(self, i, viewer):
+        """
+        Build the message that brings a viewer up to date with the newest
+        frame of a string
+        :param i: String index
+        :param viewer: The ViewerConnection
+        :return: Returns the message
+        """
+        seq, display, rgb = self.display_frame(i)
+        base_seq = viewer.sent_seqs[i]
+        previous = viewer.sent_data[i]
+        viewer.sent_seqs[i] = seq
+        viewer.sent_data[i] = display.data
+
+        if self.deltas[i][0:2] == (base_seq, seq):
+            return self.deltas[i][2]
+        message = None
+        if previous is not None and len(previous) == len(display.data):
+            changed = changed_pixels(display.data, previous)
+            # A delta entry is 7 bytes, a pixel in a frame is 3 bytes
+            if len(changed) * 7 < len(rgb):
+                parts = [WebViewerServerThread.message_header.pack(WebViewerServerThread.DELTA_MESSAGE,
+                                                                   i, len(changed))]
+                for pixel in changed:
+                    parts.append(WebViewerServerThread.delta_index.pack(pixel))
+                    parts.append(rgb[pixel * 3:(pixel * 3) + 3])
+                message = b"".join(parts)
+                self.deltas[i] = (base_seq, seq, message)
+        if message is None:
+            message = WebViewerServerThread.message_header.pack(WebViewerServerThread.FRAME_MESSAGE,
+                                                                i, display.num_pixels) + rgb
+        return message
+
+    async def handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections[task] = writer
+        try:
+            await self.handle_request(reader, writer)
+        except asyncio.CancelledError:
+            # The server is shutting down
+            writer.close()
+        finally:
+            del self.connections[task]
+
+    async def handle_request(self, reader, writer):
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+        lines = request.decode("latin-1").split("\r\n")
+        try:
+            method, target, version = lines[0].split(" ", 2)
+        except ValueError:
+            writer.close()
+            return
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+        url = urlsplit(target)
+
+        try:
+            if method != "GET":
+                await self.send_response(writer, "405 Method Not Allowed", "text/plain", b"Method not allowed\n")
+            elif url.path == "/":
+                await self.send_response(writer, "200 OK", "text/html; charset=utf-8",
+                                         viewer_page.encode("utf-8"))
+            elif url.path == "/ws" and headers.get("upgrade", "").lower() == "websocket" and \
+                    "sec-websocket-key" in headers:
+                await self.handle_viewer(reader, writer, headers["sec-websocket-key"], parse_qs(url.query))
+            else:
+                await self.send_response(writer, "404 Not Found", "text/plain", b"Not found\n")
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def send_response(writer, status, content_type, body):
+        writer.write("HTTP/1.1 {0}\r\nContent-Type: {1}\r\nContent-Length: {2}\r\n"
+                     "Cache-Control: no-cache\r\nConnection: close\r\n\r\n".format(
+                         status, content_type, len(body)).encode("latin-1"))
+        writer.write(body)
+        await writer.drain()
+
+    async def handle_viewer(self, reader, writer, key, query):
+        """
+        Complete the WebSocket handshake and send frames until the viewer goes away
+        :param reader: The connection's asyncio.StreamReader
+        :param writer: The connection's asyncio.StreamWriter
+        :param key: The Sec-WebSocket-Key header
+        :param query: The parsed query string
+        :return: None
+        """
+        accept = base64.b64encode(hashlib.sha1(key.encode("latin-1") + WebViewerServerThread.websocket_guid).digest())
+        writer.write(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                     b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+        fps = self.max_fps
+        try:
+            fps = min(fps, max(1, int(query["fps"][0])))
+        except (KeyError, ValueError):
+            pass
+        viewer = ViewerConnection(writer, len(self.led_strings), 1.0 / fps)
+        client_address = writer.get_extra_info("peername")
+        print("Web viewer connected from {0}".format(client_address[0]))
+
+        self.send_message(writer, WebViewerServerThread.OP_TEXT, self.strings_message.encode("utf-8"))
+        self.viewers.add(viewer)
+        sender = asyncio.ensure_future(self.send_frames(viewer))
+        try:
+            await self.receive_messages(reader, writer)
+        except asyncio.CancelledError:
+            # The server is shutting down
+            pass
+        finally:
+            self.viewers.discard(viewer)
+            sender.cancel()
+            try:
+                await sender
+            except (asyncio.CancelledError, ConnectionError):
+                pass
+            print("Web viewer disconnected")
+
+    async def send_frames(self, viewer):
+        """
+        Send each viewer the newest frames, at most once per interval.
+        While a slow viewer drains, newer frames replace older ones.
+        :param viewer: The ViewerConnection
+        :return: None
+        """
+        writer = viewer.writer
+        next_send = 0.0
+        while True:
+            # Taken before looking at the frames so no wakeup is missed
+            event = self.frame_event
+            with self.lock:
+                seqs = list(self.seqs)
+            pending = [i for i in range(len(seqs)) if seqs[i] != viewer.sent_seqs[i]]
+            if not pending:
+                await event.wait()
+                continue
+            delay = next_send - self.loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            for i in pending:
+                self.send_message(writer, WebViewerServerThread.OP_BINARY, self.frame_message(i, viewer))
+            next_send = self.loop.time() + viewer.interval
+            await writer.drain()
+
+    @staticmethod
+    def send_message(writer, opcode, payload):
+        """
+        Write one unmasked WebSocket message
+        """
+        size = len(payload)
+        if size < 126:
+            header = pack("!BB", 0x80 | opcode, size)
+        elif size < 65536:
+            header = pack("!BBH", 0x80 | opcode, 126, size)
+        else:
+            header = pack("!BBQ", 0x80 | opcode, 127, size)
+        writer.write(header)
+        writer.write(payload)
+
+    async def receive_messages(self, reader, writer):
+        """
+        Answer the viewer's control messages until it closes the connection
+        :return: None
+        """
+        try:
+            while True:
+                b0, b1 = await reader.readexactly(2)
+                opcode = b0 & 0x0F
+                size = b1 & 0x7F
+                if size == 126:
+                    size = int.from_bytes(await reader.readexactly(2), "big")
+                elif size == 127:
+                    size = int.from_bytes(await reader.readexactly(8), "big")
+                if size > WebViewerServerThread.max_client_message:
+                    return
+                mask = await reader.readexactly(4) if b1 & 0x80 else b"\x00\x00\x00\x00"
+                payload = bytes([b ^ mask[j % 4] for j, b in enumerate(await reader.readexactly(size))])
+                if opcode == WebViewerServerThread.OP_CLOSE:
+                    self.send_message(writer, WebViewerServerThread.OP_CLOSE, payload[0:2])
+                    return
+                if opcode == WebViewerServerThread.OP_PING:
+                    self.send_message(writer, WebViewerServerThread.OP_PONG, payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+
+# The page served to browsers
+viewer_page = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>LED Emulator</title>
+<style>
+body { background: #202020; color: #c0c0c0; font-family: monospace; margin: 8px; }
+canvas { background: #000000; display: block; margin-bottom: 12px; }
+</style>
+</head>
+<body>
+<div id="status">Connecting...</div>
+<div id="strings"></div>
+<script>
+"use strict";
+var strings = [];
+var dirty = false;
+var frameCount = 0;
+var connected = false;
+
+function connect() {
+    var ws = new WebSocket((location.protocol === "https:" ? "wss://" : "ws://") + location.host + "/ws" +
+                           location.search);
+    ws.binaryType = "arraybuffer";
+    ws.onmessage = function (event) {
+        if (typeof event.data === "string") {
+            configure(JSON.parse(event.data).strings);
+            return;
+        }
+        var view = new DataView(event.data);
+        var s = strings[view.getUint8(1)];
+        var count = view.getUint32(4);
+        if (view.getUint8(0) === 1) {
+            s.rgb.set(new Uint8Array(event.data, 8, Math.min(count, s.numPixels) * 3));
+        } else {
+            for (var i = 0, offset = 8; i < count; i++, offset += 7) {
+                var p = view.getUint32(offset) * 3;
+                s.rgb[p] = view.getUint8(offset + 4);
+                s.rgb[p + 1] = view.getUint8(offset + 5);
+                s.rgb[p + 2] = view.getUint8(offset + 6);
+            }
+        }
+        s.dirty = true;
+        frameCount++;
+        if (!dirty) {
+            dirty = true;
+            requestAnimationFrame(draw);
+        }
+    };
+    ws.onopen = function () {
+        connected = true;
+        document.getElementById("status").textContent = "Connected";
+    };
+    ws.onclose = function () {
+        connected = false;
+        document.getElementById("status").textContent = "Disconnected, retrying...";
+        setTimeout(connect, 2000);
+    };
+}
+
+function configure(config) {
+    var container = document.getElementById("strings");
+    container.innerHTML = "";
+    strings = config.map(function (c) {
+        var cell = Math.max(4, Math.min(24, Math.floor((window.innerWidth - 32) / c.layout.width)));
+        var title = document.createElement("div");
+        title.textContent = c.name + " (" + c.num_pixels + " pixels)";
+        var canvas = document.createElement("canvas");
+        canvas.width = c.layout.width * cell;
+        canvas.height = c.layout.height * cell;
+        container.appendChild(title);
+        container.appendChild(canvas);
+        return {numPixels: c.num_pixels, positions: c.layout.positions, cell: cell,
+                rgb: new Uint8Array(c.num_pixels * 3), context: canvas.getContext("2d"), dirty: true};
+    });
+}
+
+function draw() {
+    dirty = false;
+    strings.forEach(function (s) {
+        if (!s.dirty) {
+            return;
+        }
+        s.dirty = false;
+        var size = Math.max(1, s.cell - 2);
+        for (var i = 0; i < s.numPixels; i++) {
+            var p = s.positions[i];
+            s.context.fillStyle = "rgb(" + s.rgb[i * 3] + "," + s.rgb[i * 3 + 1] + "," + s.rgb[i * 3 + 2] + ")";
+            s.context.fillRect(Math.round(p[0] * s.cell) + 1, Math.round(p[1] * s.cell) + 1, size, size);
+        }
+    });
+}
+
+setInterval(function () {
+    if (connected) {
+        document.getElementById("status").textContent = "Connected, " + frameCount + " frames/sec";
+    }
+    frameCount = 0;
+}, 1000);
+connect();
+</script>
+</body>
+</html>
+"""
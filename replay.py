@@ -0,0 +1,224 @@
+#
+# replay - play back a frame capture file
+# Copyright © 2019  Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Frames from a capture file (see frame_capture.py) are played back
+# either into a LED window (or headless frame sink) in this process, or
+# over TCP to a running emulator using the same wire format as test_client.
+#
+#   python replay.py soak.cap                          original timing, LED window
+#   python replay.py soak.cap --speed 10 --headless    10x faster, null sink
+#   python replay.py soak.cap --fast --host pi --port 5555
+#
+# Frames are read straight from the memory mapped capture file. Pixel
+# data is never copied on its way to the socket or frame queue.
+#
+
+import argparse
+import socket
+import threading
+import time
+from struct import pack
+import app_logger
+from configuration import Configuration
+from frame_capture import CaptureReader
+from frame_queue import FrameRingBuffer
+from frame_sinks import sink_names, create_frame_sink
+from led_frame import LEDFrame
+from led_string import LEDString, LEDStrings
+
+logger = app_logger.getAppLogger()
+
+
+def replay_frames(reader, send, speed=1.0, start=0, count=None, stop_event=None):
+    """
+    Call send for each frame in a capture at the time it was recorded
+    :param reader: CaptureReader
+    :param send: A callable taking (timestamp, seq, data) where data is a
+    memoryview of the frame's pixel data
+    :param speed: Time scale. 1.0 is the original timing, 2.0 is twice as
+    fast and 0 is as fast as possible.
+    :param start: First frame number
+    :param count: Number of frames, None for all remaining frames
+    :param stop_event: Optional threading.Event that ends the replay when set
+    :return: Returns the number of frames sent
+    """
+    end = len(reader) if count is None else min(len(reader), start + count)
+    if start >= end:
+        return 0
+    first_timestamp = reader.timestamp(start)
+    wall_start = time.perf_counter()
+    sent = 0
+    for index in range(start, end):
+        if stop_event and stop_event.is_set():
+            break
+        timestamp, seq, data = reader.record(index)
+        if speed:
+            delay = ((timestamp - first_timestamp) / speed) - (time.perf_counter() - wall_start)
+            if delay > 0:
+                time.sleep(delay)
+        send(timestamp, seq, data)
+        sent += 1
+    return sent
+
+
+class TCPFrameSender:
+    """
+    Sends capture frames to an emulator. Each frame goes out in the
+    test_client.frame_send format: the frame size, a 4 byte header, the
+    pixel data and a 4 byte trailer.
+    """
+    def __init__(self, host, port, num_pixels):
+        frame_size = (num_pixels * LEDFrame.pixel_size) + 8
+        # Frame size and header are the same for every frame
+        self.prefix = pack('!i', frame_size) + bytes(4)
+        self.trailer = bytes([0xFF, 0xFF, 0xFF, 0xFF])
+        self.message_size = frame_size + 4
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.use_sendmsg = hasattr(self.sock, "sendmsg")
+
+    def send(self, timestamp, seq, data):
+        if self.use_sendmsg:
+            # Gather the pieces in one system call without joining them
+            sent = self.sock.sendmsg([self.prefix, data, self.trailer])
+            if sent == self.message_size:
+                return
+            remaining = (self.prefix + bytes(data) + self.trailer)[sent:]
+        else:
+            remaining = self.prefix + bytes(data) + self.trailer
+        self.sock.sendall(remaining)
+
+    def close(self):
+        self.sock.close()
+
+
+def replay_tcp(reader, host, port, speed=1.0, start=0, count=None):
+    """
+    Replay a capture to an emulator over TCP
+    :return: Returns the number of frames sent
+    """
+    sender = TCPFrameSender(host, port, reader.num_pixels)
+    try:
+        return replay_frames(reader, sender.send, speed=speed, start=start, count=count)
+    finally:
+        sender.close()
+
+
+def replay_local(reader, speed=1.0, start=0, count=None, headless=False, sink=None):
+    """
+    Replay a capture into a LED string in this process. The string is
+    displayed in the LED window or drained into a frame sink.
+    :return: Returns the number of frames sent
+    """
+    # When replaying as fast as possible, the queue applies backpressure
+    # instead of dropping frames
+    policy = FrameRingBuffer.BLOCK if not speed else Configuration.frame_queue_policy()
+    color_pipeline = LEDStrings.default().color_pipeline
+    led_string = LEDString("replay", 0, reader.num_pixels,
+                           queue_size=Configuration.frame_queue_size(), queue_policy=policy,
+                           layout=reader.layout, color_pipeline=color_pipeline)
+    LEDStrings.configure([led_string])
+
+    def put_frame(timestamp, seq, data):
+        led_string.frame_queue.put(LEDFrame(data, timestamp=time.time()))
+        if led_string.notifier:
+            led_string.notifier.notify()
+
+    stop_event = threading.Event()
+    done_event = threading.Event()
+    result = []
+
+    def run_replay():
+        try:
+            result.append(replay_frames(reader, put_frame, speed=speed, start=start, count=count,
+                                        stop_event=stop_event))
+        finally:
+            done_event.set()
+
+    replay_thread = threading.Thread(target=run_replay, name="replay")
+    replay_thread.start()
+    try:
+        if headless:
+            from led_headless import run_headless
+            drain_event = threading.Event()
+
+            # The sink stops once the replay is done and the queue is empty
+            def watch():
+                done_event.wait()
+                while len(led_string.frame_queue):
+                    time.sleep(0.01)
+                drain_event.set()
+
+            threading.Thread(target=watch, name="replay-watch", daemon=True).start()
+            run_headless(sink, polling_interval_ms=Configuration.polling_interval(),
+                         stop_event=drain_event, led_string=led_string)
+        else:
+            from led_window import run_led_window
+            run_led_window([led_string], renderer=Configuration.renderer(),
+                           polling_interval_ms=Configuration.polling_interval(),
+                           max_fps=Configuration.max_fps())
+    finally:
+        stop_event.set()
+        led_string.frame_queue.close()
+        replay_thread.join()
+    return result[0] if result else 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay a LED Emulator capture file")
+    parser.add_argument("capture", help="Capture file")
+    parser.add_argument("--speed", type=float, default=1.0, help="Time scale, e.g. 2 for twice as fast")
+    parser.add_argument("--fast", action="store_true", help="Replay as fast as possible")
+    parser.add_argument("--start", type=int, default=0, help="First frame number")
+    parser.add_argument("--count", type=int, default=None, help="Number of frames")
+    parser.add_argument("--host", help="Send frames to the emulator on this host")
+    parser.add_argument("--port", type=int, default=Configuration.port(), help="Emulator port")
+    parser.add_argument("--headless", action="store_true", help="Drain frames into a frame sink")
+    parser.add_argument("--sink", choices=sink_names, default="null", help="Frame sink used when headless")
+    parser.add_argument("--sink-file", dest="sink_file", default="", help="Output file for the file frame sink")
+    return parser.parse_args()
+
+
+def main():
+    Configuration.load_configuration()
+    args = parse_args()
+    app_logger.EnableEngineLogging()
+    speed = 0 if args.fast else args.speed
+
+    with CaptureReader(args.capture) as reader:
+        logger.info("Replaying %s: %d frames of %d pixels", args.capture, len(reader), reader.num_pixels)
+        start_time = time.time()
+        try:
+            if args.host:
+                sent = replay_tcp(reader, args.host, args.port, speed=speed, start=args.start, count=args.count)
+            else:
+                sink = create_frame_sink(args.sink, args.sink_file) if args.headless else None
+                sent = replay_local(reader, speed=speed, start=args.start, count=args.count,
+                                    headless=args.headless, sink=sink)
+        except KeyboardInterrupt:
+            sent = 0
+        elapsed = time.time() - start_time
+        logger.info("Replayed %d frames in %.1f sec", sent, elapsed)
+    app_logger.Shutdown()
+
+
+#
+# Run as an application
+#
+if __name__ == "__main__":
+    main()
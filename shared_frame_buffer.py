@@ -0,0 +1,247 @@
+#
+# Shared memory LED data frame buffer
+# Copyright © 2019  Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# A triple buffer in shared memory that passes the newest frame of a LED
+# string from an ingest worker process (the writer) to the render
+# process (the reader).
+#
+# Shared memory layout
+#   control     64 bytes (see control_struct)
+#     seq           uint64   number of frames written
+#     latest_slot   uint64   slot holding the newest frame
+#     reading_slot  uint64   slot the reader is using (no_slot if none)
+#     wake_pending  uint64   1 while a wakeup is in the wake pipe
+#     timestamps    3 float64, time.time() each slot was written
+#   slots       3 slots of num_pixels * 4 bytes (brightness, r, g, b)
+#
+# The writer always fills a slot that is neither the newest one nor the
+# one being read, so a frame is never changed while the reader is using
+# it and the reader never copies a frame. The control block is only
+# read or written while holding a multiprocessing lock, which is held
+# just long enough to pick a slot. Frame data is copied outside the lock.
+#
+# Every publish advances seq. The reader only ever sees the newest
+# frame; the frames it did not see are reported as skipped.
+#
+
+import multiprocessing
+import threading
+from struct import Struct
+from multiprocessing import shared_memory
+from led_frame import LEDFrame
+
+# Worker processes are always spawned, never forked, so they do not
+# inherit the render process's threads or Tk state
+context = multiprocessing.get_context("spawn")
+
+control_struct = Struct("<QQQQddd")
+control_size = 64
+slot_count = 3
+no_slot = slot_count
+
+
+class SharedFrameBuffer:
+    """
+    One LED string's triple buffer. It is created by the render process
+    and passed to the ingest worker process when the worker is started.
+    """
+    def __init__(self, num_pixels):
+        """
+        Constructor. Creates the shared memory.
+        :param num_pixels: Number of pixels in every frame
+        """
+        self.num_pixels = num_pixels
+        self.frame_body_size = num_pixels * LEDFrame.pixel_size
+        self.shm = shared_memory.SharedMemory(create=True, size=control_size + (slot_count * self.frame_body_size))
+        self.owner = True
+        self.lock = context.Lock()
+        # The writer tells the reader about new frames through a pipe
+        self.wake_recv, self.wake_send = context.Pipe(duplex=False)
+        control_struct.pack_into(self.shm.buf, 0, 0, 1, no_slot, 0, 0.0, 0.0, 0.0)
+        self._attach()
+
+    def __getstate__(self):
+        # What the worker process receives
+        return {"name": self.shm.name, "num_pixels": self.num_pixels, "lock": self.lock,
+                "wake_send": self.wake_send}
+
+    def __setstate__(self, state):
+        self.num_pixels = state["num_pixels"]
+        self.frame_body_size = self.num_pixels * LEDFrame.pixel_size
+        self.shm = shared_memory.SharedMemory(name=state["name"])
+        self.owner = False
+        self.lock = state["lock"]
+        self.wake_recv = None
+        self.wake_send = state["wake_send"]
+        self._attach()
+
+    def _attach(self):
+        buf = self.shm.buf
+        self.slots = [buf[control_size + (i * self.frame_body_size):control_size + ((i + 1) * self.frame_body_size)]
+                      for i in range(slot_count)]
+        self.read_views = [slot.toreadonly() for slot in self.slots]
+        # Writer state (only used in the writer process)
+        self.write_lock = threading.Lock()
+        self.write_slot = 0
+        # Reader state (only used in the reader process)
+        self.last_seq = 0
+        self.frame_ready = threading.Condition()
+        self.closed = False
+        self.listener = None
+
+    def _read_control(self):
+        # Caller holds the lock
+        return list(control_struct.unpack_from(self.shm.buf, 0))
+
+    def _write_control(self, control):
+        # Caller holds the lock
+        control_struct.pack_into(self.shm.buf, 0, *control)
+
+    ######################################################################
+    # Writer
+
+    def write(self, data, timestamp, frames=1):
+        """
+        Publish a frame. Called by the ingest worker's socket server threads.
+        :param data: The frame body, num_pixels * 4 bytes
+        :param timestamp: time.time() when the frame was received
+        :param frames: Number of frames this one stands for (a batch
+        publishes only its newest frame)
+        :return: None
+        """
+        with self.write_lock:
+            slot = self.write_slot
+            self.slots[slot][:] = data
+            with self.lock:
+                control = self._read_control()
+                control[0] += frames
+                control[1] = slot
+                control[4 + slot] = timestamp
+                reading = control[2]
+                wake = control[3] == 0
+                control[3] = 1
+                self._write_control(control)
+            # The next frame goes into the slot that is neither the newest nor being read
+            self.write_slot = [s for s in range(slot_count) if s != slot and s != reading][0]
+        if wake:
+            try:
+                self.wake_send.send_bytes(b"\x00")
+            except (OSError, ValueError):
+                pass
+
+    ######################################################################
+    # Reader
+
+    def seq(self):
+        """
+        :return: Returns the number of frames written so far
+        """
+        with self.lock:
+            return self._read_control()[0]
+
+    def read_latest(self):
+        """
+        Take the newest frame. The frame's data is a view of the shared
+        memory. It is valid until the next call that returns a frame.
+        :return: Returns a tuple (frame, skipped) where skipped is the number
+        of frames that were never seen. The frame is None if no frame has
+        arrived since the last call.
+        """
+        with self.lock:
+            control = self._read_control()
+            seq = control[0]
+            if seq == self.last_seq:
+                return None, 0
+            slot = control[1]
+            # Claim the slot so the writer leaves it alone
+            control[2] = slot
+            self._write_control(control)
+        skipped = seq - self.last_seq - 1
+        self.last_seq = seq
+        return LEDFrame(self.read_views[slot], timestamp=control[4 + slot]), skipped
+
+    def wait(self, timeout=None):
+        """
+        Wait for a frame the reader has not seen
+        :param timeout: Maximum time to wait in seconds
+        :return: Returns True if there is a new frame
+        """
+        with self.frame_ready:
+            if self.seq() == self.last_seq and not self.closed:
+                self.frame_ready.wait(timeout)
+        return self.seq() != self.last_seq
+
+    def start_listener(self, on_frame=None):
+        """
+        Start a thread that waits for wakeups from the writer.
+        :param on_frame: Optional callable, called (on the listener thread)
+        when new frames have arrived
+        :return: None
+        """
+        self.listener = threading.Thread(target=self._listen, args=(on_frame,), name="SharedFrameListener")
+        self.listener.daemon = True
+        self.listener.start()
+
+    def _listen(self, on_frame):
+        while True:
+            try:
+                self.wake_recv.recv_bytes()
+            except (EOFError, OSError):
+                break
+            if self.closed:
+                break
+            # Clear the wakeup before looking at the frames, so frames that
+            # arrive from now on cause another wakeup
+            with self.lock:
+                control = self._read_control()
+                control[3] = 0
+                self._write_control(control)
+            while self.wake_recv.poll(0):
+                self.wake_recv.recv_bytes()
+            with self.frame_ready:
+                self.frame_ready.notify_all()
+            if on_frame:
+                on_frame()
+
+    def close(self):
+        """
+        Release the shared memory. The creator also removes it.
+        :return: None
+        """
+        self.closed = True
+        with self.frame_ready:
+            self.frame_ready.notify_all()
+        if self.listener:
+            # Wake up the listener so it sees closed
+            try:
+                self.wake_send.send_bytes(b"\x00")
+            except (OSError, ValueError):
+                pass
+            self.listener.join(1.0)
+            self.listener = None
+        for view in self.read_views + self.slots:
+            view.release()
+        self.read_views = []
+        self.slots = []
+        try:
+            self.shm.close()
+        except BufferError:
+            # Frames returned by the reader are still in use
+            pass
+        if self.owner:
+            self.shm.unlink()
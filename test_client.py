@@ -60,6 +60,56 @@ def frame_send(sock, frame):
     block_send(sock, len(frame))
     block_send(sock, frame)
 
+def batch_send(sock, frames, timestamps=None):
+    """
+    Send several frames in one batch message
+    :param sock:
+    :param frames: A list of complete frames (header, pixels, trailer)
+    :param timestamps: Optional list of frame times in seconds
+    :return: None
+    """
+    num_pixels = (len(frames[0]) - 8) // 4
+    flags = 0x01 if timestamps else 0
+    message = pack('!iHBxI', -1, len(frames), flags, num_pixels)
+    if timestamps:
+        message += pack('!{0}d'.format(len(frames)), *timestamps)
+    block_send(sock, message + b"".join(frames))
+
+def delta_send(sock, num_pixels, changes):
+    """
+    Send only the pixels that changed since the previous frame
+    :param sock:
+    :param num_pixels: Number of pixels in the LED string
+    :param changes: A list of (index, pixel) where pixel is 4 bytes (brightness, r, g, b)
+    :return: None
+    """
+    message = pack('!iII', -2, num_pixels, len(changes))
+    message += b"".join([pack('!H', index) + bytes(pixel) for index, pixel in changes])
+    block_send(sock, message)
+
+def rle_send(sock, num_pixels, runs):
+    """
+    Send a frame as runs of identical pixels
+    :param sock:
+    :param num_pixels: Number of pixels in the LED string
+    :param runs: A list of (length, pixel) where pixel is 4 bytes (brightness, r, g, b)
+    :return: None
+    """
+    message = pack('!iII', -3, num_pixels, len(runs))
+    message += b"".join([pack('!H', length) + bytes(pixel) for length, pixel in runs])
+    block_send(sock, message)
+
+def datagram_send(sock, address, seq, frame):
+    """
+    Send a frame in one UDP datagram
+    :param sock: A SOCK_DGRAM socket
+    :param address: (host, udp port) of the emulator
+    :param seq: Frame sequence number, incremented for each frame
+    :param frame: A complete frame (header, pixels, trailer)
+    :return: None
+    """
+    sock.sendto(pack('!I', seq & 0xFFFFFFFF) + frame, address)
+
 def block_send(sock, block):
     total_sent = 0
     if isinstance(block, int):
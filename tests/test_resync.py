@@ -0,0 +1,140 @@
+# coding: utf-8
+#
+# Stream resynchronization tests
+# Copyright © 2016, 2018  Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# See the LICENSE file for more details.
+#
+
+import asyncio
+import os
+import socket
+import sys
+import threading
+import unittest
+from struct import pack
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ledsocketserver.TCPRequestHandler import TCPRequestHandler
+from ledsocketserver.AsyncRequestHandler import AsyncRequestHandler
+
+NUM_PIXELS = 20
+FRAME_SIZE = 8 + (NUM_PIXELS * 4)
+MAX_FRAME_SIZE = 400
+
+
+class RecordingHandler:
+    """
+    Command handler that keeps a copy of every frame it is given
+    """
+    frames = []
+
+    def execute_command(self, port, led_data):
+        RecordingHandler.frames.append(bytes(led_data))
+
+
+def frame(value):
+    return b"\x00" * 4 + bytes([0xFF, value, value, value]) * NUM_PIXELS + b"\xff" * 4
+
+
+def marker_in_oversized_frame():
+    """
+    A 200 byte frame with no end frame. A complete frame message starts
+    10 bytes into the stream, and the rest of the oversized frame follows
+    it. A good frame message comes after that.
+    :return: Returns the stream
+    """
+    inner = pack("!i", FRAME_SIZE) + frame(1)
+    body = b"\x11" * 6 + inner
+    body += b"\x11" * (200 - len(body))
+    return pack("!i", len(body)) + body + pack("!i", FRAME_SIZE) + frame(2)
+
+
+def marker_in_fitted_frame():
+    """
+    A variable frame of 30 pixels with a bad header. A complete frame
+    message starts in its pixels and ends after the first 20 of them, so
+    only the frame as received (not as fitted) holds all of it.
+    :return: Returns the stream
+    """
+    pixels = pack("!i", FRAME_SIZE) + frame(1)
+    pixels += b"\xff\x01\x01\x01" * (30 - (len(pixels) // 4))
+    body = b"\x01\x00\x00\x00" + pixels + b"\xff" * 4
+    return pack("!i", len(body)) + body + pack("!i", FRAME_SIZE) + frame(2)
+
+
+def run_threaded(stream):
+    """
+    Pass a stream through a TCPRequestHandler
+    """
+    listener = socket.create_server(("127.0.0.1", 0))
+    client = socket.create_connection(listener.getsockname())
+    connection, address = listener.accept()
+    listener.close()
+    sender = threading.Thread(target=lambda: (client.sendall(stream), client.close()))
+    sender.start()
+    try:
+        TCPRequestHandler(connection, address, None)
+    finally:
+        sender.join()
+        connection.close()
+
+
+def run_async(stream):
+    """
+    Pass a stream through AsyncRequestHandler
+    """
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(stream)
+        reader.feed_eof()
+        await AsyncRequestHandler.handle_connection(reader, FakeWriter())
+    asyncio.run(run())
+
+
+class FakeWriter:
+    def get_extra_info(self, name):
+        return ("127.0.0.1", 5555)
+
+    def close(self):
+        pass
+
+
+class TestResync(unittest.TestCase):
+    def setUp(self):
+        TCPRequestHandler.set_command_handler_class(RecordingHandler)
+        TCPRequestHandler.set_frame_size(FRAME_SIZE)
+        TCPRequestHandler.set_strict_frames(True)
+        TCPRequestHandler.set_max_frame_size(MAX_FRAME_SIZE)
+        RecordingHandler.frames = []
+
+    def tearDown(self):
+        TCPRequestHandler.set_command_handler_class(None)
+        TCPRequestHandler.set_frame_size(8 + (50 * 4))
+        TCPRequestHandler.set_strict_frames(False)
+        TCPRequestHandler.set_max_frame_size(0)
+
+    def test_marker_inside_oversized_variable_frame(self):
+        run_threaded(marker_in_oversized_frame())
+        self.assertEqual(RecordingHandler.frames, [frame(1), frame(2)])
+
+    def test_marker_inside_oversized_variable_frame_async(self):
+        run_async(marker_in_oversized_frame())
+        self.assertEqual(RecordingHandler.frames, [frame(1), frame(2)])
+
+    def test_resync_searches_received_variable_frame(self):
+        run_threaded(marker_in_fitted_frame())
+        self.assertEqual(RecordingHandler.frames, [frame(1), frame(2)])
+
+    def test_resync_searches_received_variable_frame_async(self):
+        run_async(marker_in_fitted_frame())
+        self.assertEqual(RecordingHandler.frames, [frame(1), frame(2)])
+
+
+if __name__ == "__main__":
+    unittest.main()